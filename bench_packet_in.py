@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark del parseo de packet-in en controlador.py: decodificación
+# completa con ryu.lib.packet (camino anterior) frente a la lectura directa
+# de la cabecera Ethernet (camino rápido), que sólo decodifica los ARP.
+#
+# Uso:
+#     python3 bench_packet_in.py [captura.pcap] [repeticiones]
+#
+# Sin captura se usa una mezcla sintética de tramas UDP/5004, TCP/1883 y ARP.
+#
+import sys
+import time
+
+from ryu.lib import pcaplib
+from ryu.lib.packet import packet, ethernet, arp, ipv4, tcp, udp, ether_types
+
+from controlador import ETH_HEADER
+
+
+def synthetic_frames():
+    """Tramas típicas de la red: IPTV, MQTT y ARP entre hosts de la VLAN."""
+    frames = []
+    for proto in (udp.udp(src_port=40000, dst_port=5004),
+                  tcp.tcp(src_port=40001, dst_port=1883)):
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(
+            dst='00:00:00:00:00:06', src='00:00:00:00:00:03',
+            ethertype=ether_types.ETH_TYPE_IP))
+        pkt.add_protocol(ipv4.ipv4(
+            src='192.168.10.3', dst='192.168.10.6',
+            proto=6 if isinstance(proto, tcp.tcp) else 17))
+        pkt.add_protocol(proto)
+        pkt.add_protocol(b'\x00' * 1000)
+        pkt.serialize()
+        frames.append(bytes(pkt.data))
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(
+        dst='ff:ff:ff:ff:ff:ff', src='00:00:00:00:00:03',
+        ethertype=ether_types.ETH_TYPE_ARP))
+    pkt.add_protocol(arp.arp(
+        opcode=arp.ARP_REQUEST, src_mac='00:00:00:00:00:03',
+        src_ip='192.168.10.3', dst_mac='00:00:00:00:00:00',
+        dst_ip='192.168.10.169'))
+    pkt.serialize()
+    frames.append(bytes(pkt.data))
+    # proporción aproximada de un packet-in real: mayoría de tráfico IP
+    return frames[:1] * 4 + frames[1:2] * 4 + frames[2:]
+
+
+def pcap_frames(path):
+    with open(path, 'rb') as f:
+        return [bytes(buf) for _, buf in pcaplib.Reader(f)]
+
+
+def full_parse(data):
+    """Camino anterior: Packet(msg.data) para todas las tramas."""
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocol(ethernet.ethernet)
+    if eth.ethertype == ether_types.ETH_TYPE_ARP:
+        pkt.get_protocol(arp.arp)
+    return eth.dst, eth.src, eth.ethertype
+
+
+def fast_parse(data):
+    """Camino rápido: cabecera Ethernet con struct, ARP con el parser completo."""
+    dst, src, ethertype = ETH_HEADER.unpack_from(data)
+    if ethertype == ether_types.ETH_TYPE_ARP:
+        packet.Packet(data).get_protocol(arp.arp)
+    return dst, src, ethertype
+
+
+def bench(func, frames, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for data in frames:
+            func(data)
+    return (time.perf_counter() - start) / (rounds * len(frames))
+
+
+def main():
+    frames = pcap_frames(sys.argv[1]) if len(sys.argv) > 1 else synthetic_frames()
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    if not frames:
+        sys.exit("La captura no tiene tramas")
+    n_arp = sum(1 for data in frames
+                if ETH_HEADER.unpack_from(data)[2] == ether_types.ETH_TYPE_ARP)
+    print("%d tramas (%d ARP) x %d repeticiones" % (len(frames), n_arp, rounds))
+
+    before = bench(full_parse, frames, rounds)
+    after = bench(fast_parse, frames, rounds)
+    print("antes:   %8.2f us/paquete" % (before * 1e6))
+    print("despues: %8.2f us/paquete" % (after * 1e6))
+    print("mejora:  %8.1fx" % (before / after))
+
+
+if __name__ == '__main__':
+    main()
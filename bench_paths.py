@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark de PathEngine (controlador.py) sobre un grafo aleatorio
+# conexo: cálculo en frío y con caché de las Route que usan los servicios, y
+# coste de un evento de enlace (invalidación incremental de la caché).
+#
+# Uso:
+#     python3 bench_paths.py [switches] [enlaces por switch] [pares]
+#
+import random
+import sys
+import time
+
+from controlador import PathEngine, Route
+
+
+def random_links(switches, degree, seed=1):
+    """Árbol aleatorio más enlaces extra hasta el grado medio pedido."""
+    rng = random.Random(seed)
+    links = set()
+    for b in range(2, switches + 1):
+        links.add((rng.randint(1, b - 1), b))
+    while len(links) < switches * degree // 2:
+        a, b = sorted(rng.sample(range(1, switches + 1), 2))
+        links.add((a, b))
+    return [(a, 0, b, 0) for a, b in sorted(links)]
+
+
+def bench(engine, pairs, route):
+    start = time.perf_counter()
+    for src, dst in pairs:
+        engine.paths(src, dst, route)
+    return (time.perf_counter() - start) / len(pairs)
+
+
+def main():
+    switches = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    degree = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    n_pairs = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    links = random_links(switches, degree)
+    rng = random.Random(2)
+    pairs = [tuple(rng.sample(range(1, switches + 1), 2))
+             for _ in range(n_pairs)]
+    print("%d switches, %d enlaces, %d pares" % (switches, len(links), n_pairs))
+
+    for route in (Route(1), Route(2, disjoint=True), Route(2), Route(3)):
+        engine = PathEngine(links)
+        cold = bench(engine, pairs, route)
+        warm = bench(engine, pairs, route)
+        print("k=%d %-10s  en frío: %7.3f ms   con caché: %7.4f ms"
+              % (route.k, 'disjuntos' if route.disjoint else '',
+                 cold * 1e3, warm * 1e3))
+
+    engine = PathEngine(links)
+    bench(engine, pairs, Route(2))
+    start = time.perf_counter()
+    for a, _, b, _ in links[:50]:
+        engine.remove_link(a, b)
+        engine.add_link(a, b)
+    print("evento de enlace: %.3f ms"
+          % ((time.perf_counter() - start) / 100 * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Comprobación de la protección fast-failover de PolicyCompiler: recorre
+# paquete a paquete las tablas compiladas (con los grupos FF eligiendo el
+# primer bucket cuyo puerto vigilado sigue vivo) y verifica, para cada enlace
+# caído, que el tráfico no entra en bucle y llega a su destino si el grafo
+# sin ese enlace aún lo permite.
+#
+#   1. Los servicios de SERVICES sobre LINKS, sin fallos y con cada enlace
+#      caído de uno en uno.
+#   2. Un servicio protegido entre dos switches al azar de topologías
+#      aleatorias conexas, con cada uno de sus enlaces caído.
+#
+# Uso:
+#     python3 check_failover.py [topologías aleatorias] [semilla]
+#
+import random
+import sys
+
+from controlador import (HOSTS, LINKS, SERVICES, SERVICE_QUEUES, HostService,
+                         PathEngine, PolicyCompiler, Route, resolve_routes)
+
+MAX_HOPS = 30
+
+
+def _matches(match, pkt, metadata):
+    for field, value in match:
+        current = metadata if field == 'metadata' else pkt.get(field)
+        if current is None:
+            return False
+        if isinstance(value, tuple):
+            if current & value[1] != value[0]:
+                return False
+        elif current != value:
+            return False
+    return True
+
+
+def pipeline(flows, pkt):
+    """Acciones que aplica un switch a pkt recorriendo sus tablas."""
+    table, metadata, actions = 0, 0, []
+    while True:
+        candidates = [flow for flow in flows if flow.table_id == table
+                      and _matches(flow.match, pkt, metadata)]
+        if not candidates:
+            return actions + [('drop',)]
+        best = max(candidates, key=lambda flow: flow.priority)
+        goto = None
+        for action in best.actions:
+            if action[0] == 'goto':
+                goto = action[1]
+            elif action[0] == 'write_metadata':
+                metadata = (metadata & ~action[2]) | (action[1] & action[2])
+            else:
+                actions.append(action)
+        if goto is None:
+            return actions
+        table = goto
+
+
+class Network(object):
+    """Tablas compiladas sobre links y recorrido de paquetes con enlaces caídos."""
+
+    def __init__(self, links, tables):
+        self.tables = tables
+        self.peer = {}
+        for a, port_a, b, port_b in links:
+            self.peer[(a, port_a)] = (b, port_b)
+            self.peer[(b, port_b)] = (a, port_a)
+
+    def _alive(self, dpid, port, down):
+        return (dpid, port) not in self.peer or frozenset(
+            ((dpid, port), self.peer[(dpid, port)])) not in down
+
+    def walk(self, dpid, pkt, down, hops=0):
+        """Resultados de pkt entrando en dpid: ('host', dpid, puerto, vlan),
+        'loop', 'dead' (salida por un enlace caído) o 'drop'."""
+        if hops > MAX_HOPS:
+            return ['loop']
+        tables = self.tables.get(dpid)
+        if tables is None:
+            return ['drop']
+        groups = dict((group.group_id, group) for group in tables.groups)
+        result = []
+
+        def apply(actions, pkt):
+            pkt = dict(pkt)
+            for action in actions:
+                if action[0] == 'push_vlan':
+                    pkt['vlan_vid'] = 0x1000 | action[1]
+                elif action[0] == 'pop_vlan':
+                    pkt['vlan_vid'] = 0
+                elif action[0] == 'drop':
+                    result.append('drop')
+                elif action[0] == 'output':
+                    port = action[1]
+                    if not self._alive(dpid, port, down):
+                        result.append('dead')
+                    elif (dpid, port) in self.peer:
+                        peer, peer_port = self.peer[(dpid, port)]
+                        result.extend(self.walk(
+                            peer, dict(pkt, in_port=peer_port), down,
+                            hops + 1))
+                    else:
+                        result.append(('host', dpid, port, pkt['vlan_vid']))
+                elif action[0] == 'group':
+                    group = groups[action[1]]
+                    if group.type_ == 'ff':
+                        live = [bucket for bucket in group.buckets
+                                if self._alive(dpid, bucket.watch_port, down)]
+                        if live:
+                            apply(live[0].actions, pkt)
+                        else:
+                            result.append('dead')
+                    else:
+                        # ALL: todos los buckets; SELECT: basta con que
+                        # cualquiera de ellos sea correcto, se prueban todos
+                        for bucket in group.buckets:
+                            apply(bucket.actions, pkt)
+
+        apply(pipeline(tables.flows, pkt), pkt)
+        return result
+
+
+def _failures(links):
+    return [None] + [frozenset(((a, port_a), (b, port_b)))
+                     for a, port_a, b, port_b in links]
+
+
+def _without(links, down):
+    return [link for link in links
+            if frozenset(((link[0], link[1]), (link[2], link[3]))) != down]
+
+
+def _host_packet(svc, src, dst, side, hosts):
+    proto = 6 if svc.proto == 'tcp' else 17
+    other = 'src' if side == 'dst' else 'dst'
+    return dict(eth_type=0x800, ipv4_src=src, ipv4_dst=dst, ip_proto=proto,
+                vlan_vid=0, in_port=hosts[src][1],
+                **{'%s_%s' % (svc.proto, side): svc.l4_port,
+                   '%s_%s' % (svc.proto, other): 40000})
+
+
+def check_declared():
+    """Servicios declarados sobre LINKS; devuelve el número de fallos."""
+    engine = PathEngine(LINKS)
+    services = resolve_routes(SERVICES, engine, HOSTS)
+    net = Network(LINKS, PolicyCompiler(
+        LINKS, HOSTS, queues=SERVICE_QUEUES, engine=engine).compile(services))
+    cases = []
+    for svc in services:
+        if isinstance(svc, HostService):
+            for src, dst, side in ((svc.src, svc.dst, 'dst'),
+                                   (svc.dst, svc.src, 'src')):
+                cases.append((svc.name, HOSTS[src][0],
+                              _host_packet(svc, src, dst, side, HOSTS),
+                              set([(HOSTS[dst][0], HOSTS[dst][1], 0)])))
+        else:
+            for (dpid, ports, _), (out_dpid, out_ports, _), side in (
+                    (svc.src, svc.dst, 'dst'), (svc.dst, svc.src, 'src')):
+                pkt = dict(eth_type=0x800, ipv4_src='192.168.10.3',
+                           ipv4_dst='192.168.10.5', ip_proto=17, vlan_vid=0,
+                           in_port=ports[0], udp_src=7, udp_dst=7)
+                if svc.proto:
+                    pkt.update(udp_src=40000, udp_dst=40000)
+                    pkt['udp_' + side] = svc.l4_port
+                cases.append((svc.name, dpid, pkt, set(
+                    (out_dpid, port, 0) for port in out_ports)))
+    bad = 0
+    for down in _failures(LINKS):
+        failed = set([down]) if down else set()
+        for name, dpid, pkt, want in cases:
+            result = net.walk(dpid, pkt, failed)
+            got = set(item[1:] for item in result if isinstance(item, tuple))
+            if 'loop' in result or got != want:
+                bad += 1
+                print("FALLO %s con %s caído: %r" % (
+                    name, sorted(down) if down else 'nada', result))
+    print("servicios declarados: %d casos x %d escenarios, %d fallos"
+          % (len(cases), len(LINKS) + 1, bad))
+    return bad
+
+
+def random_links(rng, switches):
+    """Árbol aleatorio más algunos enlaces extra, puertos desde el 10."""
+    pairs = set((rng.randint(1, b - 1), b) for b in range(2, switches + 1))
+    for _ in range(rng.randint(0, switches)):
+        pairs.add(tuple(sorted(rng.sample(range(1, switches + 1), 2))))
+    next_port = dict((dpid, 10) for dpid in range(1, switches + 1))
+    links = []
+    for a, b in sorted(pairs):
+        links.append((a, next_port[a], b, next_port[b]))
+        next_port[a] += 1
+        next_port[b] += 1
+    return links
+
+
+def check_random(topologies, seed):
+    """Servicio protegido en topologías aleatorias; devuelve los fallos."""
+    rng = random.Random(seed)
+    cases = loops = undelivered = 0
+    for _ in range(topologies):
+        switches = rng.randint(4, 10)
+        links = random_links(rng, switches)
+        src, dst = rng.sample(range(1, switches + 1), 2)
+        hosts = {'10.0.0.1': (src, 1), '10.0.0.2': (dst, 1)}
+        engine = PathEngine(links)
+        svc = HostService('radar', 200, 'udp', 2000, src='10.0.0.1',
+                          dst='10.0.0.2', path=engine.paths(src, dst, Route(1))[0],
+                          backup=Route(1), group_ids=(3, 4))
+        svc, = resolve_routes((svc,), engine, hosts)
+        net = Network(links, PolicyCompiler(
+            links, hosts, engine=engine).compile((svc,)))
+        for down in _failures(links):
+            failed = set([down]) if down else set()
+            reachable = PathEngine(_without(links, down)).paths(
+                src, dst, Route(1))
+            for a, b, side in (('10.0.0.1', '10.0.0.2', 'dst'),
+                               ('10.0.0.2', '10.0.0.1', 'src')):
+                cases += 1
+                result = net.walk(hosts[a][0],
+                                  _host_packet(svc, a, b, side, hosts), failed)
+                if 'loop' in result:
+                    loops += 1
+                    print("BUCLE %r camino %r caído %r" % (
+                        links, svc.path, sorted(down)))
+                elif reachable and result != [('host', hosts[b][0], 1, 0)]:
+                    undelivered += 1
+                    print("SIN ENTREGA %r camino %r respaldo %r caído %r: %r"
+                          % (links, svc.path, svc.backup, sorted(down), result))
+    print("topologías aleatorias: %d casos, %d bucles, %d sin entrega con "
+          "camino posible" % (cases, loops, undelivered))
+    return loops + undelivered
+
+
+def main():
+    topologies = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    bad = check_declared() + check_random(topologies, seed)
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+    main()
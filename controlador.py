@@ -2,21 +2,1906 @@
 # -*- coding: utf-8 -*-
 #
 # Controlador Ryu: iperf udp/5004 entre h1 (192.168.10.3) y h3 (192.168.10.6),
-# IPTV, ARP, y MQTT (192.168.10.138 ↔ 192.168.10.169) vía S1-S5-S6.
+# IPTV, ARP, y MQTT (192.168.10.138 ↔ 192.168.10.169) por el enlace directo
+# S6-S1, con S6-S5-S1 de respaldo.
 #
+# Los puertos entre switches se descubren por LLDP (ryu.topology):
+#     ryu-manager --observe-links controlador.py
+#
+import bisect
+import heapq
+import struct
+import subprocess
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import (
     CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER,
     set_ev_cls
 )
-from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet, ethernet, arp, ether_types
-from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+from ryu.lib.packet import packet, arp, ipv4, tcp, udp, ether_types
+from ryu.lib import addrconv, hub
+from ryu.topology import event as topo_event
 
 # Umbral en bps (por ejemplo 100 Mbps)
 UMBRAL_BPS = 5000
 
+# Cabecera Ethernet (dst, src, ethertype) leída directamente del packet-in;
+# sólo los ARP pasan por el parser completo de ryu.lib.packet
+ETH_HEADER = struct.Struct('!6s6sH')
+
+
+# ============================================================
+#   Modelo de políticas
+# ============================================================
+#
+# Las reglas ya no se escriben a mano por DPID: se declaran los servicios
+# (IPTV, MQTT, radar, tráfico VLAN 10↔30) sobre caminos de switches y
+# PolicyCompiler los traduce, una sola vez al arrancar, a tablas de grupos
+# y flujos por switch. Al conectarse un switch sólo se buscan y se envían.
+
+# Enlaces entre switches (dpid_a, puerto_a, dpid_b, puerto_b), según el
+# orden de los addLink de topologia.py. Sólo sirven para programar los
+# switches al arrancar: en cuanto LLDP descubre todos los enlaces que usan
+# los servicios, las tablas se recompilan con el grafo real
+LINKS = (
+    (1, 4, 2, 1),   # s1-eth4 ↔ s2-eth1
+    (1, 5, 3, 3),   # s1-eth5 ↔ s3-eth3
+    (1, 6, 5, 1),   # s1-eth6 ↔ s5-eth1
+    (1, 7, 6, 3),   # s1-eth7 ↔ s6-eth3
+    (2, 2, 3, 4),   # s2-eth2 ↔ s3-eth4
+    (3, 5, 4, 1),   # s3-eth5 ↔ s4-eth1
+    (4, 2, 5, 2),   # s4-eth2 ↔ s5-eth2
+    (5, 3, 6, 2),   # s5-eth3 ↔ s6-eth2
+)
+
+# Punto de conexión (dpid, puerto) de los hosts que usan algún servicio
+HOSTS = {
+    '192.168.10.169': (1, 3),   # h5: Mosquitto
+    '192.168.10.138': (6, 4),   # ESP32 (AP-s6)
+    '192.168.10.150': (6, 4),   # radar (AP-s6)
+    '192.168.10.105': (3, 6),   # Raspberry (AP-s3)
+    '192.168.10.108': (3, 6),   # visualizador del radar (AP-s3)
+}
+
+# Caminos calculados por PathEngine sobre el grafo de enlaces, en lugar de
+# escribirlos a mano. Se resuelven con cada cambio de topología.
+#   k:        número de caminos (del más corto al más largo, en saltos)
+#   weights:  pesos de los buckets SELECT, uno por camino en ese orden
+#   disjoint: caminos sin enlaces en común (para grupos FF)
+#   avoid:    pares de DPIDs cuyo enlace no debe usarse
+Route = namedtuple('Route', 'k weights disjoint avoid',
+                   defaults=(None, False, ()))
+
+# Servicio unicast bidireccional entre dos hosts.
+#   proto/l4_port: en la ida se compara con el puerto destino, en la vuelta
+#                  con el de origen
+#   path:          DPIDs desde el switch de src hasta el de dst, o Route; con
+#                  Route(2, ...) y group_ids el segundo camino es el respaldo
+#   backup:        camino alternativo, o Route para calcular uno sin enlaces
+#                  en común con path
+#   group_ids:     ids de los grupos FF (ida, vuelta) de un servicio
+#                  protegido: cada switch del camino salvo el último elige en
+#                  el plano de datos entre el siguiente salto y un desvío
+#                  (backup en la entrada, si lo hay)
+HostService = namedtuple(
+    'HostService',
+    'name priority proto l4_port src dst path backup group_ids')
+
+# Servicio entre los puertos de acceso de dos VLAN.
+#   src/dst:       (dpid, puertos de acceso, VLAN con la que se etiqueta)
+#   paths:         ((peso, camino), ...) o Route; con más de un camino se usa
+#                  un grupo SELECT
+#   select_groups: ids de los grupos SELECT (ida en src, vuelta en dst)
+#   flood_groups:  ids de los grupos ALL de entrega (ida en dst, vuelta en
+#                  src) o None para entregar con una lista de OUTPUTs
+#   meter_ids:     ids de los medidores que limitan el tráfico en la entrada
+#                  (ida en src, vuelta en dst) o None
+#   backup/ff_groups: protección FF como en HostService, sólo con un camino
+VlanService = namedtuple(
+    'VlanService',
+    'name priority proto l4_port src dst paths select_groups flood_groups '
+    'meter_ids backup ff_groups', defaults=(None, None, None))
+
+SERVICES = (
+    # IPTV: h1,h6,h5 (VLAN 10) ↔ h2,h3,AP-s3 (VLAN 30) por S1-S2-S3,
+    # protegido
+    VlanService('iptv', 30, 'udp', 5004,
+                src=(1, (1, 2, 3), 10), dst=(3, (1, 2, 6), 30),
+                paths=((0, (1, 2, 3)),),
+                select_groups=None, flood_groups=(21, 20),
+                backup=Route(1), ff_groups=(22, 23)),
+    # MQTT ESP32 ↔ Mosquitto: los dos caminos disjuntos más cortos entre S6
+    # y S1 (directo S6-S1, respaldo S6-S5-S1)
+    HostService('mqtt-esp32', 100, 'tcp', 1883,
+                src='192.168.10.138', dst='192.168.10.169',
+                path=Route(2, disjoint=True), backup=None, group_ids=(1, 2)),
+    # MQTT Raspberry ↔ Mosquitto: S3-S2-S1, protegido
+    HostService('mqtt-rasp', 100, 'tcp', 1883,
+                src='192.168.10.105', dst='192.168.10.169',
+                path=(3, 2, 1), backup=Route(1), group_ids=(5, 6)),
+    # UDP 2000 radar ↔ visualizador: S6-S1-S3, protegido
+    HostService('radar', 200, 'udp', 2000,
+                src='192.168.10.150', dst='192.168.10.108',
+                path=(6, 1, 3), backup=Route(1), group_ids=(3, 4)),
+    # Tráfico normal VLAN 10 ↔ VLAN 30: los dos caminos más cortos sin el
+    # enlace directo S1-S3 (reservado al desvío de MQTT); 20% por el primero
+    # (S1-S2-S3, que ya lleva IPTV) y 80% por el segundo (S1-S5-S4-S3)
+    VlanService('vlan10-30', 10, None, None,
+                src=(1, (1, 2, 3), 10), dst=(3, (1, 2, 6), 30),
+                paths=Route(2, weights=(20, 80), avoid=((1, 3),)),
+                select_groups=(10, 30), flood_groups=None, meter_ids=(1, 1)),
+)
+
+# Desvío de MQTT-Raspberry por el enlace directo S1-S3 mientras se supera el
+# umbral: se instala por encima del camino normal y se retira por su cookie
+MQTT_RASP_DETOUR = next(
+    svc for svc in SERVICES if svc.name == 'mqtt-rasp')._replace(
+        priority=101, path=(3, 1), backup=None, group_ids=None)
+
+# Cookie de las reglas, para filtrar estadísticas y borrar en el switch:
+#   bits 0-7:   servicio (SERVICE_IDS; 0 para las reglas base)
+#   bit 8:      regla de entrada del servicio (donde se clasifica el tráfico)
+#   bit 9:      tráfico entre VLAN (IPTV y best effort 10↔30)
+#   bits 16-23: origen de la regla (compilada, desvío, elefante, ARP, reactiva)
+SERVICE_IDS = {'iptv': 1, 'mqtt-esp32': 2, 'mqtt-rasp': 3, 'radar': 4,
+               'vlan10-30': 5}
+COOKIE_SERVICE_MASK = 0xff
+COOKIE_INGRESS = 0x100
+COOKIE_VLAN = 0x200
+COOKIE_ACCESS = 0x400           # conteo por puerto de acceso de una entrada
+COOKIE_KIND_MASK = 0xff << 16
+COOKIE_COMPILED = 0
+COOKIE_DETOUR = 1 << 16
+COOKIE_ELEPHANT = 2 << 16
+COOKIE_ARP_RESPONDER = 3 << 16
+COOKIE_REACTIVE = 4 << 16
+COOKIE_PACKET_IN_BLOCK = 5 << 16
+
+# Tablas del pipeline:
+#   0 clasificación: ARP, VLAN de cada puerto de acceso (en metadata) y
+#                    tramas ya etiquetadas hacia la tabla 1
+#   1 VLAN:          tránsito y entrega del tráfico etiquetado
+#   2 servicios:     MQTT, radar y entrada a los servicios entre VLAN por la
+#                    VLAN de origen, sin repetir reglas por puerto
+#   3 reenvío:       flujos reactivos y table-miss
+# Lo que no casa en una tabla sigue en la siguiente que corresponda.
+TABLE_CLASSIFY = 0
+TABLE_VLAN = 1
+TABLE_SERVICE = 2
+TABLE_FORWARD = 3
+CLASSIFY_PRIORITY = 10          # puerto de acceso -> VLAN
+CLASSIFY_TAGGED_PRIORITY = 20   # trama etiquetada -> tabla VLAN
+CLASSIFY_COUNT_PRIORITY = 15    # puerto de acceso + servicio, para contarlo
+METADATA_VLAN_MASK = 0xfff
+
+# Entradas compiladas; match y actions son tuplas para poder compararlas.
+#   actions: ('output', puerto) | ('group', id) | ('push_vlan', vid)
+#            | ('pop_vlan',) | ('controller',) | ('controller', max_len)
+#            | ('meter', id)
+#            | ('set_queue', id) | ('write_metadata', valor, máscara)
+#            | ('goto', tabla)
+FlowEntry = namedtuple('FlowEntry', 'priority match actions cookie table_id',
+                       defaults=(COOKIE_COMPILED, TABLE_CLASSIFY))
+GroupEntry = namedtuple('GroupEntry', 'group_id type_ buckets')
+Bucket = namedtuple('Bucket', 'actions weight watch_port')
+MeterEntry = namedtuple('MeterEntry', 'meter_id rate_kbps burst_kb')
+SwitchTables = namedtuple('SwitchTables', 'groups flows meters',
+                          defaults=((),))
+
+ARP_TO_CONTROLLER = FlowEntry(
+    100, (('eth_type', ether_types.ETH_TYPE_ARP),), (('controller',),))
+# Al table-miss le basta la cabecera: la trama se queda en el buffer del
+# switch y el packet-out o el FlowMod reactivo la liberan por su buffer_id
+PACKET_IN_MAX_LEN = 128         # bytes: Ethernet + VLAN + IPv4 + TCP con opciones
+TABLE_MISS_CONTROLLER = FlowEntry(
+    0, (), (('controller', PACKET_IN_MAX_LEN),), table_id=TABLE_FORWARD)
+TABLE_MISS_DROP = FlowEntry(0, (), (), table_id=TABLE_FORWARD)
+# LLDP del descubrimiento de enlaces, antes de cualquier clasificación
+LLDP_TO_CONTROLLER = FlowEntry(
+    0xffff, (('eth_dst', '01:80:c2:00:00:0e'),
+             ('eth_type', ether_types.ETH_TYPE_LLDP)),
+    (('controller',),))
+# Encadenado del pipeline y desvío de las tramas etiquetadas
+PIPELINE_FLOWS = (
+    FlowEntry(0, (), (('goto', TABLE_SERVICE),), table_id=TABLE_CLASSIFY),
+    FlowEntry(0, (), (('goto', TABLE_FORWARD),), table_id=TABLE_VLAN),
+    FlowEntry(0, (), (('goto', TABLE_FORWARD),), table_id=TABLE_SERVICE),
+    FlowEntry(CLASSIFY_TAGGED_PRIORITY,
+              (('vlan_vid', (ofproto_v1_3.OFPVID_PRESENT,
+                             ofproto_v1_3.OFPVID_PRESENT)),),
+              (('goto', TABLE_VLAN),), table_id=TABLE_CLASSIFY),
+)
+
+# Respuesta ARP en el propio switch para los hosts conocidos: las peticiones
+# por estas IPs se convierten en reply dentro del switch y sólo las IPs
+# desconocidas llegan al controlador. El valor es una MAC fija o None para
+# usar la que aprenda la caché ARP (Mininet asigna MACs aleatorias).
+ARP_RESPONDER_HOSTS = {
+    '192.168.10.3': None,       # h1
+    '192.168.10.4': None,       # h6
+    '192.168.10.5': None,       # h2
+    '192.168.10.6': None,       # h3
+    '192.168.10.7': None,       # h4
+    '192.168.10.169': None,     # h5: Mosquitto
+    '192.168.10.150': None,     # radar
+    '192.168.10.108': None,     # visualizador del radar
+}
+ARP_RESPONDER_PRIORITY = 110    # sobre la captura de ARP (100)
+
+# Los sondeos ARP (origen 0.0.0.0) no deben recibir respuesta del switch: el
+# host interpretaría un conflicto de dirección
+ARP_PROBE_TO_CONTROLLER = FlowEntry(
+    ARP_RESPONDER_PRIORITY + 10,
+    (('arp_op', arp.ARP_REQUEST), ('arp_spa', '0.0.0.0'),
+     ('eth_type', ether_types.ETH_TYPE_ARP)),
+    (('controller',),))
+
+# Switches sin políticas: todo lo desconocido y los ARP van al controlador
+DEFAULT_TABLES = SwitchTables(
+    (), (TABLE_MISS_CONTROLLER, ARP_TO_CONTROLLER, ARP_PROBE_TO_CONTROLLER,
+         LLDP_TO_CONTROLLER) + PIPELINE_FLOWS)
+
+# Reenvío reactivo por switch: al conocer el destino de un packet-in se
+# instala un flujo en vez de sólo hacer packet-out.
+#   'mac':   match (in_port, eth_src, eth_dst)
+#   'exact': match por 5-tupla IP (o por MACs si el paquete no es IPv4)
+#   None:    sólo packet-out
+# En los switches listados con un modo, el table-miss va al controlador en
+# lugar de DROP; los que no aparecen usan REACTIVE_DEFAULT_MODE si no tienen
+# políticas y None si las tienen.
+REACTIVE_MODE = {}
+REACTIVE_DEFAULT_MODE = 'mac'
+REACTIVE_PRIORITY = 2           # sobre el table-miss y el bloqueo de packet-in
+REACTIVE_IDLE_TIMEOUT = 30      # segundos
+REACTIVE_HARD_TIMEOUT = 300     # segundos
+
+# Caché ARP del proxy: cada entrada caduca a los ARP_TTL segundos sin
+# refrescarse y se guardan como máximo ARP_CAPACITY (se expulsa la menos usada)
+ARP_TTL = 300                   # segundos
+ARP_CAPACITY = 1024
+ARP_STATS_INTERVAL = 60         # segundos entre limpieza y log de contadores
+ARP_REPLY_CACHE_SIZE = 256      # plantillas de ARP reply ya serializadas
+
+# Inundación: sólo por los puertos del árbol de expansión de LINKS, y una
+# misma trama no se vuelve a inundar en un switch durante FLOOD_DEDUP_WINDOW
+# (las copias de un bucle vuelven en milisegundos; los reintentos ARP de un
+# host tardan alrededor de un segundo y sí deben pasar)
+FLOOD_DEDUP_WINDOW = 0.5        # segundos
+FLOOD_DEDUP_SIZE = 4096         # tramas recordadas como máximo
+
+# Admisión de packet-in: cubos de fichas por switch y por puerto de entrada.
+# Lo que no cabe en el presupuesto se descarta sin procesarlo. Si el que se
+# pasa es un puerto de acceso, además se instala en el switch durante
+# PACKET_IN_BLOCK_TIME una regla que descarta lo que ese puerto enviaría al
+# controlador (table-miss y captura de ARP); sus flujos ya instalados y el
+# respondedor ARP siguen funcionando. Los puertos entre switches no se
+# bloquean: dejarían sin inundación a toda una rama de la red.
+PACKET_IN_SWITCH_RATE = 200     # packet-in/s por switch
+PACKET_IN_SWITCH_BURST = 400
+PACKET_IN_PORT_RATE = 50        # packet-in/s por puerto
+PACKET_IN_PORT_BURST = 100
+PACKET_IN_BLOCK_TIME = 10       # segundos
+PACKET_IN_BLOCK_PRIORITY = 1    # tabla de reenvío: sobre el table-miss
+PACKET_IN_BLOCK_ARP_PRIORITY = ARP_RESPONDER_PRIORITY - 5   # bajo el respondedor
+
+# Trabajo por switch (respuestas de estadísticas y decisiones de pesos y
+# medidores): colas que unos pocos hilos verdes atienden por turnos, para que
+# una respuesta grande no retrase los packet-in ni a otros switches. Cada
+# cola guarda como mucho una tarea por tipo: una nueva sustituye a la que
+# aún espera
+WORKERS = 2
+
+# Sondeo adaptativo: con tráfico estable y lejos de UMBRAL_BPS el periodo se
+# alarga hasta POLL_MAX_INTERVAL; cerca del umbral o con cambios bruscos
+# vuelve a POLL_MIN_INTERVAL
+POLL_MIN_INTERVAL = 0.5         # segundos
+POLL_MAX_INTERVAL = 5.0         # segundos
+POLL_BACKOFF = 1.5              # factor de alargamiento por ciclo estable
+POLL_NEAR_FRACTION = 0.3        # "cerca" = a menos del 30% de UMBRAL_BPS
+POLL_CHANGE_FRACTION = 0.2      # cambio brusco = 20% de UMBRAL_BPS por muestra
+
+# Utilización de enlaces a partir de OFPPortStats de todos los switches
+LINK_CAPACITY_BPS = 10000000    # capacidad nominal de cada enlace (10 Mbps)
+LINK_EWMA_ALPHA = 0.3           # peso de la última muestra en el suavizado
+LINK_REPORT_INTERVAL = 10       # segundos entre logs de la matriz
+
+# Los enlaces LLDP llegan de uno en uno (cada sentido por separado): se
+# espera a que el grafo se asiente antes de recompilar
+TOPOLOGY_SETTLE = 2.0           # segundos
+
+# Al (re)conectar un switch se leen sus flujos, grupos y medidores y sólo se
+# envía la diferencia con lo que debe tener; si la lectura no termina en
+# este tiempo se reprograma entero
+RECONCILE_TIMEOUT = 5.0         # segundos
+
+# Pesos de los grupos SELECT: cada camino recibe su peso declarado escalado
+# por la fracción libre de su enlace más cargado. Un nuevo reparto sólo se
+# aplica si algún peso se mueve al menos WEIGHT_HYSTERESIS puntos y han pasado
+# WEIGHT_MIN_DWELL segundos desde el anterior; cada GroupMod acerca los pesos
+# al objetivo como mucho WEIGHT_MAX_STEP puntos
+WEIGHT_STEP = 5                 # cuantización de los pesos (sobre 100)
+WEIGHT_MIN = 5                  # ningún camino se queda sin tráfico
+WEIGHT_HYSTERESIS = 10          # puntos
+WEIGHT_MIN_DWELL = 5.0          # segundos
+WEIGHT_MAX_STEP = 20            # puntos por GroupMod
+
+# Desvío de MQTT-Raspberry por S1-S3: se activa por encima de UMBRAL_BPS, se
+# retira por debajo de UMBRAL_BPS * REROUTE_EXIT_FRACTION y entre dos cambios
+# pasan al menos REROUTE_MIN_DWELL segundos
+REROUTE_EXIT_FRACTION = 0.7
+REROUTE_MIN_DWELL = 5.0         # segundos
+
+# Reglas mostradas en el ranking de bitrate por regla
+FLOW_TOP_N = 5
+
+# Flujos elefante: un puerto de acceso que envía más de ELEPHANT_BPS a un
+# servicio con grupo SELECT (medido con la regla de conteo del puerto en la
+# tabla de clasificación) se fija al camino con más capacidad libre con una
+# regla más prioritaria (por debajo de IPTV y MQTT). Con cada muestra se
+# revisa: vuelve al grupo cuando baja de ELEPHANT_EXIT_FRACTION *
+# ELEPHANT_BPS y se mueve de camino si en otro tendría más capacidad libre
+# que en el suyo; el switch también la borra si pasa ELEPHANT_IDLE_TIMEOUT
+# segundos sin tráfico
+ELEPHANT_BPS = 1000000          # 10% de LINK_CAPACITY_BPS
+ELEPHANT_EXIT_FRACTION = 0.5
+ELEPHANT_PRIORITY = 20
+ELEPHANT_IDLE_TIMEOUT = 10      # segundos
+
+# Medidores del tráfico best effort entre VLANs (meter_ids de los servicios):
+# el límite deja METER_RESERVE_BPS libres en cada camino del grupo SELECT para
+# MQTT y radar, y se recalcula con la utilización medida. Sólo se cambia si
+# varía más de METER_HYSTERESIS (fracción) y tras METER_MIN_DWELL segundos
+METER_MAX_BPS = LINK_CAPACITY_BPS
+METER_MIN_BPS = 500000          # nunca se corta del todo el best effort
+METER_RESERVE_BPS = 1000000     # por camino
+METER_BURST_SECONDS = 0.1       # ráfaga tolerada, en segundos al límite
+METER_HYSTERESIS = 0.1
+METER_MIN_DWELL = 5.0           # segundos
+
+# Colas de salida linux-htb en los puertos entre switches. La prioridad de
+# flujo sólo decide qué regla aplica; estas colas deciden qué paquete sale
+# antes de un puerto congestionado. Se crean con ovs-vsctl (el controlador
+# debe correr en la misma máquina que Open vSwitch) al conectarse cada switch.
+#   cola -> (tasa mínima garantizada en bps, prioridad HTB: menor sale antes)
+# Todas pueden usar hasta LINK_CAPACITY_BPS; la 0 es la de por defecto.
+QOS_ENABLED = True
+QOS_QUEUES = {
+    0: (1000000, 3),    # best effort
+    1: (4000000, 2),    # IPTV
+    2: (1000000, 1),    # MQTT
+    3: (2000000, 0),    # radar
+}
+SERVICE_QUEUES = {'iptv': 1, 'mqtt-esp32': 2, 'mqtt-rasp': 2, 'radar': 3}
+OVS_PORT_NAME = 's%d-eth%d'     # nombres de interfaz de Mininet
+
+# ARP reply Ethernet/IPv4 completo (relleno hasta el mínimo de 60 bytes):
+# eth dst, eth src, ethertype, htype, ptype, hlen, plen, op, sha, spa, tha, tpa
+ARP_REPLY = struct.Struct('!6s6sHHHBBH6s4s6s4s18x')
+
+
+def _match(**fields):
+    return tuple(sorted(fields.items()))
+
+
+def arp_responder_entries(ip, mac):
+    """Flujos que responden en el switch las peticiones ARP por ip.
+
+    Los ARP gratuitos de ip (origen == destino) siguen yendo al controlador
+    para que la caché vea los cambios de MAC.
+    """
+    arp_request = dict(eth_type=ether_types.ETH_TYPE_ARP, arp_op=arp.ARP_REQUEST)
+    return (
+        FlowEntry(ARP_RESPONDER_PRIORITY, _match(arp_tpa=ip, **arp_request),
+                  (('arp_reply', ip, mac),), COOKIE_ARP_RESPONDER),
+        FlowEntry(ARP_RESPONDER_PRIORITY + 10,
+                  _match(arp_spa=ip, arp_tpa=ip, **arp_request),
+                  (('controller',),), COOKIE_ARP_RESPONDER),
+    )
+
+
+def packet_in_block_entries(in_port):
+    """Flujos que descartan lo que in_port enviaría al controlador."""
+    return (
+        FlowEntry(PACKET_IN_BLOCK_PRIORITY, _match(in_port=in_port), (),
+                  COOKIE_PACKET_IN_BLOCK, TABLE_FORWARD),
+        FlowEntry(PACKET_IN_BLOCK_ARP_PRIORITY,
+                  _match(in_port=in_port, eth_type=ether_types.ETH_TYPE_ARP),
+                  (), COOKIE_PACKET_IN_BLOCK),
+    )
+
+
+def _l4_fields(proto, l4_port, side):
+    """Campos L4 de un servicio; side es 'dst' en la ida y 'src' en la vuelta."""
+    if proto is None:
+        return {}
+    return {'ip_proto': 6 if proto == 'tcp' else 17,
+            '%s_%s' % (proto, side): l4_port}
+
+
+class PolicyCompiler(object):
+    """Traduce los servicios declarados a tablas de grupos y flujos por DPID."""
+
+    def __init__(self, links, hosts, reactive=None, kind=COOKIE_COMPILED,
+                 queues=None, engine=None):
+        self.hosts = hosts
+        # desvíos de la protección FF de cada salto
+        self.engine = engine or PathEngine(links)
+        self.reactive = reactive or {}
+        self.kind = kind
+        self.queues = queues or {}
+        # (dpid, vecino) -> puerto local del enlace
+        self.ports = {}
+        for a, port_a, b, port_b in links:
+            self.ports[(a, b)] = port_a
+            self.ports[(b, a)] = port_b
+        self.groups = {}
+        self.flows = {}
+        self.meters = {}
+
+    def compile(self, services, base=True):
+        """Tablas por DPID; con base=False sólo las reglas de los servicios.
+
+        Las reglas base van delante en todos los switches con alguna regla
+        de servicio (también los que sólo están en un desvío).
+        """
+        for svc in services:
+            if isinstance(svc, HostService):
+                self._host_service(svc)
+            else:
+                self._vlan_service(svc)
+        for dpid in sorted(self.flows) if base else ():
+            flows = self.flows.pop(dpid)
+            if self.reactive.get(dpid):
+                self._add_flow(dpid, TABLE_MISS_CONTROLLER)
+            else:
+                self._add_flow(dpid, TABLE_MISS_DROP)
+            self._add_flow(dpid, ARP_TO_CONTROLLER)
+            self._add_flow(dpid, ARP_PROBE_TO_CONTROLLER)
+            self._add_flow(dpid, LLDP_TO_CONTROLLER)
+            for entry in PIPELINE_FLOWS:
+                self._add_flow(dpid, entry)
+            for entry in flows.values():
+                self._add_flow(dpid, entry)
+        return dict(
+            (dpid, SwitchTables(tuple(self.groups.get(dpid, {}).values()),
+                                tuple(self.flows[dpid].values()),
+                                tuple(self.meters.get(dpid, {}).values())))
+            for dpid in self.flows)
+
+    def _add_flow(self, dpid, entry):
+        flows = self.flows.setdefault(dpid, {})
+        key = (entry.table_id, entry.priority, entry.match)
+        if flows.get(key, entry) != entry:
+            raise ValueError("Reglas en conflicto en S%d: %s / %s"
+                             % (dpid, flows[key], entry))
+        flows[key] = entry
+
+    def _cookie(self, svc, ingress=False):
+        cookie = self.kind | SERVICE_IDS[svc.name]
+        if isinstance(svc, VlanService):
+            cookie |= COOKIE_VLAN
+        if ingress:
+            cookie |= COOKIE_INGRESS
+        return cookie
+
+    def _qos(self, svc):
+        """SET_QUEUE del servicio, a anteponer a sus acciones de salida."""
+        if svc.name not in self.queues:
+            return ()
+        return (('set_queue', self.queues[svc.name]),)
+
+    def _add_group(self, dpid, entry):
+        groups = self.groups.setdefault(dpid, {})
+        if groups.get(entry.group_id, entry) != entry:
+            raise ValueError("Grupo %d duplicado en S%d"
+                             % (entry.group_id, dpid))
+        groups[entry.group_id] = entry
+
+    def _add_meter(self, dpid, entry):
+        meters = self.meters.setdefault(dpid, {})
+        if meters.get(entry.meter_id, entry) != entry:
+            raise ValueError("Medidor %d duplicado en S%d"
+                             % (entry.meter_id, dpid))
+        meters[entry.meter_id] = entry
+
+    def _detour(self, path, i):
+        """Camino más corto de path[i] al destino sin el tramo path[:i + 2]."""
+        return self.engine.shortest(path[i], path[-1],
+                                    zip(path[:i + 2], path[1:i + 2]))
+
+    def _forward(self, path, backup, group_id, first_in, deliver, rule):
+        """Reglas de un sentido de un servicio a lo largo de path.
+
+        Con group_id, cada switch de path salvo el último elige con ese
+        grupo FF entre el siguiente salto y el primero de un desvío: backup
+        en la entrada (si lo hay) y _detour en el resto.
+          deliver: acciones del último switch
+          rule:    (dpid, in_port, acciones, entrada) -> FlowEntry
+
+        Cada (dpid, in_port) tiene una sola regla, así que un desvío acaba
+        en el primer estado que ya tiene una y sigue su cadena. Para que no
+        haya bucles, se anota a qué índice de path vuelve cada cadena: el
+        desvío del salto i sólo se acepta si vuelve más allá de i + 1 (o
+        entrega sin volver); si no, ese salto queda sin grupo.
+        """
+        hops = []
+        rejoin = {}     # (dpid, in_port) -> índice de path al que vuelve
+        for i, dpid in enumerate(path):
+            in_port = first_in if i == 0 else self.ports[(dpid, path[i - 1])]
+            hops.append((dpid, in_port))
+            rejoin[(dpid, in_port)] = i
+        groups = {}
+        detour_hops = []
+        for i, dpid in enumerate(path[:-1] if group_id is not None else ()):
+            detour = backup if i == 0 and backup else self._detour(path, i)
+            if not detour:
+                continue
+            states = []
+            for j in range(1, len(detour)):
+                state = (detour[j], self.ports[(detour[j], detour[j - 1])])
+                if state in rejoin:
+                    target = rejoin[state]
+                    break
+                states.append((state, detour[j + 1] if j + 1 < len(detour)
+                               else None))
+            else:
+                target = len(path)
+            if target <= i + 1:
+                continue
+            for state, _ in states:
+                rejoin[state] = target
+            groups[i] = self.ports[(dpid, detour[1])]
+            detour_hops += states
+
+        for i, (dpid, in_port) in enumerate(hops):
+            if i == len(path) - 1:
+                actions = deliver
+            else:
+                out_port = self.ports[(dpid, path[i + 1])]
+                actions = (('output', out_port),)
+                if i in groups:
+                    self._add_group(dpid, GroupEntry(group_id, 'ff', (
+                        Bucket(actions, 0, out_port),
+                        Bucket((('output', groups[i]),), 0, groups[i]),
+                    )))
+                    actions = (('group', group_id),)
+            self._add_flow(dpid, rule(dpid, in_port, actions, i == 0))
+        for (dpid, in_port), nxt in detour_hops:
+            if nxt is None:
+                actions = deliver
+            else:
+                actions = (('output', self.ports[(dpid, nxt)]),)
+            self._add_flow(dpid, rule(dpid, in_port, actions, False))
+
+    def _host_service(self, svc):
+        directions = (
+            (svc.src, svc.dst, svc.path, svc.backup, 'dst', 0),
+            (svc.dst, svc.src, svc.path[::-1],
+             svc.backup[::-1] if svc.backup else None, 'src', 1),
+        )
+        for src, dst, path, backup, side, idx in directions:
+            fields = dict(eth_type=ether_types.ETH_TYPE_IP,
+                          ipv4_src=src, ipv4_dst=dst,
+                          **_l4_fields(svc.proto, svc.l4_port, side))
+
+            def rule(dpid, in_port, actions, ingress):
+                return FlowEntry(
+                    svc.priority, _match(in_port=in_port, **fields),
+                    self._qos(svc) + actions, self._cookie(svc, ingress),
+                    TABLE_SERVICE)
+
+            self._forward(path, backup,
+                          svc.group_ids[idx] if svc.group_ids else None,
+                          self.hosts[src][1], (('output', self.hosts[dst][1]),),
+                          rule)
+
+    def _vlan_service(self, svc):
+        directions = (
+            (svc.src, svc.dst, [p for _, p in svc.paths],
+             svc.backup, 'dst', 0),
+            (svc.dst, svc.src, [p[::-1] for _, p in svc.paths],
+             svc.backup[::-1] if svc.backup else None, 'src', 1),
+        )
+        weights = [w for w, _ in svc.paths]
+        for (dpid, in_ports, vlan), (_, out_ports, _), paths, backup, side, \
+                idx in directions:
+            l4 = _l4_fields(svc.proto, svc.l4_port, side)
+
+            # El puerto de acceso sólo se mira al clasificar; el servicio
+            # se aplica una vez por VLAN de origen
+            for in_port in in_ports:
+                self._add_flow(dpid, FlowEntry(
+                    CLASSIFY_PRIORITY, _match(in_port=in_port),
+                    (('write_metadata', vlan, METADATA_VLAN_MASK),
+                     ('goto', TABLE_SERVICE)),
+                    self.kind | COOKIE_VLAN, TABLE_CLASSIFY))
+
+            # Entrada: etiquetar con la VLAN de origen (medidor y cola antes)
+            tag = (('push_vlan', vlan),)
+            prefix = self._qos(svc)
+            if svc.meter_ids:
+                meter_id = svc.meter_ids[idx]
+                self._add_meter(dpid, meter_entry(meter_id, METER_MAX_BPS))
+                prefix = (('meter', meter_id),) + prefix
+            ingress_match = _match(
+                metadata=vlan, eth_type=ether_types.ETH_TYPE_IP, **l4)
+
+            # Entrega: quitar la VLAN y salir por los puertos de acceso
+            egress = paths[0][-1]
+            if svc.flood_groups:
+                group_id = svc.flood_groups[idx]
+                self._add_group(egress, GroupEntry(group_id, 'all', tuple(
+                    Bucket((('pop_vlan',), ('output', port)), 0, None)
+                    for port in out_ports)))
+                deliver = (('group', group_id),)
+            else:
+                deliver = (('pop_vlan',),) + tuple(
+                    ('output', port) for port in out_ports)
+
+            # Tránsito con la VLAN ya puesta
+            def rule(hop, in_port, actions, ingress):
+                if ingress:
+                    return FlowEntry(svc.priority, ingress_match,
+                                     prefix + tag + actions,
+                                     self._cookie(svc, True), TABLE_SERVICE)
+                return FlowEntry(svc.priority, _match(
+                    in_port=in_port, eth_type=ether_types.ETH_TYPE_IP,
+                    vlan_vid=ofproto_v1_3.OFPVID_PRESENT | vlan, **l4),
+                    self._qos(svc) + actions, self._cookie(svc), TABLE_VLAN)
+
+            if len(paths) == 1:
+                self._forward(paths[0], backup,
+                              svc.ff_groups[idx] if svc.ff_groups else None,
+                              None, deliver, rule)
+                continue
+
+            # Varios caminos: un grupo SELECT reparte en la entrada; el
+            # switch deja de elegir un bucket cuyo puerto está caído
+            group_id = svc.select_groups[idx]
+            self._add_group(dpid, GroupEntry(group_id, 'select', tuple(
+                Bucket(tag + (('output', self.ports[(dpid, path[1])]),),
+                       weight, self.ports[(dpid, path[1])])
+                for weight, path in zip(weights, paths))))
+            self._add_flow(dpid, FlowEntry(
+                svc.priority, ingress_match, prefix + (('group', group_id),),
+                self._cookie(svc, True), TABLE_SERVICE))
+            # La regla de servicio es común a la VLAN: para detectar
+            # elefantes se cuenta aparte lo que cada puerto le envía, con la
+            # misma clasificación que la regla del puerto
+            for in_port in in_ports:
+                self._add_flow(dpid, FlowEntry(
+                    CLASSIFY_COUNT_PRIORITY, _match(
+                        in_port=in_port, eth_type=ether_types.ETH_TYPE_IP,
+                        **l4),
+                    (('write_metadata', vlan, METADATA_VLAN_MASK),
+                     ('goto', TABLE_SERVICE)),
+                    self._cookie(svc, True) | COOKIE_ACCESS, TABLE_CLASSIFY))
+            for path in paths:
+                for i in range(1, len(path)):
+                    if i == len(path) - 1:
+                        actions = deliver
+                    else:
+                        actions = (('output', self.ports[(path[i], path[i + 1])]),)
+                    self._add_flow(path[i], rule(
+                        path[i], self.ports[(path[i], path[i - 1])], actions,
+                        False))
+
+
+def meter_entry(meter_id, rate_bps):
+    """MeterEntry con límite rate_bps y ráfaga de METER_BURST_SECONDS."""
+    rate_kbps = int(rate_bps // 1000)
+    return MeterEntry(meter_id, rate_kbps,
+                      max(int(rate_kbps * METER_BURST_SECONDS), 1))
+
+
+def service_paths(services):
+    """Caminos (tuplas de DPIDs) que recorre cada servicio, respaldos incluidos."""
+    for svc in services:
+        if isinstance(svc, HostService):
+            yield svc.path
+            if svc.backup:
+                yield svc.backup
+        else:
+            for _, path in svc.paths:
+                yield path
+            if svc.backup:
+                yield svc.backup
+
+
+class PathEngine(object):
+    """Caminos más cortos (en saltos) entre switches, con caché por par.
+
+    k caminos por el algoritmo de Yen, o caminos disjuntos en enlaces
+    quitando del grafo los ya elegidos. La caché se invalida por enlace: al
+    caer uno sólo se descartan los pares cuyos caminos lo usaban, y al
+    aparecer uno sólo los pares para los que podría dar un camino no más
+    largo que el último guardado.
+    """
+
+    def __init__(self, links=()):
+        self._adj = {}      # dpid -> vecinos ordenados
+        self._cache = {}    # (src, dst, k, disjoint, avoid) -> caminos
+        self.hits = 0
+        self.misses = 0
+        self.set_links(links)
+
+    def set_links(self, links):
+        """Lleva el grafo a links (formato de LINKS) enlace a enlace."""
+        new = set((min(a, b), max(a, b)) for a, _, b, _ in links)
+        old = set((a, b) for a, neighbors in self._adj.items()
+                  for b in neighbors if a < b)
+        for a, b in sorted(old - new):
+            self.remove_link(a, b)
+        for a, b in sorted(new - old):
+            self.add_link(a, b)
+
+    def add_link(self, a, b):
+        for x, y in ((a, b), (b, a)):
+            neighbors = self._adj.setdefault(x, [])
+            if y not in neighbors:
+                bisect.insort(neighbors, y)
+        if not self._cache:
+            return
+        dist_a, dist_b = self._distances(a), self._distances(b)
+        far = len(self._adj)
+        for key, paths in list(self._cache.items()):
+            src, dst, k = key[:3]
+            # cota inferior de un camino que use el enlace nuevo
+            bound = 1 + min(dist_a.get(src, far) + dist_b.get(dst, far),
+                            dist_b.get(src, far) + dist_a.get(dst, far))
+            if len(paths) < k or bound <= len(paths[-1]) - 1:
+                del self._cache[key]
+
+    def remove_link(self, a, b):
+        for x, y in ((a, b), (b, a)):
+            neighbors = self._adj.get(x, [])
+            if y in neighbors:
+                neighbors.remove(y)
+        for key, paths in list(self._cache.items()):
+            if any({a, b} == {u, v} for path in paths
+                   for u, v in zip(path, path[1:])):
+                del self._cache[key]
+
+    def paths(self, src, dst, route):
+        """Hasta route.k caminos de src a dst, del más corto al más largo."""
+        avoid = frozenset((min(a, b), max(a, b)) for a, b in route.avoid)
+        key = (src, dst, route.k, route.disjoint, avoid)
+        paths = self._cache.get(key)
+        if paths is not None:
+            self.hits += 1
+            return paths
+        self.misses += 1
+        banned = set(avoid) | set((b, a) for a, b in avoid)
+        if route.disjoint:
+            paths = self._disjoint(src, dst, route.k, banned)
+        else:
+            paths = self._k_shortest(src, dst, route.k, banned)
+        self._cache[key] = paths
+        return paths
+
+    def valid(self, path):
+        """True si cada par de switches consecutivos de path sigue enlazado."""
+        return all(b in self._adj.get(a, ()) for a, b in zip(path, path[1:]))
+
+    def shortest(self, src, dst, arcs=()):
+        """Camino más corto sin recorrer los arcos (a, b) en ese sentido; sin caché."""
+        return self._bfs(src, dst, (), set(arcs))
+
+    def _disjoint(self, src, dst, k, banned):
+        paths = []
+        while len(paths) < k:
+            path = self._bfs(src, dst, (), banned)
+            if path is None:
+                break
+            paths.append(path)
+            for u, v in zip(path, path[1:]):
+                banned.update(((u, v), (v, u)))
+        return tuple(paths)
+
+    def _k_shortest(self, src, dst, k, banned):
+        first = self._bfs(src, dst, (), banned)
+        if first is None:
+            return ()
+        paths = [first]
+        candidates = []
+        seen = set([first])
+        while len(paths) < k:
+            prev = paths[-1]
+            for i in range(len(prev) - 1):
+                root = prev[:i + 1]
+                # desvío en prev[i] sin repetir las continuaciones ya elegidas
+                spur_banned = set(banned)
+                for path in paths:
+                    if path[:i + 1] == root:
+                        spur_banned.update(((path[i], path[i + 1]),
+                                            (path[i + 1], path[i])))
+                spur = self._bfs(prev[i], dst, root[:-1], spur_banned)
+                if spur is not None:
+                    path = root[:-1] + spur
+                    if path not in seen:
+                        seen.add(path)
+                        heapq.heappush(candidates, (len(path), path))
+            if not candidates:
+                break
+            paths.append(heapq.heappop(candidates)[1])
+        return tuple(paths)
+
+    def _bfs(self, src, dst, banned_nodes, banned_links):
+        """Camino más corto src -> dst sin esos nodos ni enlaces, o None."""
+        if src not in self._adj:
+            return None
+        parents = {src: None}
+        for node in banned_nodes:
+            parents[node] = None
+        queue = deque([src])
+        while queue:
+            node = queue.popleft()
+            if node == dst:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return tuple(reversed(path))
+            for neighbor in self._adj[node]:
+                if neighbor not in parents and \
+                        (node, neighbor) not in banned_links:
+                    parents[neighbor] = node
+                    queue.append(neighbor)
+        return None
+
+    def _distances(self, src):
+        dist = {src: 0}
+        queue = deque([src])
+        while queue:
+            node = queue.popleft()
+            for neighbor in self._adj.get(node, ()):
+                if neighbor not in dist:
+                    dist[neighbor] = dist[node] + 1
+                    queue.append(neighbor)
+        return dist
+
+
+def resolve_routes(services, engine, hosts, repair=False):
+    """Servicios con cada Route sustituida por los caminos de engine.
+
+    ValueError si el grafo no da todos los caminos que pide una Route de
+    path/paths; un respaldo sin camino deja el servicio sin proteger.
+
+    Con repair (funcionamiento degradado tras perder un enlace) una Route
+    se conforma con los caminos que haya, los caminos fijos que pasan por
+    un enlace que ya no existe se cambian por los más cortos, si no queda
+    camino sin los enlaces de avoid se usan también esos, y sólo se omiten
+    los servicios sin ningún camino.
+    """
+    resolved = []
+    for svc in services:
+        try:
+            resolved.append(_resolve_service(svc, engine, hosts, repair))
+        except ValueError:
+            if not repair:
+                raise
+    return tuple(resolved)
+
+
+def _resolve_service(svc, engine, hosts, repair):
+    if isinstance(svc, HostService):
+        route = svc.path
+        if repair and not isinstance(route, Route) and not engine.valid(route):
+            route = Route(1)
+        if isinstance(route, Route):
+            src, dst = hosts[svc.src][0], hosts[svc.dst][0]
+            paths = _route_paths(svc.name, engine, src, dst, route, repair)
+            backup = svc.backup
+            if isinstance(svc.path, Route):
+                backup = paths[1] if svc.group_ids and len(paths) > 1 else None
+            svc = svc._replace(path=paths[0], backup=backup)
+    else:
+        route = svc.paths
+        if repair and not isinstance(route, Route) and not all(
+                engine.valid(path) for _, path in route):
+            route = Route(len(route), weights=tuple(
+                weight for weight, _ in route))
+        if isinstance(route, Route):
+            paths = _route_paths(svc.name, engine, svc.src[0], svc.dst[0],
+                                 route, repair)
+            paths = _compatible_paths(paths)
+            if len(paths) < (1 if repair else route.k):
+                raise ValueError("%s: %d de %d caminos compatibles entre S%d "
+                                 "y S%d" % (svc.name, len(paths), route.k,
+                                            svc.src[0], svc.dst[0]))
+            svc = svc._replace(paths=tuple(zip(
+                route.weights or (0,) * len(paths), paths)))
+    if isinstance(svc.backup, Route):
+        # el respaldo no comparte enlaces con el camino principal
+        primary = svc.path if isinstance(svc, HostService) \
+            else svc.paths[0][1]
+        route = svc.backup._replace(avoid=tuple(svc.backup.avoid) + tuple(
+            zip(primary, primary[1:])))
+        paths = engine.paths(primary[0], primary[-1], route)
+        svc = svc._replace(backup=paths[0] if paths else None)
+    elif repair and svc.backup and not engine.valid(svc.backup):
+        svc = svc._replace(backup=None)
+    return svc
+
+
+def _compatible_paths(paths):
+    """Los caminos de paths que pueden convivir en un mismo servicio VLAN.
+
+    El tránsito se decide por (switch, puerto de entrada): dos caminos que
+    entran igual en un switch, a la ida o a la vuelta, no pueden separarse
+    ahí. Se queda el primero y se descartan los que lo contradicen.
+    """
+    next_hop = {}
+    compatible = []
+    for path in paths:
+        hops = {}
+        for way in (path, path[::-1]):
+            hops.update(((way[i - 1], way[i]), way[i + 1])
+                        for i in range(1, len(way) - 1))
+        if all(next_hop.get(hop, nxt) == nxt for hop, nxt in hops.items()):
+            next_hop.update(hops)
+            compatible.append(path)
+    return tuple(compatible)
+
+
+def _route_paths(name, engine, src, dst, route, repair):
+    paths = engine.paths(src, dst, route)
+    if repair and not paths and route.avoid:
+        # mejor pasar por un enlace evitado que dejar el servicio sin camino
+        paths = engine.paths(src, dst, route._replace(avoid=()))
+    if len(paths) < (1 if repair else route.k):
+        raise ValueError("%s: %d de %d caminos entre S%d y S%d"
+                         % (name, len(paths), route.k, src, dst))
+    return paths
+
+
+class TopologyGraph(object):
+    """Grafo vivo de enlaces entre switches, alimentado por LLDP.
+
+    LLDP informa cada sentido de un enlace por separado; un enlace sólo se
+    da por bueno cuando se han visto los dos sentidos con los mismos
+    puertos. Como en PolicyCompiler, hay un enlace como mucho por par de
+    switches.
+    """
+
+    def __init__(self, links=()):
+        self._ports = {}    # (a, b) -> (puerto de a, puerto de b)
+        for a, port_a, b, port_b in links:
+            self.add(a, port_a, b, port_b)
+            self.add(b, port_b, a, port_a)
+
+    def add(self, src, src_port, dst, dst_port):
+        """Registra el sentido src -> dst; True si cambia el grafo."""
+        if self._ports.get((src, dst)) == (src_port, dst_port):
+            return False
+        self._ports[(src, dst)] = (src_port, dst_port)
+        return True
+
+    def remove(self, src, src_port, dst, dst_port):
+        """Retira el sentido src -> dst; True si cambia el grafo."""
+        if self._ports.get((src, dst)) != (src_port, dst_port):
+            return False
+        del self._ports[(src, dst)]
+        return True
+
+    def forget(self, dpid):
+        """Retira los enlaces de un switch desconectado."""
+        for key in [key for key in self._ports if dpid in key]:
+            del self._ports[key]
+
+    def links(self):
+        """Enlaces bidireccionales en el formato de LINKS, ordenados."""
+        return tuple(sorted(
+            (a, port_a, b, port_b)
+            for (a, b), (port_a, port_b) in self._ports.items()
+            if a < b and self._ports.get((b, a)) == (port_b, port_a)))
+
+    def missing(self, services):
+        """Pares de switches que usan los servicios y aún no tienen enlace."""
+        known = set((a, b) for a, _, b, _ in self.links())
+        return sorted(set(
+            (min(a, b), max(a, b)) for path in service_paths(services)
+            for a, b in zip(path, path[1:])) - known)
+
+
+def spanning_tree(links):
+    """Puertos entre switches bloqueados para inundar, por DPID.
+
+    Se recorre en anchura desde el menor DPID de cada componente; los
+    enlaces que no entran en el árbol quedan bloqueados en ambos extremos.
+    """
+    adjacency = {}
+    for a, port_a, b, port_b in links:
+        adjacency.setdefault(a, []).append((b, port_a, port_b))
+        adjacency.setdefault(b, []).append((a, port_b, port_a))
+    blocked = dict((dpid, set(port for _, port, _ in neighbors))
+                   for dpid, neighbors in adjacency.items())
+    seen = set()
+    for root in sorted(adjacency):
+        if root in seen:
+            continue
+        seen.add(root)
+        queue = deque([root])
+        while queue:
+            dpid = queue.popleft()
+            for neighbor, port, neighbor_port in sorted(adjacency[dpid]):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    blocked[dpid].discard(port)
+                    blocked[neighbor].discard(neighbor_port)
+                    queue.append(neighbor)
+    return blocked
+
+
+#
+#  Traducción de entradas compiladas a mensajes OpenFlow 1.3
+#
+_GROUP_TYPES = {
+    'all': ofproto_v1_3.OFPGT_ALL,
+    'select': ofproto_v1_3.OFPGT_SELECT,
+    'ff': ofproto_v1_3.OFPGT_FF,
+}
+
+
+def build_actions(actions):
+    ofp, parser = ofproto_v1_3, ofproto_v1_3_parser
+    result = []
+    for action in actions:
+        kind = action[0]
+        if kind == 'output':
+            result.append(parser.OFPActionOutput(action[1]))
+        elif kind == 'controller':
+            max_len = action[1] if len(action) > 1 else ofp.OFPCML_NO_BUFFER
+            result.append(parser.OFPActionOutput(ofp.OFPP_CONTROLLER, max_len))
+        elif kind == 'group':
+            result.append(parser.OFPActionGroup(group_id=action[1]))
+        elif kind == 'push_vlan':
+            result.append(parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q))
+            result.append(parser.OFPActionSetField(
+                vlan_vid=(ofp.OFPVID_PRESENT | action[1])))
+        elif kind == 'pop_vlan':
+            result.append(parser.OFPActionPopVlan())
+        elif kind == 'set_queue':
+            result.append(parser.OFPActionSetQueue(action[1]))
+        elif kind == 'arp_reply':
+            # Convierte la petición en respuesta y la devuelve por in_port
+            # (acciones NXM de Open vSwitch para copiar campos)
+            _, ip, mac = action
+            result += [
+                parser.NXActionRegMove(src_field='eth_src', dst_field='eth_dst',
+                                       n_bits=48),
+                parser.OFPActionSetField(eth_src=mac),
+                parser.OFPActionSetField(arp_op=arp.ARP_REPLY),
+                parser.NXActionRegMove(src_field='arp_sha', dst_field='arp_tha',
+                                       n_bits=48),
+                parser.NXActionRegMove(src_field='arp_spa', dst_field='arp_tpa',
+                                       n_bits=32),
+                parser.OFPActionSetField(arp_sha=mac),
+                parser.OFPActionSetField(arp_spa=ip),
+                parser.OFPActionOutput(ofp.OFPP_IN_PORT),
+            ]
+        else:
+            raise ValueError("Acción desconocida: %r" % (action,))
+    return result
+
+
+def build_flow_mod(entry, datapath=None, command=ofproto_v1_3.OFPFC_ADD,
+                   **kwargs):
+    ofp, parser = ofproto_v1_3, ofproto_v1_3_parser
+    # medidor, metadata y goto son instrucciones aparte, en el orden en que
+    # las ejecuta el switch alrededor de las acciones
+    kinds = ('meter', 'write_metadata', 'goto')
+    special = dict((action[0], action) for action in entry.actions
+                   if action[0] in kinds)
+    inst = []
+    if 'meter' in special:
+        inst.append(parser.OFPInstructionMeter(special['meter'][1],
+                                               ofp.OFPIT_METER))
+    actions = build_actions(
+        [action for action in entry.actions if action[0] not in kinds])
+    if actions:
+        inst.append(parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS, actions))
+    if 'write_metadata' in special:
+        inst.append(parser.OFPInstructionWriteMetadata(*special['write_metadata'][1:]))
+    if 'goto' in special:
+        inst.append(parser.OFPInstructionGotoTable(special['goto'][1]))
+    return parser.OFPFlowMod(
+        datapath=datapath, cookie=entry.cookie, table_id=entry.table_id,
+        command=command, priority=entry.priority,
+        match=parser.OFPMatch(**dict(entry.match)), instructions=inst,
+        **kwargs)
+
+
+def build_cookie_delete(cookie, cookie_mask, datapath=None):
+    """Borra de todas las tablas las reglas cuyo cookie coincide bajo la máscara."""
+    ofp, parser = ofproto_v1_3, ofproto_v1_3_parser
+    return parser.OFPFlowMod(
+        datapath=datapath, cookie=cookie, cookie_mask=cookie_mask,
+        command=ofp.OFPFC_DELETE, table_id=ofp.OFPTT_ALL,
+        out_port=ofp.OFPP_ANY, out_group=ofp.OFPG_ANY,
+        match=parser.OFPMatch())
+
+
+def build_group_mod(entry, datapath=None, command=ofproto_v1_3.OFPGC_ADD):
+    parser = ofproto_v1_3_parser
+    buckets = []
+    for bucket in entry.buckets:
+        kwargs = {'weight': bucket.weight}
+        if bucket.watch_port is not None:
+            kwargs['watch_port'] = bucket.watch_port
+        buckets.append(parser.OFPBucket(
+            actions=build_actions(bucket.actions), **kwargs))
+    return parser.OFPGroupMod(
+        datapath=datapath, command=command, type_=_GROUP_TYPES[entry.type_],
+        group_id=entry.group_id, buckets=buckets)
+
+
+def build_meter_mod(entry, datapath=None, command=ofproto_v1_3.OFPMC_ADD):
+    ofp, parser = ofproto_v1_3, ofproto_v1_3_parser
+    return parser.OFPMeterMod(
+        datapath=datapath, command=command,
+        flags=ofp.OFPMF_KBPS | ofp.OFPMF_BURST | ofp.OFPMF_STATS,
+        meter_id=entry.meter_id,
+        bands=[parser.OFPMeterBandDrop(rate=entry.rate_kbps,
+                                       burst_size=entry.burst_kb)])
+
+
+def ovs_qos_command(dpid, ports, stale=(), capacity=LINK_CAPACITY_BPS):
+    """Orden ovs-vsctl que pone una QoS linux-htb con QOS_QUEUES en ports.
+
+    Todo va en una transacción: los puertos pasan a la QoS nueva y se
+    destruyen las filas stale ((tabla, uuid)) de una configuración anterior.
+    Las filas nuevas llevan external-ids:sdn-dpid para poder encontrarlas.
+    """
+    tag = 'external-ids:sdn-dpid=%d' % dpid
+    cmd = ['ovs-vsctl']
+    for port in ports:
+        cmd += ['--', 'set', 'port', OVS_PORT_NAME % (dpid, port), 'qos=@qos']
+    for table, uuid in stale:
+        cmd += ['--', 'destroy', table, uuid]
+    cmd += ['--', '--id=@qos', 'create', 'qos', 'type=linux-htb',
+            'other-config:max-rate=%d' % capacity, tag]
+    cmd += ['queues:%d=@q%d' % (queue, queue) for queue in sorted(QOS_QUEUES)]
+    for queue, (min_rate, priority) in sorted(QOS_QUEUES.items()):
+        cmd += ['--', '--id=@q%d' % queue, 'create', 'queue',
+                'other-config:min-rate=%d' % min_rate,
+                'other-config:max-rate=%d' % capacity,
+                'other-config:priority=%d' % priority, tag]
+    return cmd
+
+
+def without_meters(tables):
+    """tables para un switch sin medidores: las reglas que pasaban por uno
+    van directas (sin límite) y no se crea ninguno."""
+    return tables._replace(meters=(), flows=tuple(
+        flow._replace(actions=tuple(
+            action for action in flow.actions if action[0] != 'meter'))
+        for flow in tables.flows))
+
+
+def build_install_msgs(tables):
+    """Mensajes de instalación de un switch: (grupos y medidores, flujos)."""
+    return ([build_group_mod(group) for group in tables.groups] +
+            [build_meter_mod(meter) for meter in tables.meters],
+            [build_flow_mod(flow) for flow in tables.flows])
+
+
+def build_diff_msgs(old, new):
+    """Mensajes que llevan un switch de las tablas old a new.
+
+    Devuelve (grupos y medidores nuevos o cambiados, flujos, grupos y
+    medidores retirados): entre las tres partes debe ir una barrera, para
+    que los grupos existan antes que los flujos que los usan y no se borren
+    mientras algún flujo los referencie. Un flujo cambiado se reescribe con
+    ADD (misma tabla, prioridad y match) y uno retirado se borra en estricto.
+    """
+    ofp = ofproto_v1_3
+    old_groups = dict((group.group_id, group) for group in old.groups)
+    new_groups = dict((group.group_id, group) for group in new.groups)
+    old_meters = dict((meter.meter_id, meter) for meter in old.meters)
+    new_meters = dict((meter.meter_id, meter) for meter in new.meters)
+    pre = [build_group_mod(group, command=(
+               ofp.OFPGC_MODIFY if group_id in old_groups else ofp.OFPGC_ADD))
+           for group_id, group in sorted(new_groups.items())
+           if old_groups.get(group_id) != group]
+    pre += [build_meter_mod(meter, command=(
+                ofp.OFPMC_MODIFY if meter_id in old_meters else ofp.OFPMC_ADD))
+            for meter_id, meter in sorted(new_meters.items())
+            if old_meters.get(meter_id) != meter]
+
+    def key(flow):
+        return (flow.table_id, flow.priority, flow.match)
+    old_flows = dict((key(flow), flow) for flow in old.flows)
+    new_keys = set(key(flow) for flow in new.flows)
+    flows = [build_flow_mod(flow) for flow in new.flows
+             if old_flows.get(key(flow)) != flow]
+    # al borrar sólo cuentan tabla, prioridad y match (o el id del grupo)
+    flows += [build_flow_mod(flow._replace(actions=()),
+                             command=ofp.OFPFC_DELETE_STRICT,
+                             out_port=ofp.OFPP_ANY, out_group=ofp.OFPG_ANY)
+              for flow in old.flows if key(flow) not in new_keys]
+
+    post = [build_group_mod(GroupEntry(group_id, 'all', ()),
+                            command=ofp.OFPGC_DELETE)
+            for group_id in sorted(old_groups) if group_id not in new_groups]
+    post += [build_meter_mod(meter, command=ofp.OFPMC_DELETE)
+             for meter_id, meter in sorted(old_meters.items())
+             if meter_id not in new_meters]
+    return pre, flows, post
+
+
+#
+#  Traducción inversa: contenido leído del switch a entradas compiladas
+#
+_GROUP_NAMES = dict((value, name) for name, value in _GROUP_TYPES.items())
+
+
+def parse_actions(actions):
+    """Inversa de build_actions; None si hay alguna acción que no genera."""
+    ofp, parser = ofproto_v1_3, ofproto_v1_3_parser
+    result = []
+    actions = iter(actions)
+    for action in actions:
+        if isinstance(action, parser.OFPActionOutput):
+            if action.port != ofp.OFPP_CONTROLLER:
+                result.append(('output', action.port))
+            elif action.max_len == ofp.OFPCML_NO_BUFFER:
+                result.append(('controller',))
+            else:
+                result.append(('controller', action.max_len))
+        elif isinstance(action, parser.OFPActionGroup):
+            result.append(('group', action.group_id))
+        elif isinstance(action, parser.OFPActionPushVlan):
+            # build_actions pone la VLAN justo detrás del PUSH_VLAN
+            tag = next(actions, None)
+            if not isinstance(tag, parser.OFPActionSetField) or \
+                    tag.key != 'vlan_vid':
+                return None
+            result.append(('push_vlan', tag.value & ~ofp.OFPVID_PRESENT))
+        elif isinstance(action, parser.OFPActionPopVlan):
+            result.append(('pop_vlan',))
+        elif isinstance(action, parser.OFPActionSetQueue):
+            result.append(('set_queue', action.queue_id))
+        else:
+            return None
+    return tuple(result)
+
+
+def flow_entry_from_stats(stat):
+    """FlowEntry de una regla leída (OFPFlowStats).
+
+    actions es None si la regla lleva algo que build_flow_mod no genera:
+    no coincide con ninguna entrada compilada.
+    """
+    ofp, parser = ofproto_v1_3, ofproto_v1_3_parser
+    found = {}
+    for inst in stat.instructions:
+        if isinstance(inst, parser.OFPInstructionMeter):
+            found['meter'] = (('meter', inst.meter_id),)
+        elif isinstance(inst, parser.OFPInstructionActions) and \
+                inst.type == ofp.OFPIT_APPLY_ACTIONS:
+            found['apply'] = parse_actions(inst.actions)
+        elif isinstance(inst, parser.OFPInstructionWriteMetadata):
+            found['write_metadata'] = (
+                ('write_metadata', inst.metadata, inst.metadata_mask),)
+        elif isinstance(inst, parser.OFPInstructionGotoTable):
+            found['goto'] = (('goto', inst.table_id),)
+        else:
+            found['apply'] = None
+    actions = None
+    if found.get('apply', ()) is not None:
+        # en el orden en que build_flow_mod coloca las instrucciones
+        actions = sum((found.get(kind, ()) for kind in
+                       ('meter', 'apply', 'write_metadata', 'goto')), ())
+    return FlowEntry(stat.priority, tuple(sorted(stat.match.items())),
+                     actions, stat.cookie, stat.table_id)
+
+
+def group_entry_from_desc(desc):
+    """GroupEntry de un grupo leído (OFPGroupDescStats); type_ None si no se
+    puede representar."""
+    ofp = ofproto_v1_3
+    buckets = []
+    for bucket in desc.buckets:
+        actions = parse_actions(bucket.actions)
+        if actions is None:
+            return GroupEntry(desc.group_id, None, ())
+        watch_port = bucket.watch_port
+        buckets.append(Bucket(actions, bucket.weight,
+                              None if watch_port == ofp.OFPP_ANY else watch_port))
+    return GroupEntry(desc.group_id, _GROUP_NAMES.get(desc.type),
+                      tuple(buckets))
+
+
+def meter_entry_from_config(config):
+    """MeterEntry de un medidor leído (OFPMeterConfigStats)."""
+    band = config.bands[0] if config.bands else None
+    return MeterEntry(config.meter_id, band.rate if band else 0,
+                      band.burst_size if band else 0)
+
+
+class SwitchDump(object):
+    """Contenido de un switch leído por multipart al (re)conectarse.
+
+    Flujos, grupos, medidores y el número de medidores que admite el switch
+    se piden a la vez; la lectura termina cuando han llegado completas (sin
+    OFPMPF_REPLY_MORE) las cuatro respuestas.
+    """
+
+    def __init__(self, xids, clock=time.time):
+        # xid pendiente -> 'flows' | 'groups' | 'meters' | 'meter_features'
+        self.kinds = dict(xids)
+        self.entries = {'flows': [], 'groups': [], 'meters': [],
+                        'meter_features': []}
+        self.start = clock()
+
+    def add(self, xid, entries, more=False):
+        """Añade una respuesta a xid; True si con ella la lectura está completa."""
+        self.entries[self.kinds[xid]] += entries
+        if not more:
+            del self.kinds[xid]
+        return not self.kinds
+
+    @property
+    def meter_support(self):
+        """False si el switch no admite medidores (o rechazó la pregunta)."""
+        return any(self.entries['meter_features'])
+
+    def tables(self, ignore_kinds=()):
+        """Lo leído como SwitchTables, sin los flujos de los orígenes ignore_kinds."""
+        return SwitchTables(
+            tuple(self.entries['groups']),
+            tuple(flow for flow in self.entries['flows']
+                  if flow.cookie & COOKIE_KIND_MASK not in ignore_kinds),
+            tuple(self.entries['meters']))
+
+
+class ArpCache(object):
+    """Tabla IP -> (mac, puerto) con caducidad, límite LRU y contadores."""
+
+    def __init__(self, ttl=ARP_TTL, capacity=ARP_CAPACITY, clock=time.time):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._clock = clock
+        # ip -> (mac, puerto, instante de caducidad); el orden es el de uso
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def learn(self, ip, mac, port, gratuitous=False):
+        """Registra o refresca ip; devuelve True si la MAC o el puerto cambiaron."""
+        old = self._entries.pop(ip, None)
+        if gratuitous and old is not None:
+            self.refreshes += 1
+        self._entries[ip] = (mac, port, self._clock() + self.ttl)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return old is None or old[:2] != (mac, port)
+
+    def lookup(self, ip):
+        """(mac, puerto) de ip, o None si no se conoce o ya caducó."""
+        entry = self._entries.get(ip)
+        if entry is not None and entry[2] <= self._clock():
+            del self._entries[ip]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(ip)
+        self.hits += 1
+        return entry[:2]
+
+    def expire(self):
+        """Elimina las entradas caducadas y devuelve sus IPs."""
+        now = self._clock()
+        expired = [ip for ip, entry in self._entries.items() if entry[2] <= now]
+        for ip in expired:
+            del self._entries[ip]
+        self.expirations += len(expired)
+        return expired
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'refreshes': self.refreshes}
+
+
+class LinkUtilization(object):
+    """Tasa tx/rx suavizada de cada puerto y utilización de los enlaces.
+
+    Los intervalos se miden con duration_sec/duration_nsec de cada puerto,
+    no con el periodo de sondeo, y un contador que retrocede (puerto
+    reiniciado) sólo reinicia la referencia.
+    """
+
+    def __init__(self, links, alpha=LINK_EWMA_ALPHA):
+        self.alpha = alpha
+        self._prev = {}     # (dpid, puerto) -> (tx_bytes, rx_bytes, instante)
+        self.rates = {}     # (dpid, puerto) -> (tx_bps, rx_bps) suavizadas
+        self.set_links(links)
+
+    def set_links(self, links):
+        # (a, b) -> puerto de a hacia b
+        self.link_ports = {}
+        for a, port_a, b, port_b in links:
+            self.link_ports[(a, b)] = port_a
+            self.link_ports[(b, a)] = port_b
+
+    def update(self, dpid, port, tx_bytes, rx_bytes, when):
+        key = (dpid, port)
+        prev = self._prev.get(key)
+        self._prev[key] = (tx_bytes, rx_bytes, when)
+        if prev is None or when <= prev[2]:
+            return
+        if tx_bytes < prev[0] or rx_bytes < prev[1]:
+            return
+        interval = when - prev[2]
+        tx_bps = (tx_bytes - prev[0]) * 8 / interval
+        rx_bps = (rx_bytes - prev[1]) * 8 / interval
+        old = self.rates.get(key)
+        if old is not None:
+            tx_bps = self.alpha * tx_bps + (1 - self.alpha) * old[0]
+            rx_bps = self.alpha * rx_bps + (1 - self.alpha) * old[1]
+        self.rates[key] = (tx_bps, rx_bps)
+
+    def forget(self, dpid):
+        for key in [key for key in self._prev if key[0] == dpid]:
+            del self._prev[key]
+            self.rates.pop(key, None)
+
+    def link_bps(self, a, b):
+        """bps en el sentido a -> b (tx del puerto de a hacia b)."""
+        port = self.link_ports[(a, b)]
+        return self.rates.get((a, port), (0.0, 0.0))[0]
+
+    def spare_bps(self, a, b, capacity=LINK_CAPACITY_BPS):
+        return max(capacity - self.link_bps(a, b), 0.0)
+
+    def path_spare_bps(self, path, capacity=LINK_CAPACITY_BPS):
+        """Capacidad libre del enlace más cargado de path (lista de DPIDs)."""
+        return min(self.spare_bps(a, b, capacity)
+                   for a, b in zip(path, path[1:]))
+
+    def matrix(self):
+        """{(a, b): bps} para cada sentido de cada enlace entre switches."""
+        return dict((link, self.link_bps(*link)) for link in self.link_ports)
+
+    def format_matrix(self):
+        """Matriz origen x destino en kbps ('-' si no hay enlace)."""
+        util = self.matrix()
+        dpids = sorted(set(a for a, _ in util))
+        lines = ['      ' + ''.join('%9s' % ('S%d' % b) for b in dpids)]
+        for a in dpids:
+            lines.append('%-6s' % ('S%d' % a) + ''.join(
+                '%9.1f' % (util[(a, b)] / 1000.0) if (a, b) in util else '%9s' % '-'
+                for b in dpids))
+        return '\n'.join(lines)
+
+
+class FlowRateTracker(object):
+    """Bitrate de cada regla a partir de sus OFPFlowStats.
+
+    Las reglas se identifican por (dpid, prioridad, match, cookie) y el
+    intervalo entre muestras sale de duration_sec/duration_nsec de la propia
+    regla. Si la duración o el contador retroceden, la regla se reinstaló y
+    sólo se reinicia la referencia.
+    """
+
+    def __init__(self):
+        self._prev = {}     # clave -> (byte_count, duración)
+        self.rates = {}     # clave -> bps del último intervalo
+
+    @staticmethod
+    def key(dpid, stat):
+        return (dpid, stat.priority, tuple(sorted(stat.match.items())),
+                stat.cookie)
+
+    def update(self, dpid, stats):
+        """Procesa una respuesta completa de dpid; devuelve [(stat, bps)].
+
+        stats son todas las partes de una respuesta multiparte juntas. bps
+        es 0 en la primera muestra de una regla. Las reglas de dpid que ya
+        no aparecen en la respuesta se olvidan.
+        """
+        result = []
+        seen = set()
+        for stat in stats:
+            key = self.key(dpid, stat)
+            seen.add(key)
+            duration = stat.duration_sec + stat.duration_nsec * 1e-9
+            prev = self._prev.get(key)
+            self._prev[key] = (stat.byte_count, duration)
+            if prev is None or duration < prev[1] or stat.byte_count < prev[0]:
+                self.rates[key] = 0.0
+            elif duration > prev[1]:
+                self.rates[key] = (stat.byte_count - prev[0]) * 8 / (duration - prev[1])
+            result.append((stat, self.rates[key]))
+        for key in [key for key in self._prev if key[0] == dpid and key not in seen]:
+            del self._prev[key]
+            del self.rates[key]
+        return result
+
+    def forget(self, dpid):
+        """Olvida las reglas de un switch desconectado."""
+        for key in [key for key in self._prev if key[0] == dpid]:
+            del self._prev[key]
+            del self.rates[key]
+
+    def top(self, n):
+        """Las n reglas con mayor bitrate: [(bps, clave)]."""
+        return sorted(((bps, key) for key, bps in self.rates.items()),
+                      reverse=True)[:n]
+
+    @staticmethod
+    def format_key(key):
+        dpid, priority, match, cookie = key
+        return 'S%d prio=%d cookie=%#x %s' % (
+            dpid, priority, cookie,
+            ','.join('%s=%s' % field for field in match))
+
+
+class AdaptivePoll(object):
+    """Periodo de sondeo de estadísticas según la cercanía al umbral.
+
+    Lleva además la cuenta de peticiones enviadas frente a las que habría
+    enviado un sondeo fijo cada base_interval.
+    """
+
+    def __init__(self, threshold, base_interval, min_interval=POLL_MIN_INTERVAL,
+                 max_interval=POLL_MAX_INTERVAL):
+        self.threshold = threshold
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = base_interval
+        self.sent = 0
+        self.fixed = 0.0
+
+    def _urgent(self, prev_bps, bps):
+        near = abs(bps - self.threshold) <= POLL_NEAR_FRACTION * self.threshold
+        jump = (prev_bps is not None and
+                abs(bps - prev_bps) >= POLL_CHANGE_FRACTION * self.threshold)
+        return near or jump
+
+    def update(self, samples):
+        """samples: pares (bps anterior o None, bps actual) de cada medida."""
+        if any(self._urgent(prev_bps, bps) for prev_bps, bps in samples):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * POLL_BACKOFF, self.max_interval)
+        return self.interval
+
+    def record(self, requests):
+        """Anota las peticiones de un ciclo que dura el intervalo actual."""
+        self.sent += requests
+        self.fixed += requests * self.interval / self.base_interval
+
+    @property
+    def saved(self):
+        return int(self.fixed - self.sent)
+
+
+def weighted_groups(services):
+    """(dpid, group_id, caminos, pesos) de cada grupo SELECT de los servicios.
+
+    Los caminos empiezan en el switch del grupo y van en el orden de sus
+    buckets. Un servicio que se ha quedado con un solo camino no tiene grupo.
+    """
+    groups = []
+    for svc in services:
+        if not isinstance(svc, VlanService) or not svc.select_groups \
+                or len(svc.paths) < 2:
+            continue
+        weights = tuple(weight for weight, _ in svc.paths)
+        paths = tuple(path for _, path in svc.paths)
+        groups.append((svc.src[0], svc.select_groups[0], paths, weights))
+        groups.append((svc.dst[0], svc.select_groups[1],
+                       tuple(path[::-1] for path in paths), weights))
+    return groups
+
+
+def metered_ingresses(services):
+    """(dpid, meter_id, caminos, id de servicio) de cada medidor de los servicios."""
+    meters = []
+    for svc in services:
+        if not isinstance(svc, VlanService) or not svc.meter_ids:
+            continue
+        paths = tuple(path for _, path in svc.paths)
+        meters.append((svc.src[0], svc.meter_ids[0], paths,
+                       SERVICE_IDS[svc.name]))
+        meters.append((svc.dst[0], svc.meter_ids[1],
+                       tuple(path[::-1] for path in paths),
+                       SERVICE_IDS[svc.name]))
+    return meters
+
+
+class GroupWeights(object):
+    """Pesos de un grupo SELECT proporcionales a la capacidad libre.
+
+    El peso de cada bucket es su peso declarado por la fracción libre de su
+    camino, normalizado a 100; la histéresis, el tiempo mínimo entre cambios
+    y el paso máximo evitan que el grupo oscile con tráfico cerca del límite.
+    """
+
+    def __init__(self, dpid, group_id, paths, base_weights, clock=time.time):
+        self.dpid = dpid
+        self.group_id = group_id
+        self.paths = paths
+        self.base = tuple(base_weights)
+        self._clock = clock
+        self.reset()
+
+    def reset(self):
+        """El switch vuelve a tener los pesos declarados (p.ej. al reconectar)."""
+        self.weights = self.base
+        self.changed_at = self._clock()
+
+    def target(self, free):
+        """Pesos objetivo dada la fracción libre (0..1) de cada camino."""
+        raw = [base * max(fraction, 0.0)
+               for base, fraction in zip(self.base, free)]
+        total = sum(raw)
+        if total <= 0:
+            return self.base
+        return tuple(
+            max(WEIGHT_MIN,
+                int(round(100.0 * value / total / WEIGHT_STEP)) * WEIGHT_STEP)
+            for value in raw)
+
+    def update(self, free):
+        """Pesos que hay que enviar al switch, o None si no toca cambiarlos."""
+        now = self._clock()
+        if now - self.changed_at < WEIGHT_MIN_DWELL:
+            return None
+        target = self.target(free)
+        if max(abs(new - cur) for new, cur
+               in zip(target, self.weights)) < WEIGHT_HYSTERESIS:
+            return None
+        self.weights = tuple(
+            cur + max(-WEIGHT_MAX_STEP, min(WEIGHT_MAX_STEP, new - cur))
+            for new, cur in zip(target, self.weights))
+        self.changed_at = now
+        return self.weights
+
+
+class FloodDedup(object):
+    """Recuerda las tramas inundadas recientemente para cortar bucles."""
+
+    def __init__(self, window=FLOOD_DEDUP_WINDOW, capacity=FLOOD_DEDUP_SIZE,
+                 clock=time.time):
+        self.window = window
+        self.capacity = capacity
+        self._clock = clock
+        self._seen = OrderedDict()      # clave -> instante en que se vio
+        self.duplicates = 0
+
+    def seen(self, key):
+        """True si key ya se vio dentro de la ventana; si no, la registra."""
+        now = self._clock()
+        while self._seen:
+            oldest, when = next(iter(self._seen.items()))
+            if now - when < self.window and len(self._seen) < self.capacity:
+                break
+            del self._seen[oldest]
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[key] = now
+        return False
+
+
+class PacketInBudget(object):
+    """Cubos de fichas de packet-in por switch y por (switch, puerto)."""
+
+    def __init__(self, switch_rate=PACKET_IN_SWITCH_RATE,
+                 switch_burst=PACKET_IN_SWITCH_BURST,
+                 port_rate=PACKET_IN_PORT_RATE, port_burst=PACKET_IN_PORT_BURST,
+                 clock=time.time):
+        self.switch_rate = switch_rate
+        self.switch_burst = switch_burst
+        self.port_rate = port_rate
+        self.port_burst = port_burst
+        self._clock = clock
+        self._buckets = {}      # dpid o (dpid, puerto) -> (fichas, instante)
+        # métricas desde el último informe
+        self.admitted = {}      # dpid -> packet-in procesados
+        self.dropped = {}       # dpid o (dpid, puerto) -> descartados
+
+    def _take(self, key, rate, burst, now):
+        tokens, last = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            self.dropped[key] = self.dropped.get(key, 0) + 1
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def admit(self, dpid, in_port):
+        """None si el packet-in entra en el presupuesto; si no, 'port' o
+        'switch' según el cubo que se agotó.
+
+        Un puerto sin fichas no gasta las del switch, para no dejar sin
+        presupuesto a los demás puertos.
+        """
+        now = self._clock()
+        if not self._take((dpid, in_port), self.port_rate, self.port_burst, now):
+            return 'port'
+        if not self._take(dpid, self.switch_rate, self.switch_burst, now):
+            return 'switch'
+        self.admitted[dpid] = self.admitted.get(dpid, 0) + 1
+        return None
+
+    def forget(self, dpid):
+        for key in [key for key in self._buckets
+                    if key == dpid or isinstance(key, tuple) and key[0] == dpid]:
+            del self._buckets[key]
+
+    def report(self):
+        """Líneas con los packet-in admitidos y descartados desde el último
+        informe, que se reinician."""
+        lines = []
+        for dpid in sorted(set(self.admitted) | set(
+                key[0] if isinstance(key, tuple) else key
+                for key in self.dropped)):
+            ports = sorted((key[1], n) for key, n in self.dropped.items()
+                           if isinstance(key, tuple) and key[0] == dpid)
+            lines.append('  S%d: %d procesados, %d descartados por el switch%s' % (
+                dpid, self.admitted.get(dpid, 0), self.dropped.get(dpid, 0),
+                ''.join(', %d por el puerto %d' % (n, port)
+                        for port, n in ports)))
+        self.admitted, self.dropped = {}, {}
+        return lines
+
+
+class DatapathWork(object):
+    """Colas de trabajo por switch atendidas por turnos.
+
+    Los hilos toman una tarea de cada switch por turno, así que uno con
+    mucho trabajo no deja sin atender al resto, y las tareas de un mismo
+    switch nunca se solapan. Una tarea con la misma clave que otra aún en
+    cola la sustituye y conserva su turno (una respuesta de estadísticas
+    nueva deja obsoleta la anterior), así que cada cola tiene como mucho
+    una tarea por clave.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        # dpid -> OrderedDict clave -> (función, argumentos, instante)
+        self._queues = {}
+        self._ready = deque()   # switches con trabajo y sin hilo atendiéndolos
+        self._busy = set()
+        self._wake = hub.Event()
+        # métricas desde el último informe
+        self.max_depth = {}
+        self.max_wait = {}
+        self.busy_time = {}
+        self.merged = 0
+
+    def submit(self, dpid, key, func, *args):
+        queue = self._queues.setdefault(dpid, OrderedDict())
+        if key in queue:
+            queue[key] = (func, args, queue[key][2])
+            self.merged += 1
+            return
+        queue[key] = (func, args, self._clock())
+        self.max_depth[dpid] = max(self.max_depth.get(dpid, 0), len(queue))
+        if dpid not in self._busy and dpid not in self._ready:
+            self._ready.append(dpid)
+            self._wake.set()
+
+    def run_once(self):
+        """Ejecuta una tarea del siguiente switch en turno; False si no hay."""
+        if not self._ready:
+            return False
+        dpid = self._ready.popleft()
+        queue = self._queues[dpid]
+        _, (func, args, queued_at) = queue.popitem(last=False)
+        self._busy.add(dpid)
+        start = self._clock()
+        self.max_wait[dpid] = max(self.max_wait.get(dpid, 0.0),
+                                  start - queued_at)
+        try:
+            func(*args)
+        finally:
+            self._busy.discard(dpid)
+            self.busy_time[dpid] = (self.busy_time.get(dpid, 0.0) +
+                                    self._clock() - start)
+            # forget() pudo descartar la cola mientras corría la tarea
+            if self._queues.get(dpid):
+                self._ready.append(dpid)
+        return True
+
+    def wait(self):
+        """Bloquea el hilo hasta que llegue trabajo nuevo."""
+        self._wake.clear()
+        self._wake.wait()
+
+    def forget(self, dpid):
+        """Descarta el trabajo pendiente de un switch desconectado."""
+        self._queues.pop(dpid, None)
+        if dpid in self._ready:
+            self._ready.remove(dpid)
+
+    def depths(self):
+        return dict((dpid, len(queue)) for dpid, queue in self._queues.items())
+
+    def report(self):
+        """Líneas con las métricas por switch desde el último informe, que
+        se reinician."""
+        total = sum(self.busy_time.values()) or 1.0
+        depths = self.depths()
+        lines = ['  S%d: %d en cola (máx %d), espera máx %.1f ms, '
+                 '%.1f ms ocupado (%.0f%%)' % (
+                     dpid, depths.get(dpid, 0), self.max_depth.get(dpid, 0),
+                     self.max_wait.get(dpid, 0.0) * 1000.0,
+                     self.busy_time.get(dpid, 0.0) * 1000.0,
+                     100.0 * self.busy_time.get(dpid, 0.0) / total)
+                 for dpid in sorted(set(depths) | set(self.busy_time))]
+        lines.append('  %d tareas sustituidas por otra más nueva'
+                     % self.merged)
+        self.max_depth, self.max_wait, self.busy_time = {}, {}, {}
+        self.merged = 0
+        return lines
+
+
+class ArpReplyCache(object):
+    """Plantillas de ARP reply serializadas por (IP, MAC) anunciada.
+
+    Cada plantilla ya lleva el origen y el opcode; al responder sólo se
+    escriben la MAC/IP del solicitante sobre el mismo bytearray.
+    """
+
+    def __init__(self, capacity=ARP_REPLY_CACHE_SIZE):
+        self.capacity = capacity
+        self._templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def reply(self, ip, mac, eth_dst, requester_mac, requester_ip):
+        """ARP reply de ip/mac hacia el solicitante (campos en binario).
+
+        Devuelve el bytearray de la plantilla: debe enviarse (send_msg lo
+        copia al serializar) antes de pedir otra respuesta para la misma IP.
+        """
+        key = (ip, mac)
+        template = self._templates.get(key)
+        if template is None:
+            self.misses += 1
+            mac_bin = addrconv.mac.text_to_bin(mac)
+            template = bytearray(ARP_REPLY.size)
+            ARP_REPLY.pack_into(
+                template, 0, b'', mac_bin, ether_types.ETH_TYPE_ARP,
+                1, ether_types.ETH_TYPE_IP, 6, 4, arp.ARP_REPLY,
+                mac_bin, addrconv.ipv4.text_to_bin(ip), b'', b'')
+            self._templates[key] = template
+            if len(self._templates) > self.capacity:
+                self._templates.popitem(last=False)
+        else:
+            self.hits += 1
+            self._templates.move_to_end(key)
+        template[0:6] = eth_dst
+        template[32:38] = requester_mac
+        template[38:42] = requester_ip
+        return template
+
+    def invalidate(self, ip):
+        for key in [key for key in self._templates if key[0] == ip]:
+            del self._templates[key]
+
 
 class Iperf5004WithARP(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
@@ -26,14 +1911,108 @@ class Iperf5004WithARP(app_manager.RyuApp):
         super(Iperf5004WithARP, self).__init__(*args, **kwargs)
         # tablas de aprendizaje y ARP
         self.mac_to_port = {}
-        self.arp_table = {}
+        self.arp_table = ArpCache()
+        self.arp_replies = ArpReplyCache()
+        # enlaces descubiertos por LLDP y enlaces con los que se compiló;
+        # hasta completar el descubrimiento se usa LINKS
+        self.topology = TopologyGraph()
+        self.topology_thread = None
+        self.bootstrap_links = TopologyGraph(LINKS).links()
+        self.discovered = False
+        self.links = self.bootstrap_links
+        # enlaces con un puerto caído: (a, b) -> ((a, puerto), (b, puerto))
+        self.down_links = {}
+        # barreras finales de los reencaminamientos: (dpid, xid) -> registro
+        self.reroute_barriers = {}
+        # inundación por el árbol de expansión con supresión de duplicados
+        self.blocked_ports = spanning_tree(self.links)
+        self.flood_dedup = FloodDedup()
+        # presupuesto de packet-in y puertos bloqueados: (dpid, puerto) -> fin
+        self.packet_in_budget = PacketInBudget()
+        self.packet_in_blocks = {}
+        # utilización de enlaces a partir de las estadísticas de puerto
+        self.link_util = LinkUtilization(self.links)
+        # servicios con sus Route ya convertidas en caminos del grafo
+        self.paths = PathEngine(self.links)
+        self.services = resolve_routes(SERVICES, self.paths, HOSTS)
+        self.detour = MQTT_RASP_DETOUR
         # registro de datapaths vivos
         self.datapaths = {}
-        # guardamos los byte_count anteriores por flujo (dpid, in_port)
-        self.prev_flow_bytes = {}
+        # bitrate por regla de S1 y S3
+        self.flow_rates = FlowRateTracker()
+        # bitrate agregado de las dos últimas respuestas de cada switch
+        self.flow_bps = {}
+        self.poll = AdaptivePoll(UMBRAL_BPS, self.POLL_INTERVAL)
+        # desvío de MQTT-Raspberry activo y cuándo cambió por última vez
         self.high_congestion = False
+        self.reroute_changed = 0.0
+        # políticas compiladas (al arrancar y con cada cambio de topología):
+        # dpid -> SwitchTables y sus mensajes
+        self.queues = SERVICE_QUEUES if QOS_ENABLED else None
+        self._compile(self.links)
+        self.default_msgs = build_install_msgs(DEFAULT_TABLES)
+        # instalación serializada por dpid y barrera final pendiente
+        self.install_bufs = {}
+        self.pending_barriers = {}
+        # copia de las tablas enviadas a cada switch (dpid -> SwitchTables):
+        # los cambios de política se envían como diferencia contra ella
+        self.shadow = {}
+        self.sync_sent = 0
+        self.sync_avoided = 0
+        # lecturas en curso del contenido de los switches que se conectan
+        self.dumps = {}
+        # partes ya recibidas de las respuestas de estadísticas multiparte:
+        # (dpid, xid) -> lista de stats
+        self.stats_parts = {}
+        # pesos de los grupos SELECT según la capacidad libre de cada camino
+        self.group_weights = [GroupWeights(*group)
+                              for group in weighted_groups(self.services)]
+        # puertos de acceso que entran a un grupo SELECT, candidatos a
+        # elefante: (dpid, in_port) -> (GroupWeights, regla de servicio)
+        self._index_elephants()
+        # elefantes fijados: (dpid, in_port) -> índice del camino
+        self.elephants = {}
+        # medidores del best effort, su límite actual (bps, instante del
+        # cambio) y el último contador de descartes (bytes, duración)
+        self.metered = metered_ingresses(self.services)
+        self.meter_limits = {}
+        self.meter_drops = {}
+        # switches que no admiten medidores: sus reglas se instalan sin ellos
+        self.meterless = set()
+        # respondedores ARP activos: ip -> (mac, caducidad o None si es fija)
+        self.arp_responders = dict(
+            (ip, (mac, None)) for ip, mac in ARP_RESPONDER_HOSTS.items() if mac)
+        # trabajo por switch fuera del bucle de eventos
+        self.work = DatapathWork()
+        self.workers = [hub.spawn(self._worker) for _ in range(WORKERS)]
         # lanzar hilo de monitoreo de estadísticas
         self.monitor_thread = hub.spawn(self._monitor)
+        self.arp_thread = hub.spawn(self._arp_maintenance)
+
+    def _compile(self, links):
+        """Compila los servicios y el desvío sobre links."""
+        self.tables = PolicyCompiler(
+            links, HOSTS, REACTIVE_MODE, queues=self.queues,
+            engine=self.paths).compile(self.services)
+        self.detour_tables = PolicyCompiler(
+            links, HOSTS, kind=COOKIE_DETOUR, queues=self.queues,
+            engine=self.paths).compile(
+                (self.detour,) if self.detour else (), base=False)
+        self.install_msgs = dict(
+            (dpid, build_install_msgs(tables))
+            for dpid, tables in self.tables.items())
+
+    def _index_elephants(self):
+        self.elephant_rules = {}
+        for group in self.group_weights:
+            flows = self.tables[group.dpid].flows
+            for flow in flows:
+                if ('group', group.group_id) not in flow.actions:
+                    continue
+                for entry in flows:
+                    if entry.cookie == flow.cookie | COOKIE_ACCESS:
+                        key = (group.dpid, dict(entry.match)['in_port'])
+                        self.elephant_rules[key] = (group, flow)
 
     #
     #  Registro y desregistro de switches al conectarse y desconectarse
@@ -49,1125 +2028,555 @@ class Iperf5004WithARP(app_manager.RyuApp):
             if dp.id in self.datapaths:
                 self.logger.info("Eliminando datapath %s", dp.id)
                 del self.datapaths[dp.id]
+                self.link_util.forget(dp.id)
+                self.topology.forget(dp.id)
+                # su último bitrate no debe seguir decidiendo el desvío ni
+                # el periodo de sondeo
+                self.flow_bps.pop(dp.id, None)
+                self.flow_rates.forget(dp.id)
+                self.shadow.pop(dp.id, None)
+                self.dumps.pop(dp.id, None)
+                for key in [key for key in self.stats_parts
+                            if key[0] == dp.id]:
+                    del self.stats_parts[key]
+                self.work.forget(dp.id)
+                # un switch caído no confirmará sus barreras pendientes
+                for key in [key for key in self.reroute_barriers
+                            if key[0] == dp.id]:
+                    self._reroute_confirmed(
+                        dp.id, self.reroute_barriers.pop(key))
+                self.packet_in_budget.forget(dp.id)
+                for key in [key for key in self.packet_in_blocks
+                            if key[0] == dp.id]:
+                    del self.packet_in_blocks[key]
     
     #
-    #  Configuración inicial de flujos (incluye ARP, IPTV, MQTT, etc.)
+    #  Configuración inicial de flujos: se lee lo que ya tiene el switch que
+    #  se conecta y se le envía sólo la diferencia con sus tablas compiladas
+    #  (ARP, IPTV, MQTT, radar, VLAN 10↔30); si no responde a tiempo se le
+    #  envían enteras
     #
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
-        dp     = ev.msg.datapath
-        dpid   = dp.id
-        ofp    = dp.ofproto
-        parser = dp.ofproto_parser
-
-        # Table-miss: enviar todo lo desconocido al controlador
-        match = parser.OFPMatch()
-        actions = [parser.OFPActionOutput(ofp.OFPP_CONTROLLER, ofp.OFPCML_NO_BUFFER)]
-        inst = [parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS, actions)]
-        dp.send_msg(parser.OFPFlowMod(datapath=dp, priority=0, match=match, instructions=inst))
-
-        # ARP: capturar todos los ARP
-        match = parser.OFPMatch(eth_type=0x0806)
-        dp.send_msg(parser.OFPFlowMod(datapath=dp, priority=100, match=match, instructions=inst))
-
-
-        # ----------------------------
-        #   SWITCH S1  (DPID == 1)
-        # ----------------------------
-        if dpid == 1:
-            
-            # ------------------ IPTV entre VLAN 10 y VLAN 30 ------------------ #
-
-            # --- IPTV saliente (hosts h1,h6,h5) → tag VLAN 10 y salida por puerto 4 → s2 ---
-            for in_p in [1, 2, 3]:  # h1=s1-eth1, h6=s1-eth2, h5=s1-eth3
-                match_iptv_out = parser.OFPMatch(
-                    in_port=in_p,
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ip_proto=17,               # UDP
-                    udp_dst=5004               # puerto IPTV
-                )
-                actions_iptv_out = [
-                    parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                    parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                    parser.OFPActionOutput(4)  # hacia s1-eth4 → enlace a s2
-                ]
-
-                dp.send_msg(parser.OFPFlowMod(
-                    datapath=dp,
-                    priority=30,               # más alta que otros flujos “normales”
-                    match=match_iptv_out,
-                    instructions=[parser.OFPInstructionActions(
-                        ofp.OFPIT_APPLY_ACTIONS, actions_iptv_out
-                    )]
-                ))
-
-
-            # --- IPTV retorno: pop VLAN 30, ingress por s1-eth4, salida por s1-eth1,2,3 ---
-            # 1) Crea un grupo ALL para el retorno IPTV (group_id = 20)
-            buckets_iptv_ret_all = [
-                parser.OFPBucket(
-                    actions=[
-                        parser.OFPActionPopVlan(),
-                        parser.OFPActionOutput(1)   # h1
-                    ]
-                ),
-                parser.OFPBucket(
-                    actions=[
-                        parser.OFPActionPopVlan(),
-                        parser.OFPActionOutput(2)   # h6
-                    ]
-                ),
-                parser.OFPBucket(
-                    actions=[
-                        parser.OFPActionPopVlan(),
-                        parser.OFPActionOutput(3)   # h5
-                    ]
-                )
-            ]
-            dp.send_msg(parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_ALL,
-                group_id=20,
-                buckets=buckets_iptv_ret_all
-            ))
-
-
-            # 2) FlowMod que usa el grupo ALL en lugar de una lista de OUTPUTs
-            match_iptv_ret = parser.OFPMatch(
-                in_port=4,
-                eth_type=ether_types.ETH_TYPE_IP,
-                vlan_vid=(0x1000 | 30),
-                ip_proto=17,
-                udp_src=5004
-            )
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=30,
-                match=match_iptv_ret,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS,
-                    [parser.OFPActionGroup(group_id=20)]
-                )]
-            ))
-
-            # ----------- MQTT entre Mosquitto H5 y ESP32 ------------ #
-
-
-            # 1) Crear grupo FF para el sentido ESP32→Mosquitto
-            #    bucket1: si el enlace s1-eth6 (watch_port=6) está UP → salir por 3
-            #    bucket2: si falla el anterior → salir por 3 vía enlace s1-eth7 (watch_port=7)
-            buckets_fwd = [
-                parser.OFPBucket(
-                    watch_port=6,
-                    actions=[parser.OFPActionOutput(3)]
-                ),
-                parser.OFPBucket(
-                    watch_port=7,
-                    actions=[parser.OFPActionOutput(3)]
-                )
-            ]
-            req_fwd = parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_FF,
-                group_id=1,
-                buckets=buckets_fwd
-            )
-            dp.send_msg(req_fwd)
-
-            # 2) Crear grupo FF para el sentido Mosquitto→ESP32
-            #    bucket1: monitor s1-eth6 → mirar puerto 6 y, si está UP, salida por 6
-            #    bucket2: si falla enlace 6 → salida por 7
-            buckets_rev = [
-                parser.OFPBucket(
-                    watch_port=6,
-                    actions=[parser.OFPActionOutput(6)]
-                ),
-                parser.OFPBucket(
-                    watch_port=7,
-                    actions=[parser.OFPActionOutput(7)]
-                )
-            ]
-            req_rev = parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_FF,
-                group_id=2,
-                buckets=buckets_rev
-            )
-            dp.send_msg(req_rev)
-
-
-            # 3a) ESP32→Mosquitto
-            m_mqtt_fwd = parser.OFPMatch(
-                in_port=6,
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,
-                ipv4_src="192.168.10.138",
-                ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=100,
-                match=m_mqtt_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS,
-                    [parser.OFPActionGroup(group_id=1)]
-                )]
-            ))
-
-            # 3b) Mosquitto→ESP32
-            m_mqtt_rev = parser.OFPMatch(
-                in_port=3,
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,
-                ipv4_src="192.168.10.169",
-                ipv4_dst="192.168.10.138",
-                tcp_src=1883
-            )
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=100,
-                match=m_mqtt_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS,
-                    [parser.OFPActionGroup(group_id=2)]
-                )]
-            ))
-
-
-
-            match_bkp_s1 = parser.OFPMatch(
-                in_port=7,                            # enlace de backup s1←s6
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,                           # TCP
-                ipv4_src="192.168.10.138",            # ESP32
-                ipv4_dst="192.168.10.169",            # Mosquitto
-                tcp_dst=1883                          # puerto MQTT
-            )
-            actions_bkp_s1 = [
-                parser.OFPActionOutput(3)             # salida s1-eth3 (camino primario hacia S5)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=100,                         # misma prioridad que el flujo principal
-                match=match_bkp_s1,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_bkp_s1
-                )]
-            ))
-
-            # m_mqtt_fwd = parser.OFPMatch(
-            #     in_port=6, eth_type=0x0800, ip_proto=6,
-            #     ipv4_src="192.168.10.138", ipv4_dst="192.168.10.169",
-            #     tcp_dst=1883
-            # )
-            # a_mqtt_fwd = [parser.OFPActionOutput(3)]
-            # dp.send_msg(parser.OFPFlowMod(
-            #     datapath=dp, priority=100, match=m_mqtt_fwd,
-            #     instructions=[parser.OFPInstructionActions(
-            #         ofp.OFPIT_APPLY_ACTIONS, a_mqtt_fwd
-            #     )]
-            # ))
-
-            # m_mqtt_rev = parser.OFPMatch(
-            #     in_port=3, eth_type=0x0800, ip_proto=6,
-            #     ipv4_src="192.168.10.169", ipv4_dst="192.168.10.138",
-            #     tcp_src=1883
-            # )
-            # a_mqtt_rev = [parser.OFPActionOutput(6)]
-            # dp.send_msg(parser.OFPFlowMod(
-            #     datapath=dp, priority=100, match=m_mqtt_rev,
-            #     instructions=[parser.OFPInstructionActions(
-            #         ofp.OFPIT_APPLY_ACTIONS, a_mqtt_rev
-            #     )]
-            # ))
-
-
-            # --------- MQTT entre Mosquitto H5 y Raspberry ---------- #
-
-            m_rasp_fwd = parser.OFPMatch(
-                in_port=4, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.105", ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            a_rasp_fwd = [parser.OFPActionOutput(3)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m_rasp_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a_rasp_fwd
-                )]
-            ))
-            
-            m_rasp_rev = parser.OFPMatch(
-                in_port=3, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.105",
-                tcp_src=1883
-            )
-            a_rasp_rev = [parser.OFPActionOutput(4)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m_rasp_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a_rasp_rev
-                )]
-            ))
-
-
-            # ------------- Trafico normal entre VLAN 10 y VLAN 30 ------------- #            
-
-            # 1) Grupo SELECT para balancear 80/20 el tráfico VLAN10→VLAN30
-            buckets = [
-                # Bucket primario (80%): ruta s1→s5
-                parser.OFPBucket(
-                    weight=80,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                        parser.OFPActionOutput(6)
-                    ]
-                ),
-                # Bucket secundario (20%): ruta s1→s2
-                parser.OFPBucket(
-                    weight=20,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                        parser.OFPActionOutput(4)
-                    ]
-                )
-            ]
-            dp.send_msg(parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_SELECT,
-                group_id=10,
-                buckets=buckets
-            ))
-
-            # 2) Flujos que usan el grupo SELECT 
-            #    Todo tráfico IP que entra por 1,2,3 va al grupo 10
-            for in_p in [1, 2, 3]:
-                match = parser.OFPMatch(
-                    in_port=in_p,
-                    eth_type=ether_types.ETH_TYPE_IP
-                )
-                dp.send_msg(parser.OFPFlowMod(
-                    datapath=dp,
-                    priority=10,  
-                    match=match,
-                    instructions=[parser.OFPInstructionActions(
-                        ofp.OFPIT_APPLY_ACTIONS,
-                        [parser.OFPActionGroup(group_id=10)]
-                    )]
-                ))
-
-            # 3) Flujo de retorno VLAN30 que llega desde s2 (puerto 4)
-            #    Pop VLAN y enviar a h1,h6,h5 (puertos 1,2,3)
-            match_return = parser.OFPMatch(
-                in_port=4,
-                eth_type=ether_types.ETH_TYPE_IP,
-                vlan_vid=(0x1000 | 30)
-            )
-            actions_return = [
-                parser.OFPActionPopVlan(),
-                parser.OFPActionOutput(1),
-                parser.OFPActionOutput(2),
-                parser.OFPActionOutput(3)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,
-                match=match_return,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_return
-                )]
-            ))
-
-             # --- Retorno VLAN 30: todo lo que entra por s1-eth6 sale a h5, h1 y h6 ---
-            m_return = parser.OFPMatch(
-                in_port=6,                             # viene de s1-eth6 (desde s5)
-                eth_type=ether_types.ETH_TYPE_IP,
-                vlan_vid=(0x1000 | 30)                 # etiqueta VLAN 30 presente
-            )
-            actions_return = [
-                parser.OFPActionPopVlan(),             # quitamos la etiqueta antes de entregar a hosts
-                parser.OFPActionOutput(1),             # h1 (s1-eth1)
-                parser.OFPActionOutput(2),             # h6 (s1-eth2)
-                parser.OFPActionOutput(3)              # h5 (s1-eth3)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,                           # más alta que el DROP genérico
-                match=m_return,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_return
-                )]
-            ))
-
-
-            # ----------- UDP 2000 entre Radar y Visualizador ------------ #
-
-            # --- Nuevo camino UDP/2000 entre 192.168.10.150 (AP-s6) → 192.168.10.108 (AP-s3) vía s1 ---
-            # Sentido A: de s6 (in_port=7) hacia s3 (out_port=5)
-            match_path_fwd = parser.OFPMatch(
-                in_port=7,                            # s1-eth7 (viene de s6)
-                eth_type=ether_types.ETH_TYPE_IP,     # IPv4
-                ip_proto=17,                          # UDP
-                ipv4_src="192.168.10.150",
-                ipv4_dst="192.168.10.108",
-                udp_dst=2000                          # puerto UDP 2000
-            )
-            actions_path_fwd = [
-                parser.OFPActionOutput(5)             # s1-eth5 hacia s3
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=200,
-                match=match_path_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_path_fwd
-                )]
-            ))
-
-            # Sentido B: de s3 (in_port=5) de vuelta a s6 (out_port=7)
-            match_path_rev = parser.OFPMatch(
-                in_port=5,                            # s1-eth5 (viene de s3)
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=17,
-                ipv4_src="192.168.10.108",
-                ipv4_dst="192.168.10.150",
-                udp_src=2000                          # tráfico de retorno UDP/2000
-            )
-            actions_path_rev = [
-                parser.OFPActionOutput(7)             # s1-eth7 hacia s6
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=200,
-                match=match_path_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_path_rev
-                )]
-            ))
-            
-            
-                    
-
-            # ----------------------- DROP ALL ----------------------- #
-
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=0,
-                match=parser.OFPMatch(),
-                instructions=[]
-            ))
+        dp = ev.msg.datapath
+        ofp, parser = dp.ofproto, dp.ofproto_parser
+        requests = (
+            ('flows', parser.OFPFlowStatsRequest(
+                dp, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY, ofp.OFPG_ANY, 0, 0,
+                parser.OFPMatch())),
+            ('groups', parser.OFPGroupDescStatsRequest(dp, 0)),
+            ('meters', parser.OFPMeterConfigStatsRequest(dp, 0, ofp.OFPM_ALL)),
+            ('meter_features', parser.OFPMeterFeaturesStatsRequest(dp, 0)),
+        )
+        for _, req in requests:
+            dp.set_xid(req)
+        dump = self.dumps[dp.id] = SwitchDump(
+            (req.xid, kind) for kind, req in requests)
+        for _, req in requests:
+            dp.send_msg(req)
+        hub.spawn(self._reconcile_timeout, dp, dump)
+
+    def _reconcile_timeout(self, dp, dump):
+        hub.sleep(RECONCILE_TIMEOUT)
+        if self.dumps.get(dp.id) is dump:
+            del self.dumps[dp.id]
+            self.logger.warning("S%d no envió su contenido en %.0f s: se "
+                                "reprograma entero", dp.id, RECONCILE_TIMEOUT)
+            self._program_switch(dp)
+
+    def _dump_reply(self, ev, parse):
+        """Respuesta a una lectura del contenido; False si no es de ninguna.
+
+        Las lecturas se piden aún en CONFIG_DISPATCHER y sus respuestas
+        pueden llegar antes del paso a MAIN_DISPATCHER, así que los
+        manejadores que llaman aquí escuchan en los dos estados.
+        """
+        msg = ev.msg
+        dp = msg.datapath
+        dump = self.dumps.get(dp.id)
+        if dump is None or msg.xid not in dump.kinds:
+            return False
+        self._dump_add(dp, dump, msg.xid, [parse(item) for item in msg.body],
+                       msg.flags & dp.ofproto.OFPMPF_REPLY_MORE)
+        return True
+
+    def _stats_body(self, msg):
+        """Cuerpo completo de una respuesta multiparte; None hasta que llega
+        la última parte (sin OFPMPF_REPLY_MORE)."""
+        dp = msg.datapath
+        key = (dp.id, msg.xid)
+        body = self.stats_parts.pop(key, []) + list(msg.body)
+        if msg.flags & dp.ofproto.OFPMPF_REPLY_MORE:
+            self.stats_parts[key] = body
+            return None
+        return body
+
+    def _dump_add(self, dp, dump, xid, entries, more=False):
+        if dump.add(xid, entries, more):
+            del self.dumps[dp.id]
+            self._reconcile(dp, dump)
+
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _group_desc_reply(self, ev):
+        self._dump_reply(ev, group_entry_from_desc)
+
+    @set_ev_cls(ofp_event.EventOFPMeterConfigStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_config_reply(self, ev):
+        self._dump_reply(ev, meter_entry_from_config)
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_reply(self, ev):
+        self._dump_reply(ev, lambda features: features.max_meter)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _error_handler(self, ev):
+        """Un switch sin grupos o medidores rechaza su lectura: cuenta como vacía."""
+        msg = ev.msg
+        dp = msg.datapath
+        dump = self.dumps.get(dp.id)
+        if dump is not None and msg.xid in dump.kinds:
+            self.logger.info("S%d no admite la lectura de %s (error %d/%d)",
+                             dp.id, dump.kinds[msg.xid], msg.type, msg.code)
+            self._dump_add(dp, dump, msg.xid, [])
+
+    def _reconcile(self, dp, dump):
+        """Lleva el switch de lo leído a _intended enviando sólo la diferencia.
+
+        Las reglas con caducidad (elefantes, respondedor ARP, reactivas,
+        bloqueos de packet-in) se dejan como están. Los pesos SELECT y
+        límites de medidor que ya tiene el switch se adoptan, para no mover
+        el tráfico que está pasando.
+        """
+        found = dump.tables(
+            (COOKIE_ELEPHANT, COOKIE_ARP_RESPONDER, COOKIE_REACTIVE,
+             COOKIE_PACKET_IN_BLOCK))
+        now = time.time()
+        if dump.meter_support:
+            self.meterless.discard(dp.id)
+        elif dp.id not in self.meterless:
+            self.meterless.add(dp.id)
+            self.install_bufs.pop(dp.id, None)
+            self.logger.warning("S%d no admite medidores: el best effort "
+                                "entre VLANs pasa sin límite", dp.id)
+        for key in [key for key in self.elephants if key[0] == dp.id]:
+            del self.elephants[key]
+        for key in [key for key in self.meter_limits if key[0] == dp.id]:
+            del self.meter_limits[key]
+        def unweighted(group):
+            return group._replace(buckets=tuple(
+                bucket._replace(weight=0) for bucket in group.buckets))
+        groups = dict((group.group_id, group) for group in found.groups)
+        for group in self.group_weights:
+            if group.dpid != dp.id:
+                continue
+            group.reset()
+            current = groups.get(group.group_id)
+            if current and unweighted(current) == \
+                    unweighted(self._group_entry(group)):
+                group.weights = tuple(
+                    bucket.weight for bucket in current.buckets)
+        meters = dict((meter.meter_id, meter) for meter in found.meters)
+        for dpid, meter_id, _, _ in self.metered:
+            current = meters.get(meter_id)
+            if dpid == dp.id and current and current.rate_kbps and \
+                    meter_entry(meter_id, current.rate_kbps * 1000) == current:
+                self.meter_limits[(dpid, meter_id)] = (
+                    current.rate_kbps * 1000, now)
+        self.shadow[dp.id] = found
+        record = {'cause': 'Reconexión de S%d' % dp.id, 'start': dump.start,
+                  'computed': now, 'pending': set(), 'msgs': 0}
+        sent = self._sync(dp, record=record)
+        buf = bytearray()
+        for ip, (mac, expires) in list(self.arp_responders.items()):
+            for msg in self._arp_responder_msgs(dp, ip, mac, expires):
+                buf += self._serialize(dp, msg)
+        if buf:
+            dp.send(bytes(buf))
+        self.logger.info(
+            "S%d reconciliado: leídos %d flujos, %d grupos y %d medidores en "
+            "%.1f ms; %d mensajes de diferencia", dp.id, len(found.flows),
+            len(found.groups), len(found.meters), (now - dump.start) * 1000.0,
+            sent)
+        if QOS_ENABLED:
+            hub.spawn(self._configure_queues, dp.id)
+
+    def _program_switch(self, dp):
+        """Envía las tablas de dp y reinicia el estado que depende de ellas."""
+        # la instalación deja los grupos SELECT con sus pesos declarados
+        for group in self.group_weights:
+            if group.dpid == dp.id:
+                group.reset()
+        for key in [key for key in self.elephants if key[0] == dp.id]:
+            del self.elephants[key]
+        for key in [key for key in self.meter_limits if key[0] == dp.id]:
+            del self.meter_limits[key]
+        self._install_tables(dp)
+        if self.high_congestion and dp.id in self.detour_tables:
+            for flow in self.detour_tables[dp.id].flows:
+                dp.send_msg(build_flow_mod(flow, dp))
+        self.shadow[dp.id] = self._intended(dp.id)
+        if QOS_ENABLED:
+            hub.spawn(self._configure_queues, dp.id)
+
+    def _sync(self, dp, extra=(), record=None):
+        """Lleva dp a _intended(dp.id) enviando sólo la diferencia con la sombra.
+
+        extra son flujos a enviar junto con la diferencia si la hay. Con
+        record se cierra con una barrera cuya respuesta se apunta en él
+        (latencia de un reencaminamiento). Devuelve los mensajes enviados.
+        Las reglas con caducidad (elefantes, respondedor ARP, reactivas,
+        bloqueos de packet-in) no están en la sombra.
+        """
+        old = self.shadow.get(dp.id)
+        if old is None:
+            return 0
+        new = self._intended(dp.id)
+        size = len(new.groups) + len(new.meters) + len(new.flows)
+        if new == old:
+            self.sync_avoided += size
+            return 0
+        pre, flows, post = build_diff_msgs(old, new)
+        flows += list(extra)
+        self.shadow[dp.id] = new
+        if not (pre or flows or post):
+            # mismas entradas en otro orden
+            self.sync_avoided += size
+            return 0
+        self.sync_avoided += size - (
+            len(set(new.groups) - set(old.groups)) +
+            len(set(new.meters) - set(old.meters)) +
+            len(set(new.flows) - set(old.flows)))
+        buf = bytearray()
+        for part in (pre, flows, post):
+            if part and buf:
+                buf += self._serialize(
+                    dp, dp.ofproto_parser.OFPBarrierRequest(dp))
+            for msg in part:
+                buf += self._serialize(dp, msg)
+        if record is not None:
+            barrier = dp.ofproto_parser.OFPBarrierRequest(dp)
+            buf += self._serialize(dp, barrier)
+            self.reroute_barriers[(dp.id, barrier.xid)] = record
+            record['pending'].add(dp.id)
+            record['msgs'] += len(pre) + len(flows) + len(post)
+        sent = len(pre) + len(flows) + len(post)
+        self.sync_sent += sent
+        dp.send(bytes(buf))
+        return sent
+
+    def _serialize_install(self, dp):
+        """Serializa grupos, medidores, barrera y flujos en un solo buffer.
+
+        La barrera intermedia garantiza que los grupos SELECT/FF/ALL y los
+        medidores existan antes de que lleguen los flujos que los referencian.
+        """
+        groups, flows = self.install_msgs.get(dp.id, self.default_msgs)
+        if dp.id in self.meterless:
+            groups, flows = build_install_msgs(without_meters(
+                self.tables.get(dp.id, DEFAULT_TABLES)))
+        buf = bytearray()
+        for msg in groups:
+            buf += self._serialize(dp, msg)
+        if groups:
+            buf += self._serialize(dp, dp.ofproto_parser.OFPBarrierRequest(dp))
+        for msg in flows:
+            buf += self._serialize(dp, msg)
+        return bytes(buf)
+
+    @staticmethod
+    def _serialize(dp, msg):
+        msg.datapath = dp
+        if msg.xid is None:
+            dp.set_xid(msg)
+        msg.serialize()
+        return msg.buf
+
+    def _install_tables(self, dp):
+        """Programa un switch con una única escritura cerrada por una barrera."""
+        start = time.time()
+        buf = self.install_bufs.get(dp.id)
+        if buf is None:
+            buf = self.install_bufs[dp.id] = self._serialize_install(dp)
+        buf = bytearray(buf)
+        for ip, (mac, expires) in list(self.arp_responders.items()):
+            for msg in self._arp_responder_msgs(dp, ip, mac, expires):
+                buf += self._serialize(dp, msg)
+        # La barrera final lleva un xid nuevo para medir cuándo termina
+        barrier = dp.ofproto_parser.OFPBarrierRequest(dp)
+        buf += self._serialize(dp, barrier)
+        self.pending_barriers[dp.id] = (barrier.xid, start)
+        dp.send(bytes(buf))
+
+    def _configure_queues(self, dpid):
+        """Crea (o rehace) las colas de salida de los puertos entre switches."""
+        ports = sorted(port for (a, _), port in self.link_util.link_ports.items()
+                       if a == dpid)
+        if not ports:
             return
-
-        # ----------------------------
-        #   SWITCH S2  (DPID == 2)
-        # ----------------------------
-        if dpid == 2:
-
-            
-            
-            # ------------------ IPTV entre h1 y h3 ------------------ #
-
-            # --- IPTV VLAN 10: ingress por s2-eth1 → egress por s2-eth2 ---
-            match_iptv_s2 = parser.OFPMatch(
-                in_port=1,                             # viene de s2-eth1 (desde s1)
-                eth_type=ether_types.ETH_TYPE_IP,   # trama 802.1Q
-                vlan_vid=(0x1000 | 10),                # VLAN ID = 10
-                ip_proto=17,                           # UDP
-                udp_dst=5004                           # puerto IPTV
-            )
-            actions_iptv_s2 = [
-                parser.OFPActionOutput(2)              # hacia s2-eth2 (hacia s3)
-            ]
-
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=30,                           # más alta que DROP
-                match=match_iptv_s2,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_iptv_s2
-                )]
-            ))
-
-            # --- IPTV bi-direccional retorno: VLAN 30 ingress por s2-eth2 → egress por s2-eth1 ---
-            match_iptv_ret_s2 = parser.OFPMatch(
-                in_port=2,                               # viene de s2-eth2 (desde s3)
-                eth_type=ether_types.ETH_TYPE_IP,     # trama 802.1Q
-                vlan_vid=(0x1000 | 30),                  # VLAN ID = 30
-                ip_proto=17,                             # UDP
-                udp_src=5004                             # tráfico IPTV de retorno
-            )
-            actions_iptv_ret_s2 = [
-                parser.OFPActionOutput(1)                # hacia s2-eth1 (de regreso a s1)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=30,                             # más alta que DROP
-                match=match_iptv_ret_s2,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_iptv_ret_s2
-                )]
-            ))
-            
-
-            # --------- MQTT entre Mosquitto H5 y Raspberry ---------- #
-
-            m2_rasp_fwd = parser.OFPMatch(
-                in_port=2, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.105", ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            a2_rasp_fwd = [parser.OFPActionOutput(1)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m2_rasp_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a2_rasp_fwd
-                )]
-            ))
-            
-            m2_rasp_rev = parser.OFPMatch(
-                in_port=1, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.105",
-                tcp_src=1883
-            )
-            a2_rasp_rev = [parser.OFPActionOutput(2)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m2_rasp_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a2_rasp_rev
-                )]
-            ))
-
-
-            # ------------- Trafico normal entre VLAN 10 y VLAN 30 ------------- #    
-
-            # --- VLAN 10: ingress por s2-eth1 → egress por s2-eth2 ---
-            m_vlan10 = parser.OFPMatch(
-                in_port=1,                            # s2-eth1
-                eth_type=ether_types.ETH_TYPE_IP,     # trama 802.1Q
-                vlan_vid=(0x1000 | 10)                # VLAN ID = 10
-            )
-            a_vlan10 = [parser.OFPActionOutput(2)]    # s2-eth2
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=20,
-                match=m_vlan10,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a_vlan10
-                )]
-            ))
-
-            # --- VLAN 30: ingress por s2-eth2 → egress por s2-eth1 ---
-            m_vlan30 = parser.OFPMatch(
-                in_port=2,                            # s2-eth2
-                eth_type=ether_types.ETH_TYPE_IP,     # trama 802.1Q
-                vlan_vid=(0x1000 | 30)                # VLAN ID = 30
-            )
-            a_vlan30 = [parser.OFPActionOutput(1)]   # s2-eth1
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=20,
-                match=m_vlan30,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a_vlan30
-                )]
-            ))
-
-
-
-            # ----------------------- DROP ALL ----------------------- #
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=0,
-                match=parser.OFPMatch(),
-                instructions=[]
-            ))
+        try:
+            stale = []
+            for table in ('qos', 'queue'):
+                out = subprocess.check_output(
+                    ['ovs-vsctl', '--bare', '--columns=_uuid', 'find', table,
+                     'external-ids:sdn-dpid=%d' % dpid])
+                stale += [(table, uuid) for uuid in out.decode().split()]
+            subprocess.check_call(ovs_qos_command(dpid, ports, stale))
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.logger.warning("No se pudieron crear las colas de S%d: %s",
+                                dpid, e)
             return
-                
-
-        # ----------------------------
-        #   SWITCH S3  (DPID == 3)
-        # ----------------------------
-        if dpid == 3:
-            
-            # ------------------ IPTV entre h1 y h3 ------------------ #
-            
-
-            # 1) Crear grupo ALL para IPTV entrante en S3 (group_id = 21)
-            buckets_iptv_in_all = [
-                parser.OFPBucket(
-                    actions=[
-                        parser.OFPActionPopVlan(),
-                        parser.OFPActionOutput(1)   # h2 (s3-eth1)
-                    ]
-                ),
-                parser.OFPBucket(
-                    actions=[
-                        parser.OFPActionPopVlan(),
-                        parser.OFPActionOutput(2)   # h3 (s3-eth2)
-                    ]
-                ),
-                parser.OFPBucket(
-                    actions=[
-                        parser.OFPActionPopVlan(),
-                        parser.OFPActionOutput(6)   # AP-s3 (s3-eth6)
-                    ]
-                )
-            ]
-            dp.send_msg(parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_ALL,
-                group_id=21,
-                buckets=buckets_iptv_in_all
-            ))
-
-
-            # --- IPTV VLAN 10 entrante por s3-eth4 → pop VLAN → salida a h2,h3,AP (puertos 1,2,6) ---
-            match_iptv_in = parser.OFPMatch(
-                in_port=4,                                # s3-eth4 conecta con s2
-                eth_type=ether_types.ETH_TYPE_IP,         # trama 802.1Q
-                vlan_vid=(0x1000 | 10),                   # VLAN ID = 10
-                ip_proto=17,                              # UDP
-                udp_dst=5004                              # puerto IPTV
-            )
-            
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=30,
-                match=match_iptv_in,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS,
-                    [parser.OFPActionGroup(group_id=21)]
-                )]
-            ))
-
-            # --- IPTV bi-direccional: tag VLAN 30 en tráfico UDP/5004 que entra por 1,2,6 y enviar por el puerto 4 ---
-            for in_p in [1, 2, 6]:  # h2 (1), h3 (2), AP-s3 (6)
-                match_iptv_bi = parser.OFPMatch(
-                    in_port=in_p,
-                    eth_type=ether_types.ETH_TYPE_IP,
-                    ip_proto=17,         # UDP
-                    udp_src=5004         # tráfico IPTV de retorno
-                )
-                actions_iptv_bi = [
-                    parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                    parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                    parser.OFPActionOutput(4)     # hacia s3-eth4 → enlace a s2
-                ]
-                dp.send_msg(parser.OFPFlowMod(
-                    datapath=dp,
-                    priority=30,
-                    match=match_iptv_bi,
-                    instructions=[parser.OFPInstructionActions(
-                        ofp.OFPIT_APPLY_ACTIONS, actions_iptv_bi
-                    )]
-                ))
-
-
-            
-            # --------- MQTT entre Mosquitto H5 y Raspberry ---------- #
-
-            m3_rasp_fwd = parser.OFPMatch(
-                in_port=6, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.105", ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            a3_rasp_fwd = [parser.OFPActionOutput(4)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m3_rasp_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a3_rasp_fwd
-                )]
-            ))
-            
-            m3_rasp_rev = parser.OFPMatch(
-                in_port=4, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.105",
-                tcp_src=1883
-            )
-            a3_rasp_rev = [parser.OFPActionOutput(6)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m3_rasp_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a3_rasp_rev
-                )]
-            ))
-
-
-            # ------------- Trafico normal entre VLAN 30 y VLAN 10 ------------- #
-
-            # 1) Crear grupo SELECT para retorno VLAN 30 con peso 60/40
-            buckets_vlan30_return = [
-                # 80% de los paquetes: tag VLAN30 + salida por s3-eth5 → puerto 5 (hacia S4)
-                parser.OFPBucket(
-                    weight=80,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                        parser.OFPActionOutput(5)
-                    ]
-                ),
-                # 20% de los paquetes: tag VLAN30 + salida por s3-eth4 → puerto 4 (ruta alternativa)
-                parser.OFPBucket(
-                    weight=20,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                        parser.OFPActionOutput(4)
-                    ]
-                )
-            ]
-            dp.send_msg(parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_SELECT,
-                group_id=30,
-                buckets=buckets_vlan30_return
-            ))
-
-            # 2) Flujos de retorno que usan el grupo SELECT en lugar de OUTPUT directo
-            for in_p in [1, 2, 6]:
-                match_ret = parser.OFPMatch(
-                    in_port=in_p,
-                    eth_type=ether_types.ETH_TYPE_IP
-                )
-                dp.send_msg(parser.OFPFlowMod(
-                    datapath=dp,
-                    priority=10,
-                    match=match_ret,
-                    instructions=[parser.OFPInstructionActions(
-                        ofp.OFPIT_APPLY_ACTIONS,
-                        [parser.OFPActionGroup(group_id=30)]
-                    )]
-                ))
-
-            m_h6_all = parser.OFPMatch(
-                in_port=5,                         # viene de s4-ethX
-                eth_type=ether_types.ETH_TYPE_IP,
-                vlan_vid=(0x1000 | 10)             # etiqueta VLAN 10 presente
-            )
-            actions_h6_all = [
-                parser.OFPActionPopVlan(),
-                parser.OFPActionOutput(1),         # hacia h2 (s3-eth1)
-                parser.OFPActionOutput(2),         # hacia h3 (s3-eth2)
-                parser.OFPActionOutput(6)          # hacia AP-s3
-            ]
-
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,                       # más alta que el DROP
-                match=m_h6_all,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_h6_all
-                )]
-            ))
-
-            m_h6_all = parser.OFPMatch(
-                in_port=4,                         # viene de s2-eth1
-                eth_type=ether_types.ETH_TYPE_IP,
-                vlan_vid=(0x1000 | 10)             # etiqueta VLAN 10 presente
-            )
-            actions_h6_all = [
-                parser.OFPActionPopVlan(),
-                parser.OFPActionOutput(1),         # hacia h2 (s3-eth1)
-                parser.OFPActionOutput(2),         # hacia h3 (s3-eth2)
-                parser.OFPActionOutput(6)          # hacia AP-s3
-            ]
-
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,                       # más alta que el DROP
-                match=m_h6_all,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_h6_all
-                )]
-            ))
-
-
-
-            # ----------- UDP 2000 entre Radar y Visualizador ------------ #
-            
-            # --- UDP/2000 forward: de 192.168.10.150 → 192.168.10.108, ingress por s3-eth3 → egress por s3-eth6 (AP) ---
-            match_path_fwd = parser.OFPMatch(
-                in_port=3,                            # s3-eth3 (viene de s1)
-                eth_type=ether_types.ETH_TYPE_IP,     # IPv4
-                ip_proto=17,                          # UDP
-                ipv4_src="192.168.10.150",
-                ipv4_dst="192.168.10.108",
-                udp_dst=2000                          # puerto UDP 2000
-            )
-            actions_path_fwd = [
-                parser.OFPActionOutput(6)             # s3-eth6 hacia AP
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=200,
-                match=match_path_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_path_fwd
-                )]
-            ))
-
-            # --- UDP/2000 reverse: de 192.168.10.108 → 192.168.10.150, ingress por s3-eth6 → egress por s3-eth3 ---
-            match_path_rev = parser.OFPMatch(
-                in_port=6,                            # s3-eth6 (viene del AP)
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=17,
-                ipv4_src="192.168.10.108",
-                ipv4_dst="192.168.10.150",
-                udp_src=2000                          # tráfico de retorno UDP/2000
-            )
-            actions_path_rev = [
-                parser.OFPActionOutput(3)             # s3-eth3 de regreso hacia s1
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=200,
-                match=match_path_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_path_rev
-                )]
-            ))
-
-
+        self.logger.info("Colas QoS en S%d: puertos %s", dpid,
+                         ', '.join(map(str, ports)))
 
+    #
+    #  Descubrimiento de enlaces por LLDP y caídas de puertos: al cambiar el
+    #  grafo se recompilan las políticas y a cada switch afectado se le
+    #  envía sólo la diferencia entre sus tablas viejas y las nuevas
+    #
+    @set_ev_cls(topo_event.EventLinkAdd)
+    def _link_add_handler(self, ev):
+        src, dst = ev.link.src, ev.link.dst
+        if self.topology.add(src.dpid, src.port_no, dst.dpid, dst.port_no):
+            self.logger.info("Enlace LLDP S%d-eth%d -> S%d-eth%d",
+                             src.dpid, src.port_no, dst.dpid, dst.port_no)
+            self._schedule_topology()
+
+    @set_ev_cls(topo_event.EventLinkDelete)
+    def _link_delete_handler(self, ev):
+        start = time.time()
+        src, dst = ev.link.src, ev.link.dst
+        if self.topology.remove(src.dpid, src.port_no, dst.dpid, dst.port_no):
+            self.logger.info("Enlace LLDP perdido S%d-eth%d -> S%d-eth%d",
+                             src.dpid, src.port_no, dst.dpid, dst.port_no)
+            if self.discovered:
+                # caducidad LLDP de un enlace en uso: se reencamina ya
+                self._apply_topology(("LLDP S%d-S%d" % (src.dpid, dst.dpid),
+                                      start))
+            else:
+                self._schedule_topology()
 
-            # ----------------------- DROP ALL ----------------------- #
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=0,
-                match=parser.OFPMatch(),
-                instructions=[]
-            ))
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        """Caída o vuelta de un puerto entre switches: se reencamina al momento."""
+        start = time.time()
+        msg = ev.msg
+        dp = msg.datapath
+        ofp = dp.ofproto
+        end = (dp.id, msg.desc.port_no)
+        down = (msg.reason == ofp.OFPPR_DELETE or
+                msg.desc.state & ofp.OFPPS_LINK_DOWN or
+                msg.desc.config & ofp.OFPPC_PORT_DOWN)
+        if down:
+            base = self.topology.links() if self.discovered \
+                else self.bootstrap_links
+            pair = next(((a, b, ((a, port_a), (b, port_b)))
+                         for a, port_a, b, port_b in base
+                         if end in ((a, port_a), (b, port_b))), None)
+            if pair is None or pair[:2] in self.down_links:
+                return
+            self.down_links[pair[:2]] = pair[2]
+            self.logger.warning("Puerto S%d-eth%d caído: enlace S%d-S%d fuera",
+                                end[0], end[1], pair[0], pair[1])
+            self._apply_topology(("caída S%d-S%d" % pair[:2], start))
+        else:
+            pair = next((pair for pair, ends in self.down_links.items()
+                         if end in ends), None)
+            if pair is None:
+                return
+            del self.down_links[pair]
+            self.logger.info("Puerto S%d-eth%d activo: enlace S%d-S%d de vuelta",
+                             end[0], end[1], pair[0], pair[1])
+            self._apply_topology(("vuelta S%d-S%d" % pair, start))
+
+    def _schedule_topology(self):
+        if self.topology_thread is None:
+            self.topology_thread = hub.spawn(self._settle_topology)
+
+    def _settle_topology(self):
+        hub.sleep(TOPOLOGY_SETTLE)
+        self.topology_thread = None
+        self._apply_topology()
+
+    @staticmethod
+    def _discovery_gap(links):
+        """Motivo por el que links aún no cubre los servicios, o None."""
+        try:
+            services = resolve_routes(SERVICES + (MQTT_RASP_DETOUR,),
+                                      PathEngine(links), HOSTS)
+        except ValueError as e:
+            return str(e)
+        missing = TopologyGraph(links).missing(services)
+        if missing:
+            return "sin enlace " + ', '.join('S%d-S%d' % pair
+                                             for pair in missing)
+        return None
+
+    def _intended(self, dpid):
+        """Tablas que debe tener dpid según el estado actual de las políticas.
+
+        Son las compiladas con los pesos vigentes de los grupos SELECT, el
+        límite vigente de los medidores y el desvío si está activo; sin
+        medidores si el switch no los admite.
+        """
+        tables = self.tables.get(dpid, DEFAULT_TABLES)
+        weights = dict((group.group_id, group.weights)
+                       for group in self.group_weights if group.dpid == dpid)
+        limits = dict((meter_id, limit) for (switch, meter_id), (limit, _)
+                      in self.meter_limits.items() if switch == dpid)
+        groups = tuple(
+            group._replace(buckets=tuple(
+                bucket._replace(weight=weight) for bucket, weight
+                in zip(group.buckets, weights[group.group_id])))
+            if group.group_id in weights else group
+            for group in tables.groups)
+        meters = tuple(
+            meter_entry(meter.meter_id, limits[meter.meter_id])
+            if meter.meter_id in limits else meter
+            for meter in tables.meters)
+        flows = tables.flows
+        if self.high_congestion and dpid in self.detour_tables:
+            flows += self.detour_tables[dpid].flows
+        tables = SwitchTables(groups, flows, meters)
+        return without_meters(tables) if dpid in self.meterless else tables
+
+    def _apply_topology(self, cause=None):
+        """Recompila con el grafo actual y envía a los switches sólo lo que cambia.
+
+        Hasta que LLDP cubre todos los servicios se sigue con LINKS (el
+        grafo puede estar a medio descubrir). A partir de ahí, o en cuanto
+        cae un puerto, los servicios se resuelven en modo degradado: los
+        que pasaban por un enlace perdido se reencaminan.
+          cause: (descripción, instante en que se detectó el cambio) para
+                 medir la latencia hasta que los switches confirman las
+                 reglas nuevas
+        """
+        description, start = cause or ("cambio de topología", time.time())
+        if not self.discovered:
+            gap = self._discovery_gap(self.topology.links())
+            if gap is None:
+                self.discovered = True
+            elif self.topology.links():
+                self.logger.info("Topología LLDP incompleta (%s): se sigue "
+                                 "con LINKS", gap)
+        base = self.topology.links() if self.discovered \
+            else self.bootstrap_links
+        links = tuple(link for link in base
+                      if (link[0], link[2]) not in self.down_links)
+        if links == self.links:
             return
-
-        # ----------------------------
-        #   SWITCH S4  (DPID == 4)
-        # ----------------------------
-        if dpid == 4:
-
-            # ------------- Trafico normal entre H6 y H2 ------------- #
-
-            m_h6_h2 = parser.OFPMatch(
-                in_port=2,                          # viene de s4-eth2 (desde s5)
-                eth_type=ether_types.ETH_TYPE_IP,
-                vlan_vid=(0x1000 | 10)              # etiqueta VLAN 10 presente
-            )
-
-            a_h6_h2 = [
-                parser.OFPActionOutput(1)           # hacia s4-eth1 (s3)
-            ]
-
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,                        # mayor que el DROP
-                match=m_h6_h2,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a_h6_h2
-                )]
-            ))
-
-
-
-            # --- Retorno VLAN 30: todo lo que entra por el puerto 1 sale por el puerto 2 ---
-            m_ret = parser.OFPMatch(
-                in_port=1,                            # viene de s4-eth1 (h2/h3/AP)
-                eth_type=ether_types.ETH_TYPE_IP,        # solo tráfico IP
-                vlan_vid=(0x1000 | 30)                # etiqueta VLAN 30 presente
-            )
-            actions_ret = [
-                parser.OFPActionOutput(2)             # hacia s4-eth2 (de regreso a s5)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,                          # más alta que el DROP
-                match=m_ret,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_ret
-                )]
-            ))
-
-
-
-
-            # ----------------------- DROP ALL ----------------------- #
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=0,
-                match=parser.OFPMatch(),
-                instructions=[]
-            ))
+        self.paths.set_links(links)
+        services = resolve_routes(SERVICES, self.paths, HOSTS, repair=True)
+        names = set(svc.name for svc in services)
+        lost = [svc.name for svc in SERVICES if svc.name not in names]
+        if lost:
+            self.logger.warning("Sin camino para %s", ', '.join(lost))
+        old_tables = self.tables
+        old_ports = dict(self.link_util.link_ports)
+        self.links = links
+        self.blocked_ports = spanning_tree(links)
+        self.link_util.set_links(links)
+        self.services = services
+        self.detour = next(iter(resolve_routes(
+            (MQTT_RASP_DETOUR,), self.paths, HOSTS, repair=True)), None)
+        self._compile(links)
+        # un grupo SELECT con los mismos caminos conserva sus pesos
+        current = dict(((group.dpid, group.group_id, group.paths, group.base),
+                        group) for group in self.group_weights)
+        self.group_weights = [current.get(spec) or GroupWeights(*spec)
+                              for spec in weighted_groups(services)]
+        self._index_elephants()
+        self.metered = metered_ingresses(services)
+
+        for dpid in set(old_tables) | set(self.tables):
+            if old_tables.get(dpid) != self.tables.get(dpid):
+                self.install_bufs.pop(dpid, None)
+        computed = time.time()
+        record = {'cause': description, 'start': start, 'computed': computed,
+                  'pending': set(), 'msgs': 0}
+        changed = []
+        for dpid, dp in sorted(self.datapaths.items()):
+            # los elefantes fijados usaban los buckets de antes
+            pinned = [key for key in self.elephants if key[0] == dpid] \
+                if old_tables.get(dpid) != self.tables.get(dpid) else []
+            extra = [build_cookie_delete(COOKIE_ELEPHANT, COOKIE_KIND_MASK)] \
+                if pinned else []
+            if self._sync(dp, extra, record):
+                changed.append(dpid)
+                for key in pinned:
+                    del self.elephants[key]
+        self.logger.info(
+            "%s: grafo con %d enlaces, recalculado en %.1f ms; cambia %s "
+            "con %d mensajes (caché de caminos: %d aciertos, %d cálculos)",
+            description, len(links), (computed - start) * 1000.0,
+            ', '.join('S%d' % dpid for dpid in changed) or 'nada',
+            record['msgs'], self.paths.hits, self.paths.misses)
+        # colas de los puertos entre switches nuevos
+        moved = set(old_ports.items()) ^ set(self.link_util.link_ports.items())
+        for dpid in sorted(set(a for (a, _), _ in moved)):
+            if QOS_ENABLED and dpid in self.datapaths:
+                hub.spawn(self._configure_queues, dpid)
+
+    @staticmethod
+    def _arp_responder_msgs(dp, ip, mac, expires):
+        """FlowMods del respondedor ARP de ip; los aprendidos caducan con la caché."""
+        hard_timeout = 0
+        if expires is not None:
+            hard_timeout = int(expires - time.time())
+            if hard_timeout <= 0:
+                return []
+        return [build_flow_mod(entry, dp, hard_timeout=hard_timeout)
+                for entry in arp_responder_entries(ip, mac)]
+
+    def _update_arp_responder(self, ip, mac, changed):
+        """Instala o actualiza en todos los switches el respondedor de ip.
+
+        Sin cambios de MAC sólo se reinstala cuando al flujo le queda menos
+        de la mitad de su vida, para no reenviarlo con cada ARP.
+        """
+        if ip not in ARP_RESPONDER_HOSTS or ARP_RESPONDER_HOSTS[ip]:
             return
-        
-        # ----------------------------
-        #   SWITCH S5  (DPID == 5)
-        # ----------------------------
-        if dpid == 5:
-            
-            # ----------- MQTT entre Mosquitto H5 y ESP32 ------------ #
-
-            m1 = parser.OFPMatch(
-                in_port=3, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.138", ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            a1 = [parser.OFPActionOutput(1)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m1,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a1
-                )]
-            ))
-
-            m2 = parser.OFPMatch(
-                in_port=1, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.138",
-                tcp_src=1883
-            )
-            a2 = [parser.OFPActionOutput(3)]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m2,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a2
-                )]
-            ))
-
-
-            # ------------- Trafico normal entre H6 y H2 ------------- #
-
-            # Match: paquetes IPv4 entrantes por s5-eth1 (in_port=1) con VLAN ID 30
-            m_h6_h2 = parser.OFPMatch(
-                in_port=1,
-                eth_type=0x0800,
-                vlan_vid=(0x1000 | 10)     # el bit 0x1000 indica "VLAN present"
-            )
-
-            a_h6_h2 = [
-                parser.OFPActionOutput(2)  # hacia s4 (s5-eth2)
-            ]
-
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,               # más alta que el DROP
-                match=m_h6_h2,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, a_h6_h2
-                )]
-            ))
-
-
-            # --- Retorno VLAN 30: todo lo que entra por el puerto 2 sale por el puerto 1 ---
-            m_ret = parser.OFPMatch(
-                in_port=2,                            # viene de s5-eth2 (desde s4)
-                eth_type=ether_types.ETH_TYPE_IP,        # sólo tráfico IP
-                vlan_vid=(0x1000 | 30)                # etiqueta VLAN 30 presente
-            )
-            actions_ret = [
-                parser.OFPActionOutput(1)             # hacia s5-eth1 (de regreso a s1)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=10,                          # más alta que el DROP genérico
-                match=m_ret,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_ret
-                )]
-            ))
-
-
-
-            # ----------------------- DROP ALL ----------------------- #
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=0,
-                match=parser.OFPMatch(),
-                instructions=[]
-            ))
+        now = time.time()
+        current = self.arp_responders.get(ip)
+        if not changed and current and current[1] - now > ARP_TTL / 2.0:
             return
-
-        # ---------------------------------
-        #   SWITCH S6  (DPID == 6)
-        # ---------------------------------
-        if dpid == 6:
-
-            # ----------- MQTT entre Mosquitto H5 y ESP32 ------------ #
-            
-            # 1) Crear grupo FF para ESP32→Mosquitto (in_port=4 → out_port=2 primario, backup→out_port=3)
-            buckets_fwd_s6 = [
-                parser.OFPBucket(
-                    watch_port=2,
-                    actions=[parser.OFPActionOutput(2)]
-                ),
-                parser.OFPBucket(
-                    watch_port=3,
-                    actions=[parser.OFPActionOutput(3)]
-                )
-            ]
-            req_fwd_s6 = parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_FF,
-                group_id=1,
-                buckets=buckets_fwd_s6
-            )
-            dp.send_msg(req_fwd_s6)
-
-            # 2) Crear grupo FF para Mosquitto→ESP32 (in_port=2 → out_port=4 primario, backup→out_port=3)
-            buckets_rev_s6 = [
-                parser.OFPBucket(
-                    watch_port=2,
-                    actions=[parser.OFPActionOutput(4)]
-                ),
-                parser.OFPBucket(
-                    watch_port=3,
-                    actions=[parser.OFPActionOutput(4)]
-                )
-            ]
-            req_rev_s6 = parser.OFPGroupMod(
-                datapath=dp,
-                command=ofp.OFPGC_ADD,
-                type_=ofp.OFPGT_FF,
-                group_id=2,
-                buckets=buckets_rev_s6
-            )
-            dp.send_msg(req_rev_s6)
-
-            # 3) Flujos MQTT que usan los grupos en lugar de OUTPUT directo
-
-            # ESP32→Mosquitto
-            m_f = parser.OFPMatch(
-                in_port=4, eth_type=ether_types.ETH_TYPE_IP, ip_proto=6,
-                ipv4_src="192.168.10.138", ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m_f,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS,
-                    [parser.OFPActionGroup(group_id=1)]
-                )]
-            ))
-
-            # Mosquitto→ESP32
-            m_r = parser.OFPMatch(
-                in_port=2, eth_type=ether_types.ETH_TYPE_IP, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.138",
-                tcp_src=1883
-            )
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=100, match=m_r,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS,
-                    [parser.OFPActionGroup(group_id=2)]
-                )]
-            ))
-
-
-
-            match_bkp_s6 = parser.OFPMatch(
-                in_port=3,                            # enlace de backup s6←s1
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,                           # TCP
-                ipv4_src="192.168.10.169",            # Mosquitto
-                ipv4_dst="192.168.10.138",            # ESP32
-                tcp_src=1883                          # puerto MQTT de origen
-            )
-            actions_bkp_s6 = [
-                parser.OFPActionOutput(4)             # salida s6-eth4 (hacia ESP32)
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=100,
-                match=match_bkp_s6,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_bkp_s6
-                )]
-            ))
-
-
-
-            # m_f = parser.OFPMatch(
-            #     in_port=4, eth_type=0x0800, ip_proto=6,
-            #     ipv4_src="192.168.10.138", ipv4_dst="192.168.10.169",
-            #     tcp_dst=1883
-            # )
-            # a_f = [parser.OFPActionOutput(2)]
-            # dp.send_msg(parser.OFPFlowMod(
-            #     datapath=dp, priority=100, match=m_f,
-            #     instructions=[parser.OFPInstructionActions(
-            #         ofp.OFPIT_APPLY_ACTIONS, a_f
-            #     )]
-            # ))
-
-            # m_r = parser.OFPMatch(
-            #     in_port=2, eth_type=0x0800, ip_proto=6,
-            #     ipv4_src="192.168.10.169", ipv4_dst="192.168.10.138",
-            #     tcp_src=1883
-            # )
-            # a_r = [parser.OFPActionOutput(4)]
-            # dp.send_msg(parser.OFPFlowMod(
-            #     datapath=dp, priority=100, match=m_r,
-            #     instructions=[parser.OFPInstructionActions(
-            #         ofp.OFPIT_APPLY_ACTIONS, a_r
-            #     )]
-            # ))
-
-
-
-            # ----------- UDP 2000 entre Radar y Visualizador ------------ #
-
-            # Sentido 1: 192.168.10.150 → 192.168.10.108
-            match_fwd = parser.OFPMatch(
-                in_port=4,                             # llega de s6-eth4 (AP-s6)
-                eth_type=ether_types.ETH_TYPE_IP,      # IPv4
-                ip_proto=17,                           # UDP
-                ipv4_src="192.168.10.150",                 # host origen en s6
-                ipv4_dst="192.168.10.108",             # destino en s3
-                udp_dst=2000                           # puerto UDP 2000
-            )
-            actions_fwd = [
-                parser.OFPActionOutput(3)              # sale por s6-eth3 hacia s1
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=200,                          # suficientemente alto
-                match=match_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_fwd
-                )]
-            ))
-
-            # Sentido 2: 192.168.10.108 → 192.168.10.150
-            match_rev = parser.OFPMatch(
-                in_port=3,                             # llega de s6-eth3 (vía s1)
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=17,
-                ipv4_src="192.168.10.108",
-                ipv4_dst="192.168.10.150",
-                udp_src=2000
-            )
-            actions_rev = [
-                parser.OFPActionOutput(4)              # sale por s6-eth4 hacia el AP
-            ]
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp,
-                priority=200,
-                match=match_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_rev
-                )]
-            ))
-
-            
-            # ----------------------- DROP ALL ----------------------- #
-            dp.send_msg(parser.OFPFlowMod(
-                datapath=dp, priority=0,
-                match=parser.OFPMatch(),
-                instructions=[]
-            ))
+        expires = now + ARP_TTL
+        self.arp_responders[ip] = (mac, expires)
+        self.logger.info("Respondedor ARP %s -> %s", ip, mac)
+        for dp in self.datapaths.values():
+            for msg in self._arp_responder_msgs(dp, ip, mac, expires):
+                dp.send_msg(msg)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _barrier_reply_handler(self, ev):
+        dp = ev.msg.datapath
+        record = self.reroute_barriers.pop((dp.id, ev.msg.xid), None)
+        if record is not None:
+            self._reroute_confirmed(dp.id, record)
+            return
+        pending = self.pending_barriers.get(dp.id)
+        if pending is None or pending[0] != ev.msg.xid:
             return
+        del self.pending_barriers[dp.id]
+        groups, flows = self.install_msgs.get(dp.id, self.default_msgs)
+        self.logger.info(
+            "S%s programado en %.1f ms (%d grupos y medidores, %d flujos)",
+            dp.id, (time.time() - pending[1]) * 1000.0, len(groups), len(flows))
+
+    def _reroute_confirmed(self, dpid, record):
+        """dpid ya no está pendiente en record; si era el último, se registra
+        la latencia del reencaminamiento."""
+        record['pending'].discard(dpid)
+        if not record['pending']:
+            self.logger.warning(
+                "%s: reglas confirmadas en %.1f ms (cálculo %.1f ms, "
+                "%d mensajes)", record['cause'],
+                (time.time() - record['start']) * 1000.0,
+                (record['computed'] - record['start']) * 1000.0,
+                record['msgs'])
 
     #
     #  Manejador de paquetes entrantes: L2 learning y ARP proxy
@@ -1180,16 +2589,37 @@ class Iperf5004WithARP(app_manager.RyuApp):
         parser = dp.ofproto_parser
 
         in_port = msg.match['in_port']
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)
+        dst, src, ethertype = ETH_HEADER.unpack_from(msg.data)
+        if ethertype == ether_types.ETH_TYPE_LLDP:
+            # lo procesa ryu.topology; no se aprende ni se inunda
+            return
+        if dst[0] & 1 and in_port in self.blocked_ports.get(dp.id, ()):
+            # broadcast/multicast que entró por un enlace fuera del árbol
+            return
+        over = self.packet_in_budget.admit(dp.id, in_port)
+        if over is not None:
+            if over == 'port':
+                self._block_packet_in(dp, in_port)
+            return
 
-        if eth.ethertype != 0x0806:
-            # L2 learning
+        if ethertype != ether_types.ETH_TYPE_ARP:
+            # L2 learning (MACs en binario, sin decodificar el paquete)
             dpid = dp.id
-            src = eth.src; dst = eth.dst
             self.mac_to_port.setdefault(dpid, {})
             self.mac_to_port[dpid][src] = in_port
             out_port = self.mac_to_port[dpid].get(dst, ofp.OFPP_FLOOD)
+            if out_port == in_port:
+                return
+            mode = self._reactive_mode(dpid)
+            if out_port != ofp.OFPP_FLOOD and mode:
+                # destino conocido: el resto del flujo ya no pasa por aquí
+                self._install_reactive_flow(
+                    dp, msg, in_port, out_port, mode, src, dst)
+                if msg.buffer_id != ofp.OFP_NO_BUFFER:
+                    return
+            if out_port == ofp.OFPP_FLOOD:
+                self._flood(dp, msg, in_port)
+                return
             actions = [parser.OFPActionOutput(out_port)]
             out = parser.OFPPacketOut(
                 datapath=dp, buffer_id=msg.buffer_id,
@@ -1200,411 +2630,452 @@ class Iperf5004WithARP(app_manager.RyuApp):
             return
 
         # Proxy ARP
+        pkt = packet.Packet(msg.data)
         arp_pkt = pkt.get_protocol(arp.arp)
         src_ip = arp_pkt.src_ip
         dst_ip = arp_pkt.dst_ip
-        self.arp_table[src_ip] = (arp_pkt.src_mac, in_port)
+        if src_ip == '0.0.0.0':
+            # sondeo ARP (RFC 5227): el emisor aún no tiene dirección
+            return
+        # ARP gratuito (anuncio tras cambiar de AP): sólo refresca la caché
+        gratuitous = src_ip == dst_ip
+        changed = self.arp_table.learn(
+            src_ip, arp_pkt.src_mac, in_port, gratuitous)
+        if changed:
+            self.arp_replies.invalidate(src_ip)
+        self._update_arp_responder(src_ip, arp_pkt.src_mac, changed)
+        if gratuitous:
+            return
 
         if arp_pkt.opcode == arp.ARP_REQUEST:
-            if dst_ip in self.arp_table:
-                dst_mac, _ = self.arp_table[dst_ip]
-                # construir y enviar ARP reply
-                arp_reply = packet.Packet()
-                arp_reply.add_protocol(ethernet.ethernet(
-                    ethertype=eth.ethertype,
-                    dst=eth.src, src=dst_mac))
-                arp_reply.add_protocol(arp.arp(
-                    opcode=arp.ARP_REPLY,
-                    src_mac=dst_mac, src_ip=dst_ip,
-                    dst_mac=arp_pkt.src_mac, dst_ip=src_ip))
-                arp_reply.serialize()
+            known = self.arp_table.lookup(dst_ip)
+            if known is not None:
+                dst_mac, _ = known
+                # ARP reply desde la plantilla: eth src y sha/spa del
+                # solicitante se copian tal cual de la trama recibida
+                data = msg.data
+                arp_reply = self.arp_replies.reply(
+                    dst_ip, dst_mac, data[6:12], data[22:28], data[28:32])
                 actions = [parser.OFPActionOutput(in_port)]
                 out = parser.OFPPacketOut(
                     datapath=dp, buffer_id=ofp.OFP_NO_BUFFER,
                     in_port=ofp.OFPP_CONTROLLER,
-                    actions=actions, data=arp_reply.data)
+                    actions=actions, data=arp_reply)
                 dp.send_msg(out)
                 return
             # flood si no conoce destino
-            actions = [parser.OFPActionOutput(ofp.OFPP_FLOOD)]
-            out = parser.OFPPacketOut(
-                datapath=dp, buffer_id=msg.buffer_id,
-                in_port=in_port, actions=actions, data=msg.data)
-            dp.send_msg(out)
+            self._flood(dp, msg, in_port)
+            return
+
+    def _flood(self, dp, msg, in_port):
+        """Inunda por los puertos del árbol, salvo si la trama ya pasó por aquí."""
+        ofp = dp.ofproto
+        parser = dp.ofproto_parser
+        # con max_len msg.data puede ser sólo el principio de la trama
+        if self.flood_dedup.seen((dp.id, msg.total_len, zlib.crc32(msg.data))):
             return
+        if dp.ports:
+            blocked = self.blocked_ports.get(dp.id, ())
+            actions = [parser.OFPActionOutput(port) for port in dp.ports
+                       if port <= ofp.OFPP_MAX and port != in_port
+                       and port not in blocked]
+        else:
+            # aún sin la descripción de puertos del switch
+            actions = [parser.OFPActionOutput(ofp.OFPP_FLOOD)]
+        out = parser.OFPPacketOut(
+            datapath=dp, buffer_id=msg.buffer_id,
+            in_port=in_port, actions=actions,
+            data=msg.data if msg.buffer_id == ofp.OFP_NO_BUFFER else None)
+        dp.send_msg(out)
         
+    def _block_packet_in(self, dp, in_port):
+        """Descarta en el switch lo que in_port manda al controlador durante
+        PACKET_IN_BLOCK_TIME; los puertos entre switches no se bloquean."""
+        now = time.time()
+        key = (dp.id, in_port)
+        if self.packet_in_blocks.get(key, 0) > now:
+            return
+        if any(a == dp.id and port == in_port for (a, _), port
+               in self.link_util.link_ports.items()):
+            return
+        self.packet_in_blocks[key] = now + PACKET_IN_BLOCK_TIME
+        self.logger.warning(
+            "S%d puerto %d supera %d packet-in/s: se descarta en el switch "
+            "durante %d s", dp.id, in_port, PACKET_IN_PORT_RATE,
+            PACKET_IN_BLOCK_TIME)
+        for entry in packet_in_block_entries(in_port):
+            dp.send_msg(build_flow_mod(entry, dp,
+                                       hard_timeout=PACKET_IN_BLOCK_TIME))
+
+    def _arp_maintenance(self):
+        """Purga periódicamente la caché ARP y registra sus contadores."""
+        while True:
+            hub.sleep(ARP_STATS_INTERVAL)
+            for ip in self.arp_table.expire():
+                self.arp_replies.invalidate(ip)
+            self.logger.info(
+                "Caché ARP: %(size)d entradas, %(hits)d aciertos, "
+                "%(misses)d fallos, %(evictions)d expulsadas, "
+                "%(expirations)d caducadas, %(refreshes)d refrescos",
+                self.arp_table.stats())
+
+    def _reactive_mode(self, dpid):
+        if dpid in REACTIVE_MODE:
+            return REACTIVE_MODE[dpid]
+        return None if dpid in self.tables else REACTIVE_DEFAULT_MODE
+
+    def _install_reactive_flow(self, dp, msg, in_port, out_port, mode,
+                               src, dst):
+        """Instala un flujo con timeouts hacia out_port para el paquete dado.
+
+        src/dst son las MACs en binario de la cabecera Ethernet; sólo el modo
+        'exact' decodifica el paquete completo. Si el switch guardó el paquete
+        en buffer, el propio FlowMod lo libera por la nueva regla y no hace
+        falta packet-out.
+        """
+        ofp = dp.ofproto
+        parser = dp.ofproto_parser
+        fields = {'in_port': in_port}
+        ip = None
+        if mode == 'exact':
+            pkt = packet.Packet(msg.data)
+            ip = pkt.get_protocol(ipv4.ipv4)
+        if ip is not None:
+            fields.update(eth_type=ether_types.ETH_TYPE_IP,
+                          ipv4_src=ip.src, ipv4_dst=ip.dst, ip_proto=ip.proto)
+            l4 = pkt.get_protocol(tcp.tcp) or pkt.get_protocol(udp.udp)
+            if l4 is not None:
+                proto = 'tcp' if ip.proto == 6 else 'udp'
+                fields[proto + '_src'] = l4.src_port
+                fields[proto + '_dst'] = l4.dst_port
+        else:
+            fields.update(eth_src=addrconv.mac.bin_to_text(src),
+                          eth_dst=addrconv.mac.bin_to_text(dst))
+        dp.send_msg(parser.OFPFlowMod(
+            datapath=dp,
+            cookie=COOKIE_REACTIVE,
+            table_id=TABLE_FORWARD,
+            priority=REACTIVE_PRIORITY,
+            match=parser.OFPMatch(**fields),
+            idle_timeout=REACTIVE_IDLE_TIMEOUT,
+            hard_timeout=REACTIVE_HARD_TIMEOUT,
+            buffer_id=msg.buffer_id,
+            instructions=[parser.OFPInstructionActions(
+                ofp.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(out_port)]
+            )]
+        ))
+
     def _monitor(self):
-        """Cada POLL_INTERVAL sonda en S1 y S3 todos los flujos IP de una vez."""
+        """Sonda los flujos IP de S1 y S3 y los puertos de todos los switches.
+
+        El periodo lo decide AdaptivePoll a partir del último bitrate medido.
+        """
+        last_report = time.time()
         while True:
-            for dp in self.datapaths.values():
+            requests = 0
+            for dp in list(self.datapaths.values()):
+                parser = dp.ofproto_parser
                 if dp.id in [1, 3]:
-                    parser = dp.ofproto_parser
-                    # Pedimos stats de todos los flujos IP en la tabla 0
+                    # Pedimos stats sólo de las reglas de entrada del tráfico
+                    # entre VLANs (tabla de servicios) y de su conteo por
+                    # puerto de acceso (tabla de clasificación); el switch
+                    # filtra por cookie
                     req = parser.OFPFlowStatsRequest(
                         dp,
-                        table_id=0,
+                        table_id=dp.ofproto.OFPTT_ALL,
+                        cookie=COOKIE_VLAN | COOKIE_INGRESS,
+                        cookie_mask=COOKIE_VLAN | COOKIE_INGRESS,
                         match=parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP)
                     )
                     dp.send_msg(req)
-            hub.sleep(self.POLL_INTERVAL)
-
-    
-    
-    def _set_groups_50_50(self):
-        """Modifica grupos SELECT en S1 y S3 a 50/50."""
-        # Switch S1: group_id=10
-        dp1 = self.datapaths.get(1)
-        if dp1:
-            ofp = dp1.ofproto; parser = dp1.ofproto_parser
-            buckets = [
-                parser.OFPBucket(
-                    weight=50,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                        parser.OFPActionOutput(6)
-                    ]
-                ),
-                parser.OFPBucket(
-                    weight=50,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                        parser.OFPActionOutput(4)
-                    ]
-                )
-            ]
-            dp1.send_msg(parser.OFPGroupMod(
-                datapath=dp1,
-                command=ofp.OFPGC_MODIFY,
-                type_=ofp.OFPGT_SELECT,
-                group_id=10,
-                buckets=buckets
-            ))
-        # Switch S3: group_id=30
-        dp3 = self.datapaths.get(3)
-        if dp3:
-            ofp = dp3.ofproto; parser = dp3.ofproto_parser
-            buckets = [
-                parser.OFPBucket(
-                    weight=50,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                        parser.OFPActionOutput(5)
-                    ]
-                ),
-                parser.OFPBucket(
-                    weight=50,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                        parser.OFPActionOutput(4)
-                    ]
-                )
-            ]
-            dp3.send_msg(parser.OFPGroupMod(
-                datapath=dp3,
-                command=ofp.OFPGC_MODIFY,
-                type_=ofp.OFPGT_SELECT,
-                group_id=30,
-                buckets=buckets
-            ))
-
-
-        # —————————————————————————————————————————————————————
-        # 2) REROUTE MQTT-Raspberry
-        # —————————————————————————————————————————————————————
-
-        # --- En S1: modifica el flujo de retorno Mosquitto→Raspberry ---
-        dp1 = self.datapaths.get(1)
-        if dp1:
-            ofp = dp1.ofproto
-            parser = dp1.ofproto_parser
-
-            # FlowMod que reemplaza in_port=3 → output pasa de 4 a 5
-            match_rev = parser.OFPMatch(
-                in_port=3, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.105",
-                tcp_src=1883
-            )
-            actions_rev = [parser.OFPActionOutput(5)]
-            dp1.send_msg(parser.OFPFlowMod(
-                datapath=dp1,
-                priority=100,
-                match=match_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_rev
-                )]
-            ))
-
-        # --- En S3: modifica el flujo de ida Raspberry→Mosquitto ---
-        dp3 = self.datapaths.get(3)
-        if dp3:
-            ofp = dp3.ofproto
-            parser = dp3.ofproto_parser
-
-            # FlowMod que reemplaza in_port=6 → output pasa de 4 a 3
-            match_fwd = parser.OFPMatch(
-                in_port=6, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.105", ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            actions_fwd = [parser.OFPActionOutput(3)]
-            dp3.send_msg(parser.OFPFlowMod(
-                datapath=dp3,
-                priority=100,
-                match=match_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_fwd
-                )]
-            ))
-
-        # —— Reroute MQTT-Raspberry en S1 —— #
-        dp1 = self.datapaths.get(1)
-        if dp1:
-            ofp     = dp1.ofproto
-            parser  = dp1.ofproto_parser
-            # Cuando llega tráfico de la Raspberry por el puerto 5…
-            match = parser.OFPMatch(
-                in_port=5,
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,
-                ipv4_src="192.168.10.105",    # Raspberry
-                ipv4_dst="192.168.10.169",    # Mosquitto
-                tcp_dst=1883
-            )
-            actions = [ parser.OFPActionOutput(3) ]  # salta directo por s1→s3
-            dp1.send_msg(parser.OFPFlowMod(
-                datapath=dp1,
-                priority=100,
-                match=match,
-                instructions=[ parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions
-                )]
-            ))
-
-        # —— Reroute MQTT-Raspberry en S3 —— #
-        dp3 = self.datapaths.get(3)
-        if dp3:
-            ofp     = dp3.ofproto
-            parser  = dp3.ofproto_parser
-            # Cuando llega tráfico de Mosquitto por el puerto 3…
-            match = parser.OFPMatch(
-                in_port=3,
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,
-                ipv4_src="192.168.10.169",    # Mosquitto
-                ipv4_dst="192.168.10.105",    # Raspberry
-                tcp_src=1883
-            )
-            actions = [ parser.OFPActionOutput(6) ]  # sale por s3→AP (puerto 6)
-            dp3.send_msg(parser.OFPFlowMod(
-                datapath=dp3,
-                priority=100,
-                match=match,
-                instructions=[ parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions
-                )]
-            ))
-    
-    def _set_groups_original(self):
-        """Restaura grupos SELECT en S1 y S3 a 80/20 y 60/40."""
-        # S1 (group 10) a 80/20
-        dp1 = self.datapaths.get(1)
-        if dp1:
-            ofp = dp1.ofproto; parser = dp1.ofproto_parser
-            buckets = [
-                parser.OFPBucket(
-                    weight=80,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                        parser.OFPActionOutput(6)
-                    ]
-                ),
-                parser.OFPBucket(
-                    weight=20,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 10)),
-                        parser.OFPActionOutput(4)
-                    ]
-                )
-            ]
-            dp1.send_msg(parser.OFPGroupMod(
-                datapath=dp1,
-                command=ofp.OFPGC_MODIFY,
-                type_=ofp.OFPGT_SELECT,
-                group_id=10,
-                buckets=buckets
-            ))
-        # S3 (group 30) a 60/40
-        dp3 = self.datapaths.get(3)
-        if dp3:
-            ofp = dp3.ofproto; parser = dp3.ofproto_parser
-            buckets = [
-                parser.OFPBucket(
-                    weight=80,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                        parser.OFPActionOutput(5)
-                    ]
-                ),
-                parser.OFPBucket(
-                    weight=20,
-                    actions=[
-                        parser.OFPActionPushVlan(ether_types.ETH_TYPE_8021Q),
-                        parser.OFPActionSetField(vlan_vid=(0x1000 | 30)),
-                        parser.OFPActionOutput(4)
-                    ]
-                )
-            ]
-            dp3.send_msg(parser.OFPGroupMod(
-                datapath=dp3,
-                command=ofp.OFPGC_MODIFY,
-                type_=ofp.OFPGT_SELECT,
-                group_id=30,
-                buckets=buckets
-            ))
-    
-        # —————————————————————————————————————————————————————
-        # 2) RESTORE MQTT-Raspberry
-        # —————————————————————————————————————————————————————
-
-        # --- En S1: retorno Mosquitto→Raspberry: in_port=3 → output vuelve a 4 ---
-        dp1 = self.datapaths.get(1)
-        if dp1:
-            ofp = dp1.ofproto
-            parser = dp1.ofproto_parser
-
-            match_rev = parser.OFPMatch(
-                in_port=3, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.169", ipv4_dst="192.168.10.105",
-                tcp_src=1883
-            )
-            actions_rev = [parser.OFPActionOutput(4)]
-            dp1.send_msg(parser.OFPFlowMod(
-                datapath=dp1,
-                priority=100,
-                match=match_rev,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_rev
-                )]
-            ))
-
-        # --- En S3: ida Raspberry→Mosquitto: in_port=6 → output vuelve a 4 ---
-        dp3 = self.datapaths.get(3)
-        if dp3:
-            ofp = dp3.ofproto
-            parser = dp3.ofproto_parser
-
-            match_fwd = parser.OFPMatch(
-                in_port=6, eth_type=0x0800, ip_proto=6,
-                ipv4_src="192.168.10.105", ipv4_dst="192.168.10.169",
-                udp_dst=1883
-            )
-            actions_fwd = [parser.OFPActionOutput(4)]
-            dp3.send_msg(parser.OFPFlowMod(
-                datapath=dp3,
-                priority=100,
-                match=match_fwd,
-                instructions=[parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions_fwd
-                )]
-            ))
-        
-        # —— Restaurar MQTT-Raspberry en S1 —— #
-        dp1 = self.datapaths.get(1)
-        if dp1:
-            ofp    = dp1.ofproto
-            parser = dp1.ofproto_parser
-            # La ruta original Raspberry→Mosquitto entraba por el puerto 4…
-            match = parser.OFPMatch(
-                in_port=4,
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,
-                ipv4_src="192.168.10.105",
-                ipv4_dst="192.168.10.169",
-                tcp_dst=1883
-            )
-            actions = [ parser.OFPActionOutput(3) ]
-            dp1.send_msg(parser.OFPFlowMod(
-                datapath=dp1,
-                priority=100,
-                match=match,
-                instructions=[ parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions
-                )]
-            ))
-
-        # —— Restaurar MQTT-Raspberry en S3 —— #
-        dp3 = self.datapaths.get(3)
-        if dp3:
-            ofp    = dp3.ofproto
-            parser = dp3.ofproto_parser
-            # La ruta original Mosquitto→Raspberry entraba por el puerto 4…
-            match = parser.OFPMatch(
-                in_port=4,
-                eth_type=ether_types.ETH_TYPE_IP,
-                ip_proto=6,
-                ipv4_src="192.168.10.169",
-                ipv4_dst="192.168.10.105",
-                tcp_src=1883
-            )
-            actions = [ parser.OFPActionOutput(6) ]
-            dp3.send_msg(parser.OFPFlowMod(
-                datapath=dp3,
-                priority=100,
-                match=match,
-                instructions=[ parser.OFPInstructionActions(
-                    ofp.OFPIT_APPLY_ACTIONS, actions
-                )]
-            ))
-
+                    requests += 1
+                    if dp.id not in self.meterless:
+                        dp.send_msg(parser.OFPMeterStatsRequest(
+                            dp, 0, dp.ofproto.OFPM_ALL))
+                        requests += 1
+                dp.send_msg(parser.OFPPortStatsRequest(dp, 0, dp.ofproto.OFPP_ANY))
+                requests += 1
+            for dpid in list(self.datapaths):
+                self.work.submit(dpid, 'policies', self._update_policies, dpid)
+            interval = self.poll.update(self.flow_bps.values())
+            self.poll.record(requests)
+            if time.time() - last_report >= LINK_REPORT_INTERVAL:
+                last_report = time.time()
+                self.logger.info("Utilización de enlaces (kbps, fila -> columna):\n%s",
+                                 self.link_util.format_matrix())
+                self.logger.info(
+                    "Sondeo cada %.1f s: %d peticiones, %d ahorradas frente a %.1f s fijo",
+                    interval, self.poll.sent, self.poll.saved, self.POLL_INTERVAL)
+                self.logger.info(
+                    "Cambios de política: %d mensajes enviados, %d evitados "
+                    "frente a reenviar las tablas", self.sync_sent,
+                    self.sync_avoided)
+                self.logger.info("Colas de trabajo por switch:\n%s",
+                                 '\n'.join(self.work.report()))
+                lines = self.packet_in_budget.report()
+                if lines:
+                    self.logger.info("Packet-in por switch:\n%s",
+                                     '\n'.join(lines))
+                self._log_top_flows()
+            hub.sleep(interval)
+
+    def _worker(self):
+        """Hilo del pool: atiende por turnos las colas de los switches."""
+        while True:
+            try:
+                if not self.work.run_once():
+                    self.work.wait()
+            except Exception:
+                self.logger.exception("Fallo en una tarea de trabajo por switch")
+            # deja pasar los packet-in entre tarea y tarea
+            hub.sleep(0)
+
+    def _update_policies(self, dpid):
+        """Pesos SELECT y límites de medidor de un switch."""
+        self._update_group_weights(dpid)
+        self._update_meters(dpid)
+
+    def _log_top_flows(self):
+        """Reglas con más tráfico en S1 y S3."""
+        lines = ['  %10.1f kbps  %s' % (bps / 1000.0, FlowRateTracker.format_key(key))
+                 for bps, key in self.flow_rates.top(FLOW_TOP_N) if bps > 0]
+        if lines:
+            self.logger.info("Reglas con más tráfico:\n%s", '\n'.join(lines))
+
+    def _update_group_weights(self, only=None):
+        """Reparte los grupos SELECT según la capacidad libre de cada camino.
+
+        only limita el reparto a los grupos de ese switch.
+        """
+        for group in self.group_weights:
+            dp = self.datapaths.get(group.dpid)
+            if dp is None or only not in (None, group.dpid):
+                continue
+            free = [self.link_util.path_spare_bps(path) / LINK_CAPACITY_BPS
+                    for path in group.paths]
+            old = group.weights
+            weights = group.update(free)
+            if weights is None:
+                continue
+            self.logger.info(
+                "S%d grupo %d: pesos %s -> %s", group.dpid, group.group_id,
+                '/'.join(map(str, old)), '/'.join(map(str, weights)))
+            self._sync(dp)
+
+    def _update_meters(self, only=None):
+        """Ajusta el límite de cada medidor a la capacidad libre medida.
+
+        El límite es el tráfico que ya pasa por el medidor más lo que cabe
+        en sus caminos sin bajar de METER_RESERVE_BPS libres en cada uno.
+        only limita el ajuste a los medidores de ese switch.
+        """
+        now = time.time()
+        service_mask = COOKIE_SERVICE_MASK | COOKIE_INGRESS | COOKIE_ACCESS
+        for dpid, meter_id, paths, service in self.metered:
+            dp = self.datapaths.get(dpid)
+            if dp is None or only not in (None, dpid) or \
+                    dpid in self.meterless:
+                continue
+            limit, changed_at = self.meter_limits.get(
+                (dpid, meter_id), (METER_MAX_BPS, 0.0))
+            if now - changed_at < METER_MIN_DWELL:
+                continue
+            metered_bps = sum(
+                bps for key, bps in self.flow_rates.rates.items()
+                if key[0] == dpid and
+                key[3] & service_mask == service | COOKIE_INGRESS)
+            target = metered_bps + sum(
+                self.link_util.path_spare_bps(path) - METER_RESERVE_BPS
+                for path in paths)
+            target = min(max(target, METER_MIN_BPS), METER_MAX_BPS)
+            if abs(target - limit) < METER_HYSTERESIS * limit:
+                continue
+            self.meter_limits[(dpid, meter_id)] = (target, now)
+            self.logger.info("Medidor %d de S%d: límite %.0f -> %.0f kbps",
+                             meter_id, dpid, limit / 1000.0, target / 1000.0)
+            self._sync(dp)
+
+    @set_ev_cls(ofp_event.EventOFPMeterStatsReply, MAIN_DISPATCHER)
+    def _meter_stats_reply(self, ev):
+        body = self._stats_body(ev.msg)
+        if body is None:
+            return
+        dp = ev.msg.datapath
+        self.work.submit(dp.id, 'meter_stats', self._meter_stats, dp, body)
 
+    def _meter_stats(self, dp, body):
+        """Registra el tráfico descartado por cada medidor desde la última respuesta."""
+        dpid = dp.id
+        for stat in body:
+            key = (dpid, stat.meter_id)
+            dropped = sum(band.byte_band_count for band in stat.band_stats)
+            duration = stat.duration_sec + stat.duration_nsec * 1e-9
+            prev = self.meter_drops.get(key)
+            self.meter_drops[key] = (dropped, duration)
+            if prev is None or duration <= prev[1] or dropped <= prev[0]:
+                continue
+            self.logger.info(
+                "Medidor %d de S%d: %.1f kbps descartados", stat.meter_id, dpid,
+                (dropped - prev[0]) * 8 / (duration - prev[1]) / 1000.0)
+
+    def _group_entry(self, group):
+        """GroupEntry compilado del grupo SELECT que controla group."""
+        return next(entry for entry in self.tables[group.dpid].groups
+                    if entry.group_id == group.group_id)
+
+    def _check_elephant(self, dp, key, bps):
+        """Fija, mueve o devuelve al grupo el tráfico de un puerto de acceso.
+
+        bps es lo que cuenta la regla del puerto en la tabla de
+        clasificación, sólo el tráfico que entra al servicio. Por encima de
+        ELEPHANT_BPS se fija al camino más libre; ya fijado, se mueve a otro
+        camino sólo si allí le quedaría más capacidad libre que en el suyo
+        contándose a sí mismo (así no vuelve atrás en la muestra siguiente),
+        y por debajo de ELEPHANT_EXIT_FRACTION * ELEPHANT_BPS se borra.
+        """
+        dpid, in_port = key
+        current = self.elephants.get(key)
+        if current is None and bps < ELEPHANT_BPS:
+            return
+        group, _ = self.elephant_rules[key]
+        if current is not None and bps < ELEPHANT_BPS * ELEPHANT_EXIT_FRACTION:
+            pin = self._elephant_pin(key, current)
+            dp.send_msg(build_flow_mod(
+                pin._replace(actions=()), dp,
+                command=dp.ofproto.OFPFC_DELETE_STRICT,
+                out_port=dp.ofproto.OFPP_ANY, out_group=dp.ofproto.OFPG_ANY))
+            del self.elephants[key]
+            self.logger.info(
+                "Elefante en S%d puerto %d baja a %.0f bps: vuelve al grupo",
+                dpid, in_port, bps)
+            return
+        spare = [self.link_util.path_spare_bps(path) for path in group.paths]
+        idx = spare.index(max(spare))
+        if current is not None and (
+                idx == current or spare[idx] <= spare[current] + bps):
+            return
+        # ADD con el mismo match sustituye las acciones de la regla fijada
+        dp.send_msg(build_flow_mod(
+            self._elephant_pin(key, idx), dp,
+            idle_timeout=ELEPHANT_IDLE_TIMEOUT,
+            flags=dp.ofproto.OFPFF_SEND_FLOW_REM))
+        self.elephants[key] = idx
+        self.logger.warning(
+            "Elefante en S%d puerto %d (%.0f bps): %s por %s",
+            dpid, in_port, bps, 'fijado' if current is None else 'movido',
+            '-'.join('S%d' % hop for hop in group.paths[idx]))
+
+    def _elephant_pin(self, key, idx):
+        """Regla que fija el tráfico de servicio del puerto key al camino idx.
+
+        Es la de servicio del grupo restringida a in_port, así que el resto
+        de servicios del puerto no se ven afectados.
+        """
+        dpid, in_port = key
+        group, flow = self.elephant_rules[key]
+        bucket = self._group_entry(group).buckets[idx]
+        # el elefante sigue pasando por el medidor de la regla original
+        meters = tuple(action for action in flow.actions
+                       if action[0] == 'meter' and dpid not in self.meterless)
+        return FlowEntry(ELEPHANT_PRIORITY,
+                         _match(in_port=in_port, **dict(flow.match)),
+                         meters + bucket.actions,
+                         flow.cookie | COOKIE_ELEPHANT, flow.table_id)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        """El switch borró por inactividad la regla de un elefante."""
+        msg = ev.msg
+        if msg.cookie & COOKIE_KIND_MASK != COOKIE_ELEPHANT:
+            return
+        key = (msg.datapath.id, msg.match.get('in_port'))
+        if self.elephants.pop(key, None) is not None:
+            self.logger.info("Elefante en S%d puerto %d inactivo: vuelve al grupo",
+                             *key)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply(self, ev):
+        body = self._stats_body(ev.msg)
+        if body is None:
+            return
+        dp = ev.msg.datapath
+        self.work.submit(dp.id, 'port_stats', self._port_stats, dp, body)
 
+    def _port_stats(self, dp, body):
+        """Actualiza las tasas tx/rx por puerto."""
+        dpid = dp.id
+        for stat in body:
+            self.link_util.update(
+                dpid, stat.port_no, stat.tx_bytes, stat.rx_bytes,
+                stat.duration_sec + stat.duration_nsec * 1e-9)
 
-    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    
+    
+    def _sync_detour(self):
+        """Aplica el estado de high_congestion al desvío de MQTT-Raspberry.
+
+        Con high_congestion activo _intended incluye las reglas del desvío
+        por el enlace directo S1-S3, que quedan por encima del camino
+        normal S3-S2-S1; sin él, la diferencia las borra en estricto y el
+        tráfico vuelve a las compiladas, que siguen instaladas debajo.
+        """
+        for dpid in self.detour_tables:
+            dp = self.datapaths.get(dpid)
+            if dp:
+                self._sync(dp)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
     def _flow_stats_reply(self, ev):
-        """Procesa estadísticas de S1 y S3, sumando bytes de los puertos de interés."""
+        if self._dump_reply(ev, flow_entry_from_stats):
+            return
+        body = self._stats_body(ev.msg)
+        if body is None:
+            return
         dp = ev.msg.datapath
+        self.work.submit(dp.id, 'flow_stats', self._flow_stats, dp, body)
+
+    def _flow_stats(self, dp, body):
+        """Procesa estadísticas de S1 y S3: sólo llegan las reglas de entrada
+        entre VLANs y las de su conteo por puerto de acceso."""
         dpid = dp.id
 
         # Sólo procesamos replies de S1 y S3
         if dpid not in [1, 3]:
             return
 
-        total_bits = 0
-        for stat in ev.msg.body:
-            in_p = stat.match.get('in_port')
-            # flujos de S1: in_ports 1,2,3
-            if dpid == 1 and in_p in [1, 2, 3]:
-                key = (dpid, in_p)
-            # flujos de S3: in_ports 1,2,6
-            elif dpid == 3 and in_p in [1, 2, 6]:
-                key = (dpid, in_p)
-            else:
+        # bps de cada regla con su propia duración (el periodo de sondeo
+        # es variable)
+        now = time.time()
+        bps = 0.0
+        for stat, rule_bps in self.flow_rates.update(dpid, body):
+            if not stat.cookie & COOKIE_ACCESS:
+                bps += rule_bps
                 continue
+            key = (dpid, stat.match.get('in_port'))
+            if key in self.elephant_rules:
+                self._check_elephant(dp, key, rule_bps)
 
-            prev = self.prev_flow_bytes.get(key, 0)
-            delta_bytes = stat.byte_count - prev
-            self.prev_flow_bytes[key] = stat.byte_count
-            total_bits += delta_bytes * 8
-
-        # Calculamos bps agregados de S1+S3
-        bps = total_bits / self.POLL_INTERVAL
+        self.flow_bps[dpid] = (self.flow_bps.get(dpid, (None, None))[1], bps)
         self.logger.info(
             "Bitrate trafico entre VLAN10↔30: %.2f bps", bps)
 
+        # El reparto de los grupos SELECT lo ajusta _update_group_weights;
+        # aquí sólo se decide el desvío de MQTT-Raspberry, con banda de
+        # histéresis sobre el mayor bitrate de S1 y S3
+        bps = max(current for _, current in self.flow_bps.values())
+        if now - self.reroute_changed < REROUTE_MIN_DWELL:
+            return
         if bps > UMBRAL_BPS and not self.high_congestion:
-            self.logger.warning("¡Umbral sobrepasado, paso a 50/50!")
+            self.logger.warning("¡Umbral sobrepasado, desvío MQTT-Raspberry por S1-S3!")
+            self._log_top_flows()
             self.high_congestion = True
-            self._set_groups_50_50()
+            self.reroute_changed = now
+            self._sync_detour()
 
-        elif bps <= UMBRAL_BPS and self.high_congestion:
-            self.logger.info("Trafico normalizado, vuelvo a 80/20.")
+        elif bps < UMBRAL_BPS * REROUTE_EXIT_FRACTION and self.high_congestion:
+            self.logger.info("Trafico normalizado, MQTT-Raspberry vuelve por S2.")
             self.high_congestion = False
-            self._set_groups_original()
+            self.reroute_changed = now
+            self._sync_detour()
             
\ No newline at end of file
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Herramientas de topologia.py --qos-test:
+#   server/client: latencia TCP en el puerto de MQTT (1883); el servidor hace
+#                  eco de cada mensaje y el cliente mide el tiempo de ida y
+#                  vuelta de mensajes pequeños como un PUBLISH.
+#   flood:         tráfico UDP a tasa fija con IP y puerto de origen elegidos,
+#                  para que case con las reglas de IPTV o del radar.
+#
+# Uso:
+#     python3 qos_probe.py server [puerto]
+#     python3 qos_probe.py client destino [puerto] [mensajes] [ip_origen]
+#     python3 qos_probe.py flood destino puerto ip_origen puerto_origen mbps segundos
+#
+import socket
+import socketserver
+import sys
+import time
+
+MESSAGE = b'x' * 64         # tamaño aproximado de un PUBLISH de sensor
+INTERVAL = 0.05             # segundos entre mensajes
+DATAGRAM = 1400             # bytes de carga UDP en flood
+
+
+class Echo(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(len(MESSAGE))
+            if not data:
+                return
+            self.request.sendall(data)
+
+
+def server(port):
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer(('', port), Echo).serve_forever()
+
+
+def client(host, port, count, source=None):
+    sock = socket.create_connection(
+        (host, port), timeout=5,
+        source_address=(source, 0) if source else None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            sock.sendall(MESSAGE)
+            received = 0
+            while received < len(MESSAGE):
+                data = sock.recv(len(MESSAGE) - received)
+                if not data:
+                    raise socket.timeout
+                received += len(data)
+        except socket.timeout:
+            # la conexión quedó desalineada: se cuentan como perdidas el resto
+            break
+        samples.append((time.perf_counter() - start) * 1000.0)
+        time.sleep(INTERVAL)
+    sock.close()
+    lost = count - len(samples)
+    if not samples:
+        print("sin respuestas (%d perdidas)" % lost)
+        return
+    samples.sort()
+    print("n=%d media=%.2f p50=%.2f p95=%.2f max=%.2f ms perdidas=%d" % (
+        len(samples), sum(samples) / len(samples),
+        samples[len(samples) // 2], samples[int(len(samples) * 0.95)],
+        samples[-1], lost))
+
+
+def flood(host, port, source, source_port, mbps, seconds):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((source, source_port))
+    payload = b'\x00' * DATAGRAM
+    gap = DATAGRAM * 8 / (mbps * 1e6)
+    start = next_send = time.perf_counter()
+    while next_send - start < seconds:
+        try:
+            sock.sendto(payload, (host, port))
+        except OSError:
+            # ICMP port unreachable del destino: no importa
+            pass
+        next_send += gap
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('server', 'client', 'flood'):
+        sys.exit("uso: qos_probe.py server [puerto] | "
+                 "client destino [puerto] [mensajes] [ip_origen] | "
+                 "flood destino puerto ip_origen puerto_origen mbps segundos")
+    if sys.argv[1] == 'flood':
+        if len(sys.argv) < 8:
+            sys.exit("flood necesita destino puerto ip_origen puerto_origen mbps segundos")
+        flood(sys.argv[2], int(sys.argv[3]), sys.argv[4], int(sys.argv[5]),
+              float(sys.argv[6]), float(sys.argv[7]))
+        return
+    if sys.argv[1] == 'server':
+        server(int(sys.argv[2]) if len(sys.argv) > 2 else 1883)
+        return
+    if len(sys.argv) < 3:
+        sys.exit("falta el destino")
+    client(sys.argv[2],
+           int(sys.argv[3]) if len(sys.argv) > 3 else 1883,
+           int(sys.argv[4]) if len(sys.argv) > 4 else 200,
+           sys.argv[5] if len(sys.argv) > 5 else None)
+
+
+if __name__ == '__main__':
+    main()
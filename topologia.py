@@ -6,14 +6,107 @@ from mininet.cli import CLI
 from mininet.log import setLogLevel, info
 from mininet.link import Intf
 import os          
+import sys
+import time
 
-def myNetwork():
+# Prueba de colas QoS (--qos-test): los AP se sustituyen por hosts emulados en
+# los mismos puertos (s6-eth4 y s3-eth6) con las IPs de sus equipos
+QOS_TEST_SECONDS = 20       # duración de la saturación en cada fase
+QOS_TEST_MBPS = 20          # el doble de la capacidad de los enlaces
+QOS_TEST_MESSAGES = 200
+
+
+def interswitch_ports(net):
+    """Interfaces de los enlaces entre switches."""
+    return [intf.name for link in net.links
+            for intf in (link.intf1, link.intf2)
+            if link.intf1.node in net.switches and link.intf2.node in net.switches]
+
+
+def wait_queues(ports, timeout=30):
+    """Espera a que el controlador ponga QoS en todos los puertos."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pending = [port for port in ports
+                   if os.popen('ovs-vsctl get port %s qos' % port).read().strip() == '[]']
+        if not pending:
+            return True
+        time.sleep(1)
+    return False
+
+
+def disable_queues(ports):
+    """Sustituye las colas del controlador por una QoS de una sola cola.
+
+    Se mantiene el límite de la cola por defecto para que la congestión sea
+    la misma; devuelve lo necesario para restore_queues.
+    """
+    saved = dict((port, os.popen('ovs-vsctl get port %s qos' % port).read().strip())
+                 for port in ports)
+    cmd = 'ovs-vsctl'
+    for port in ports:
+        cmd += ' -- set port %s qos=@fifo' % port
+    cmd += (' -- --id=@fifo create qos type=linux-htb other-config:max-rate=10000000'
+            ' queues:0=@q0 -- --id=@q0 create queue other-config:max-rate=10000000')
+    created = os.popen(cmd).read().split()
+    return saved, created
+
+
+def restore_queues(saved, created):
+    for port, qos in saved.items():
+        os.system('ovs-vsctl set port %s qos=%s' % (port, qos))
+    os.system('ovs-vsctl destroy qos %s -- destroy queue %s' % tuple(created))
+
+
+def qos_test(net):
+    """Latencia MQTT Raspberry -> Mosquitto con los enlaces saturados.
+
+    La saturación es UDP que no pasa por el medidor del best effort: IPTV de
+    h2 hacia la VLAN 10 (origen 5004, por S3-S2-S1) y el visualizador hacia
+    el radar (origen 2000, por S3-S1), así que el MQTT cruza una cola
+    congestionada tanto por su camino normal como por el desvío. Se mide con
+    las colas del controlador y con una sola cola FIFO.
+    """
+    h2, h5, ap3 = net.get('h2', 'h5', 'ap3')
+    ports = interswitch_ports(net)
+    if not wait_queues(ports):
+        info('*** El controlador no configuró las colas (¿QOS_ENABLED?)\n')
+        return
+    h5.cmd('python3 qos_probe.py server 1883 &')
+    # resolver ARP antes de medir
+    h2.cmd('ping -c 1 -W 1 192.168.10.3')
+    ap3.cmd('ping -c 1 -W 1 192.168.10.169')
+    ap3.cmd('ping -c 1 -W 1 -I 192.168.10.108 192.168.10.150')
+
+    results = {}
+    for phase in ('con colas', 'sin colas'):
+        fifo = disable_queues(ports) if phase == 'sin colas' else None
+        h2.cmd('python3 qos_probe.py flood 192.168.10.3 5004 192.168.10.5 5004 '
+               '%s %d &' % (QOS_TEST_MBPS, QOS_TEST_SECONDS))
+        ap3.cmd('python3 qos_probe.py flood 192.168.10.150 2000 192.168.10.108 2000 '
+                '%s %d &' % (QOS_TEST_MBPS, QOS_TEST_SECONDS))
+        time.sleep(2)
+        results[phase] = ap3.cmd('python3 qos_probe.py client 192.168.10.169 1883 %d '
+                                 '192.168.10.105' % QOS_TEST_MESSAGES).strip()
+        h2.cmd('wait')
+        ap3.cmd('wait')
+        if fifo:
+            restore_queues(*fifo)
+        time.sleep(2)
+
+    for phase, result in results.items():
+        info('*** MQTT %s: %s\n' % (phase, result))
+    h5.cmd('kill %python3')
+
+
+def myNetwork(qos_test_mode=False):
     
-    os.system("sudo ip link add veth-eth0 type veth peer name veth-ovs1")
-    os.system("sudo ip link set veth-eth0 up")
-    os.system("sudo ip link set veth-ovs1 up")
-    os.system("sudo ip link set dev veth-eth0 master br1")
-    os.system("sudo ip link set dev eth0 master br1")
+    if not qos_test_mode:
+        os.system("sudo ip link add veth-eth0 type veth peer name veth-ovs1")
+        os.system("sudo ip link set veth-eth0 up")
+        os.system("sudo ip link set veth-ovs1 up")
+        os.system("sudo ip link set dev veth-eth0 master br1")
+        os.system("sudo ip link set dev eth0 master br1")
 
     net = Mininet(topo=None, build=False, ipBase='10.0.0.0/8')
 
@@ -55,8 +148,15 @@ def myNetwork():
     net.addLink(s5, s6)
     net.addLink(s1, s6)
 
-    Intf('veth-ovs', node=s6)
-    Intf('veth-ovs1', node=s3)
+    if qos_test_mode:
+        # AP-s6 (ESP32 y radar) y AP-s3 (Raspberry y visualizador) emulados
+        ap6 = net.addHost('ap6', cls=Host, ip='192.168.10.138/24', defaultRoute=None)
+        ap3 = net.addHost('ap3', cls=Host, ip='192.168.10.105/24', defaultRoute=None)
+        net.addLink(ap6, s6)
+        net.addLink(ap3, s3)
+    else:
+        Intf('veth-ovs', node=s6)
+        Intf('veth-ovs1', node=s3)
 
     net.build()
     c0.start()
@@ -102,9 +202,14 @@ def myNetwork():
     
     #h5.cmd('mosquitto -c /etc/mosquitto/mosquitto.conf -d')
 
-    CLI(net)
+    if qos_test_mode:
+        ap6.cmd('ip addr add 192.168.10.150/24 dev ap6-eth0')
+        ap3.cmd('ip addr add 192.168.10.108/24 dev ap3-eth0')
+        qos_test(net)
+    else:
+        CLI(net)
     net.stop()
 
 if __name__ == '__main__':
     setLogLevel('info')
-    myNetwork()
\ No newline at end of file
+    myNetwork(qos_test_mode='--qos-test' in sys.argv)
\ No newline at end of file